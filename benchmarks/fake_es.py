@@ -0,0 +1,311 @@
+"""
+Offline stand-in for the Elasticsearch endpoints the chat app uses.
+
+Search responses are replayed from recordings when one matches the query text, otherwise they are
+synthesized from kaggle_datasets_restaurant-reviews.csv in the shape of a real restaurant_reviews
+response (metadata in _source, semantic_body chunks as inner hits). Completions are generated with a
+tunable per-token latency.
+
+    python benchmarks/fake_es.py --port 9201 --token-latency 0.02
+    # record real responses to replay later
+    python benchmarks/fake_es.py --upstream https://my-es:9200 --api-key ... --record-dir benchmarks/recordings
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from collections import defaultdict
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CSV = os.path.join(ROOT, "vectordb-genai-101", "kaggle_datasets_restaurant-reviews.csv")
+PRODUCT_HEADERS = {"X-Elastic-Product": "Elasticsearch"}
+WORD = re.compile(r"[a-z0-9]+")
+
+ANSWER_WORDS = (
+    "Based on the reviews, Beyond Flavours is a great pick for a relaxed dinner [1]. Guests praise the "
+    "courteous staff and the value for money, and several reviewers recommend the biryani and the "
+    "desserts [2]. If you prefer something quieter, the rooftop seating is mentioned as a highlight [3]."
+).split(" ")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def chunk_text(text, size=40):
+    """Split a review into chunks of about size words, like semantic_text does with its chunking"""
+    words = text.split()
+    return [" ".join(words[i:i + size]) for i in range(0, len(words), size)] or [""]
+
+
+def query_text(body):
+    """The user text inside a search body, whichever strategy built it"""
+    if isinstance(body, dict):
+        for key, value in body.items():
+            if key in ("model_text", "query") and isinstance(value, str):
+                return value
+            if key == "match" and isinstance(value, dict):
+                for field_value in value.values():
+                    return field_value if isinstance(field_value, str) else field_value.get("query", "")
+            found = query_text(value)
+            if found:
+                return found
+    elif isinstance(body, list):
+        for item in body:
+            found = query_text(item)
+            if found:
+                return found
+    return None
+
+
+def find_inner_hits(body):
+    if isinstance(body, dict):
+        if "inner_hits" in body:
+            return body["inner_hits"]
+        for value in body.values():
+            found = find_inner_hits(value)
+            if found:
+                return found
+    return None
+
+
+class ReviewCorpus:
+    """Reviews from the CSV with a small inverted index for term-overlap scoring"""
+
+    def __init__(self, path, max_docs):
+        self.docs = []
+        self.postings = defaultdict(list)
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if not row.get("Review"):
+                    continue
+                doc_id = len(self.docs)
+                self.docs.append(row)
+                for token in set(tokenize(row["Review"])):
+                    self.postings[token].append(doc_id)
+                if len(self.docs) >= max_docs:
+                    break
+
+    def search(self, text, size):
+        scores = defaultdict(int)
+        for token in set(tokenize(text or "")):
+            for doc_id in self.postings.get(token, ()):
+                scores[doc_id] += 1
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:size]
+        return [(doc_id, float(score)) for doc_id, score in ranked]
+
+
+class FakeElasticsearch:
+    def __init__(self, corpus, token_latency, response_tokens, recordings, upstream=None, record_dir=None):
+        self.corpus = corpus
+        self.token_latency = token_latency
+        self.response_tokens = response_tokens
+        self.recordings = recordings
+        self.upstream = upstream
+        self.record_dir = record_dir
+        self.requests = defaultdict(int)
+
+    # --- search ---
+
+    def synthesize(self, index, body):
+        size = body.get("size", 10)
+        text = query_text(body)
+        includes = (body.get("_source") or {}).get("includes")
+        inner_hits = find_inner_hits(body)
+
+        hits = []
+        for doc_id, score in self.corpus.search(text, size):
+            row = self.corpus.docs[doc_id]
+            source = {k: v for k, v in row.items() if includes is None or k in includes}
+            if "Rating" in source:
+                try:
+                    source["Rating"] = float(source["Rating"])
+                except ValueError:
+                    pass
+            hit = {"_index": index, "_id": f"{index}-{doc_id}", "_score": score, "_source": source}
+            if inner_hits:
+                chunks = chunk_text(row["Review"])[:inner_hits.get("size", 3)]
+                hit["inner_hits"] = {
+                    inner_hits.get("name", "chunks"): {
+                        "hits": {
+                            "hits": [
+                                {"_score": score / (n + 1), "_source": {"text": chunk}}
+                                for n, chunk in enumerate(chunks)
+                            ]
+                        }
+                    }
+                }
+            hits.append(hit)
+        return {"took": 1, "timed_out": False, "hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+    def recording_key(self, index, body):
+        return hashlib.sha1(f"{index}|{query_text(body)}|{json.dumps(body, sort_keys=True)}".encode()).hexdigest()
+
+    async def search_one(self, index, body, params):
+        key = self.recording_key(index, body)
+        if key in self.recordings:
+            return self.recordings[key]
+        if self.upstream:
+            response = await self.upstream.post(f"/{index}/_search", json=body, params=params)
+            result = await response.json()
+            self.save_recording(key, index, body, result)
+            return result
+        return self.synthesize(index, body)
+
+    def save_recording(self, key, index, body, response):
+        self.recordings[key] = response
+        if self.record_dir:
+            os.makedirs(self.record_dir, exist_ok=True)
+            with open(os.path.join(self.record_dir, f"{key}.json"), "w") as f:
+                json.dump({"key": key, "index": index, "query": query_text(body), "response": response}, f)
+
+    async def handle_search(self, request):
+        self.requests["search"] += 1
+        body = await request.json() if request.can_read_body else {}
+        params = {k: v for k, v in request.query.items() if k != "filter_path"}
+        result = await self.search_one(request.match_info["index"], body, params)
+        return web.json_response(result, headers=PRODUCT_HEADERS)
+
+    async def handle_msearch(self, request):
+        self.requests["msearch"] += 1
+        lines = [json.loads(line) for line in (await request.text()).splitlines() if line.strip()]
+        default_index = request.match_info.get("index")
+        responses = []
+        for header, body in zip(lines[0::2], lines[1::2]):
+            index = header.get("index", default_index)
+            responses.append(await self.search_one(index, body, {}))
+        return web.json_response({"took": 1, "responses": responses}, headers=PRODUCT_HEADERS)
+
+    # --- inference ---
+
+    def answer_tokens(self):
+        words = [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(self.response_tokens)]
+        return [word + " " for word in words]
+
+    async def handle_completion(self, request):
+        self.requests["completion"] += 1
+        tokens = self.answer_tokens()
+        await asyncio.sleep(self.token_latency * len(tokens))
+        return web.json_response({"completion": [{"result": "".join(tokens).strip()}]}, headers=PRODUCT_HEADERS)
+
+    async def handle_stream(self, request):
+        self.requests["stream"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **PRODUCT_HEADERS})
+        await response.prepare(request)
+        for token in self.answer_tokens():
+            await asyncio.sleep(self.token_latency)
+            event = json.dumps({"completion": [{"delta": token}]})
+            await response.write(f"event: message\ndata: {event}\n\n".encode())
+        await response.write(b"event: message\ndata: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_embedding(self, request):
+        self.requests["embedding"] += 1
+        body = await request.json()
+        inputs = body.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        embeddings = []
+        for text in inputs:
+            digest = hashlib.sha256(str(text).encode()).digest()
+            embeddings.append({"embedding": [b / 255.0 for b in digest[:16]]})
+        return web.json_response({"text_embedding": embeddings}, headers=PRODUCT_HEADERS)
+
+    async def handle_rerank(self, request):
+        """Word overlap with the query, in the shape of the rerank task API"""
+        self.requests["rerank"] += 1
+        body = await request.json()
+        query = set(tokenize(body.get("query", "")))
+        ranked = []
+        for position, text in enumerate(body.get("input", [])):
+            words = tokenize(text)
+            ranked.append({"index": position, "relevance_score": len(query.intersection(words)) / (len(query) or 1)})
+        await asyncio.sleep(self.token_latency * len(ranked))
+        ranked.sort(key=lambda item: item["relevance_score"], reverse=True)
+        return web.json_response({"rerank": ranked}, headers=PRODUCT_HEADERS)
+
+    # --- cluster ---
+
+    async def handle_info(self, request):
+        return web.json_response({
+            "name": "fake-es",
+            "cluster_name": "benchmark",
+            "version": {"number": "8.15.0", "build_flavor": "default"},
+            "tagline": "You Know, for Search"
+        }, headers=PRODUCT_HEADERS)
+
+    async def handle_index_exists(self, request):
+        return web.Response(status=200, headers=PRODUCT_HEADERS)
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.requests))
+
+
+def load_recordings(directory):
+    recordings = {}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        with open(path) as f:
+            entry = json.load(f)
+        recordings[entry["key"]] = entry["response"]
+    return recordings
+
+
+def build_app(fake):
+    app = web.Application(client_max_size=32 * 1024 ** 2)
+    app.router.add_get("/", fake.handle_info)
+    app.router.add_get("/_fake/stats", fake.handle_stats)
+    app.router.add_post("/_msearch", fake.handle_msearch)
+    app.router.add_post("/_inference/completion/{inference_id}/_stream", fake.handle_stream)
+    app.router.add_post("/_inference/completion/{inference_id}", fake.handle_completion)
+    app.router.add_post("/_inference/text_embedding/{inference_id}", fake.handle_embedding)
+    app.router.add_post("/_inference/rerank/{inference_id}", fake.handle_rerank)
+    app.router.add_post("/{index}/_search", fake.handle_search)
+    app.router.add_get("/{index}/_search", fake.handle_search)
+    app.router.add_post("/{index}/_msearch", fake.handle_msearch)
+    app.router.add_route("HEAD", "/{index}", fake.handle_index_exists)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9201)
+    parser.add_argument("--csv", default=DEFAULT_CSV)
+    parser.add_argument("--max-docs", type=int, default=5000, help="reviews loaded from the CSV")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds per generated token")
+    parser.add_argument("--response-tokens", type=int, default=60, help="tokens per completion")
+    parser.add_argument("--recordings", default=os.path.join(os.path.dirname(__file__), "recordings"))
+    parser.add_argument("--upstream", help="real Elasticsearch URL, search misses are forwarded and recorded")
+    parser.add_argument("--api-key", default=os.getenv("ES_API_KEY"))
+    parser.add_argument("--record-dir", help="where upstream responses are saved, defaults to --recordings")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    corpus = ReviewCorpus(args.csv, args.max_docs)
+    recordings = load_recordings(args.recordings)
+    print(f"fake-es: {len(corpus.docs)} reviews and {len(recordings)} recordings loaded in "
+          f"{time.perf_counter() - started:.1f}s", flush=True)
+
+    async def start():
+        upstream = None
+        if args.upstream:
+            headers = {"Authorization": f"ApiKey {args.api_key}"} if args.api_key else {}
+            upstream = ClientSession(base_url=args.upstream, headers=headers)
+        fake = FakeElasticsearch(
+            corpus, args.token_latency, args.response_tokens, recordings,
+            upstream=upstream, record_dir=args.record_dir or (args.recordings if args.upstream else None)
+        )
+        return build_app(fake)
+
+    web.run_app(start(), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
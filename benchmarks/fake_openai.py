@@ -0,0 +1,134 @@
+"""
+Offline OpenAI-compatible chat completions endpoint for the books-chat agent.
+
+When the request offers tools and the conversation has no tool result yet, the model "decides" to call
+the search tool with the user's words; otherwise it answers. Answers are streamed or returned whole,
+with a tunable per-token latency.
+
+    python benchmarks/fake_openai.py --port 9300 --token-latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+ANSWER_WORDS = (
+    "Using the search tool, I found a few books you might enjoy. 1. **Gilead** by Marilynne Robinson is a "
+    "quiet, luminous novel about faith and family. 2. **Spider's Web** by Charles Osborne is a brisk "
+    "mystery adapted from Agatha Christie. Additional Notes: both are widely available in paperback."
+).split(" ")
+
+
+class FakeOpenAI:
+    def __init__(self, token_latency, response_tokens, tool_latency):
+        self.token_latency = token_latency
+        self.response_tokens = response_tokens
+        self.tool_latency = tool_latency
+        self.requests = 0
+
+    def answer_tokens(self):
+        words = [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(self.response_tokens)]
+        return [word + " " for word in words]
+
+    @staticmethod
+    def tool_call(messages):
+        """Search the books index for the last user message"""
+        question = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "") or ""
+        if isinstance(question, list):
+            question = " ".join(part.get("text", "") for part in question if isinstance(part, dict))
+        arguments = {"index": "books", "queryBody": {"query": {"match": {"description": question[-200:]}}, "size": 5}}
+        return {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": "search", "arguments": json.dumps(arguments)}
+        }
+
+    @staticmethod
+    def wants_tool(body):
+        if not body.get("tools"):
+            return False
+        # one tool round per question: after the latest user message, any tool result means answer now
+        for message in reversed(body.get("messages", [])):
+            if message.get("role") == "tool":
+                return False
+            if message.get("role") == "user":
+                return True
+        return True
+
+    @staticmethod
+    def envelope(body, obj, **fields):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": obj,
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            **fields
+        }
+
+    async def handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        tool_call = self.tool_call(body.get("messages", [])) if self.wants_tool(body) else None
+        tokens = [] if tool_call else self.answer_tokens()
+        usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", [])),
+                 "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.tool_latency if tool_call else self.token_latency * len(tokens))
+            message = {"role": "assistant", "content": None if tool_call else "".join(tokens).strip()}
+            if tool_call:
+                message["tool_calls"] = [tool_call]
+            choice = {"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}
+            return web.json_response(self.envelope(body, "chat.completion", choices=[choice], usage=usage))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta, finish_reason=None):
+            chunk = self.envelope(body, "chat.completion.chunk",
+                                  choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await send({"role": "assistant", "content": ""})
+        if tool_call:
+            await asyncio.sleep(self.tool_latency)
+            await send({"tool_calls": [{"index": 0, **tool_call}]})
+            await send({}, "tool_calls")
+        else:
+            for token in tokens:
+                await asyncio.sleep(self.token_latency)
+                await send({"content": token})
+            await send({}, "stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_stats(self, request):
+        return web.json_response({"requests": self.requests})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9300)
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds per generated token")
+    parser.add_argument("--response-tokens", type=int, default=60, help="tokens per answer")
+    parser.add_argument("--tool-latency", type=float, default=0.3, help="seconds to decide on a tool call")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.token_latency, args.response_tokens, args.tool_latency)
+    app = web.Application()
+    # build_llm strips /v1/chat/completions from PROXY_URL, accept both forms
+    app.router.add_post("/chat/completions", fake.handle)
+    app.router.add_post("/v1/chat/completions", fake.handle)
+    app.router.add_get("/_fake/stats", fake.handle_stats)
+    print(f"fake-openai: listening on {args.host}:{args.port}", flush=True)
+    web.run_app(app, host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
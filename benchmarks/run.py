@@ -0,0 +1,568 @@
+"""
+Load test the chat app (/ws) or books-chat (/api/books-chat) fully offline.
+
+Each run starts local stand-ins (fake_es.py, fake_openai.py, stub_mcp_server.py), starts the app under
+uvicorn pointed at them, drives it with N concurrent sessions, and reports p50/p95/p99 per stage, RPS
+and server memory. Client-side stages are timed from the frames the client receives; server-side stages
+come from the app's /metrics histograms.
+
+    python benchmarks/run.py chat --concurrency 8 --requests 200 --save-baseline main
+    python benchmarks/run.py chat --concurrency 8 --requests 200 --compare main
+    python benchmarks/run.py books --books-python /path/to/books-venv/bin/python --stream
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import httpx
+import psutil
+import websockets
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+CHAT_APP_DIR = os.path.join(ROOT, "vectordb-genai-101", "chat-app-code")
+BOOKS_APP_DIR = os.path.join(ROOT, "track-notebooks", "mcp-introduction")
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+# Server-side histograms reported per app, labelled by the given label
+SERVER_HISTOGRAMS = {
+    "chat": [("chat_stage_seconds", "stage")],
+    "books": [
+        ("books_chat_agent_run_seconds", "endpoint"),
+        ("books_chat_time_to_first_token_seconds", None),
+        ("mcp_tool_call_seconds", "tool"),
+        ("mcp_session_startup_seconds", None),
+    ],
+}
+
+
+# --- statistics ---
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(seconds):
+    if not seconds:
+        return None
+    return {
+        "count": len(seconds),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 2),
+        "p95_ms": round(percentile(seconds, 95) * 1000, 2),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 2),
+        "mean_ms": round(sum(seconds) / len(seconds) * 1000, 2),
+    }
+
+
+def parse_histograms(text, metric, label):
+    """Cumulative bucket counts of a Prometheus histogram: {label value: {le: count}}"""
+    pattern = re.compile(rf"^{metric}_bucket\{{(.*)\}} (\S+)$")
+    buckets = defaultdict(dict)
+    for line in text.splitlines():
+        match = pattern.match(line)
+        if not match:
+            continue
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(1)))
+        le = float("inf") if labels["le"] == "+Inf" else float(labels["le"])
+        buckets[labels.get(label, "all") if label else "all"][le] = float(match.group(2))
+    return buckets
+
+
+def histogram_summary(before, after):
+    """p50/p95/p99 estimated from the bucket counts observed between two scrapes"""
+    summary = {}
+    for key, counts in after.items():
+        previous = before.get(key, {})
+        bounds = sorted(counts)
+        cumulative = [counts[le] - previous.get(le, 0.0) for le in bounds]
+        total = cumulative[-1] if cumulative else 0
+        if total <= 0:
+            continue
+        result = {"count": int(total)}
+        for pct in (50, 95, 99):
+            target = total * pct / 100
+            for i, le in enumerate(bounds):
+                if cumulative[i] >= target:
+                    lower = bounds[i - 1] if i else 0.0
+                    below = cumulative[i - 1] if i else 0.0
+                    if le == float("inf"):
+                        value = lower
+                    else:
+                        in_bucket = cumulative[i] - below
+                        value = lower + (le - lower) * ((target - below) / in_bucket if in_bucket else 1)
+                    result[f"p{pct}_ms"] = round(value * 1000, 2)
+                    break
+        summary[key] = result
+    return summary
+
+
+# --- processes ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Processes:
+    """Child processes of one run, stopped together"""
+
+    def __init__(self, verbose):
+        self.children = []
+        self.verbose = verbose
+
+    def start(self, name, command, cwd, env=None, ready_url=None, timeout=120):
+        output = None if self.verbose else subprocess.DEVNULL
+        process = subprocess.Popen(
+            command, cwd=cwd, env={**os.environ, **(env or {})}, stdout=output, stderr=output
+        )
+        self.children.append(process)
+        deadline = time.monotonic() + timeout
+        while ready_url:
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} exited with code {process.returncode}, rerun with --verbose")
+            try:
+                httpx.get(ready_url, timeout=1).raise_for_status()
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{name} did not become ready within {timeout}s")
+                time.sleep(0.2)
+        return process
+
+    def stop(self):
+        for process in reversed(self.children):
+            if process.poll() is None:
+                process.terminate()
+        for process in self.children:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class MemorySampler(threading.Thread):
+    """Peak and final RSS of a process and its children (the MCP server subprocesses for books-chat)"""
+
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+        self.running = True
+
+    def rss(self):
+        total = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def run(self):
+        while self.running:
+            try:
+                self.last = self.rss()
+            except psutil.NoSuchProcess:
+                return
+            self.peak = max(self.peak, self.last)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        return {"peak_mb": round(self.peak / 2 ** 20, 1), "end_mb": round(self.last / 2 ** 20, 1)}
+
+
+# --- workloads ---
+
+def parse_mix(value):
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return list(weights), list(weights.values())
+
+
+async def chat_session(url, turns, queries, mix, rng, timeout):
+    """One websocket session sending turns sequentially, so the history grows like a real conversation"""
+    records = []
+    async with websockets.connect(url, max_size=None) as ws:
+        await asyncio.wait_for(ws.recv(), timeout)  # session frame
+        for _ in range(turns):
+            context_type = rng.choices(mix[0], mix[1])[0]
+            record = {"ok": False}
+            start = time.perf_counter()
+            await ws.send(json.dumps({"message": rng.choice(queries), "context_type": context_type}))
+            context_at = first_token_at = done_at = None
+            try:
+                while True:
+                    frame = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+                    now = time.perf_counter()
+                    kind = frame.get("type")
+                    if kind in ("verbose_info", "context") and context_at is None:
+                        context_at = now
+                    elif kind == "partial_response" and first_token_at is None:
+                        first_token_at = now
+                    elif kind == "busy":
+                        record["error"] = "busy"
+                        break
+                    elif kind == "full_response":
+                        done_at = now
+                        first_token_at = first_token_at or now
+                    elif kind in ("verbose_info", "history") and done_at is not None:
+                        # the history frame closes the turn
+                        record.update({
+                            "ok": True,
+                            "retrieval_and_prompt": context_at - start,
+                            "time_to_first_token": first_token_at - start,
+                            "completion": done_at - context_at,
+                            "history": now - done_at,
+                            "turn": now - start,
+                        })
+                        break
+            except (asyncio.TimeoutError, websockets.ConnectionClosed) as e:
+                record["error"] = type(e).__name__
+                records.append(record)
+                return records
+            records.append(record)
+    return records
+
+
+async def books_session(base_url, turns, queries, rng, stream, timeout):
+    records = []
+    session_id = None
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        for _ in range(turns):
+            records.append(await books_turn(client, queries, rng, stream, timeout, session_id))
+            session_id = records[-1].pop("session_id", session_id)
+    return records
+
+
+async def books_turn(client, queries, rng, stream, timeout, session_id):
+    body = {"query": rng.choice(queries), "session_id": session_id}
+    record = {"ok": False}
+    start = time.perf_counter()
+    try:
+        if not stream:
+            response = await client.post("/api/books-chat", json=body, timeout=timeout)
+            if response.status_code == 200:
+                session_id = response.json().get("session_id")
+                record.update({"ok": True, "turn": time.perf_counter() - start})
+            else:
+                record["error"] = f"HTTP {response.status_code}"
+        else:
+            event = None
+            async with client.stream("POST", "/api/books-chat/stream", json=body, timeout=timeout) as response:
+                if response.status_code != 200:
+                    record["error"] = f"HTTP {response.status_code}"
+                async for line in response.aiter_lines():
+                    now = time.perf_counter()
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[len("data: "):])
+                        if event == "start":
+                            session_id = data.get("session_id", session_id)
+                        elif event == "tool_end" and data.get("duration_ms") is not None:
+                            record.setdefault("tool_calls", []).append(data["duration_ms"] / 1000)
+                        elif event == "token" and "time_to_first_token" not in record:
+                            record["time_to_first_token"] = now - start
+                        elif event == "final":
+                            record.update({"ok": True, "turn": now - start})
+                        elif event == "error":
+                            record["error"] = data.get("detail")
+    except httpx.HTTPError as e:
+        record["error"] = type(e).__name__
+    if session_id:
+        record["session_id"] = session_id
+    return record
+
+
+async def run_load(sessions, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(factory):
+        async with semaphore:
+            return await factory()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(bounded(factory) for factory in sessions))
+    elapsed = time.perf_counter() - started
+    return [record for records in results for record in records], elapsed
+
+
+def session_factories(total, per_session, make):
+    factories = []
+    remaining = total
+    index = 0
+    while remaining > 0:
+        turns = min(per_session, remaining)
+        factories.append(make(index, turns))
+        remaining -= turns
+        index += 1
+    return factories
+
+
+# --- app runners ---
+
+def start_standins(args, processes, with_es, with_openai):
+    urls = {}
+    if with_es:
+        port = free_port()
+        processes.start("fake-es", [
+            sys.executable, os.path.join(BENCH_DIR, "fake_es.py"), "--port", str(port),
+            "--token-latency", str(args.token_latency), "--response-tokens", str(args.response_tokens)
+        ], BENCH_DIR, ready_url=f"http://127.0.0.1:{port}/")
+        urls["es"] = f"http://127.0.0.1:{port}"
+    if with_openai:
+        port = free_port()
+        processes.start("fake-openai", [
+            sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"), "--port", str(port),
+            "--token-latency", str(args.token_latency), "--response-tokens", str(args.response_tokens),
+            "--tool-latency", str(args.tool_latency)
+        ], BENCH_DIR, ready_url=f"http://127.0.0.1:{port}/_fake/stats")
+        urls["openai"] = f"http://127.0.0.1:{port}"
+    return urls
+
+
+def extra_env(pairs):
+    return dict(pair.split("=", 1) for pair in pairs or [])
+
+
+def start_app(args, processes, name, cwd, module, env, ready_path="/"):
+    port = free_port()
+    process = processes.start(name, [
+        args.python, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"
+    ], cwd, env={**env, **extra_env(args.env)}, ready_url=f"http://127.0.0.1:{port}{ready_path}",
+        timeout=args.startup_timeout)
+    return process, f"127.0.0.1:{port}"
+
+
+def run_chat(args, processes):
+    urls = start_standins(args, processes, with_es=True, with_openai=False)
+    process, host = start_app(args, processes, "chat-app", CHAT_APP_DIR, "backend.main:app", {
+        "ES_URL": urls["es"],
+        "STREAMING_LLM": "true" if args.streaming else "false",
+        # the response cache would turn repeated benchmark queries into cache hits
+        "RESPONSE_CACHE_BACKEND": "none",
+        "SESSION_STORE_BACKEND": "memory",
+        "LOG_LEVEL": "WARNING",
+    }, ready_path="/readyz")
+    queries = read_queries(args.queries or os.path.join(BENCH_DIR, "queries", "restaurants.txt"))
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+
+    def make(index, turns):
+        url = f"ws://{host}/ws?session_id=bench-{args.seed}-{index}"
+        return lambda: chat_session(url, turns, queries, mix, rng, args.timeout)
+
+    return measure(args, process, host, "chat", make)
+
+
+def run_books(args, processes):
+    urls = start_standins(args, processes, with_es=False, with_openai=True)
+    config = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({"mcpServers": {"elasticsearch-mcp-server": {
+        "command": args.books_python or args.python,
+        "args": [os.path.join(BENCH_DIR, "stub_mcp_server.py")],
+        "env": {"STUB_MCP_LATENCY": str(args.mcp_latency)}
+    }}}, config)
+    config.close()
+    args.python = args.books_python or args.python
+    process, host = start_app(args, processes, "books-chat", BOOKS_APP_DIR, "backend.server:app", {
+        "PROXY_URL": urls["openai"],
+        "PROXY_API_KEY": "benchmark",
+        "MCP_CONFIG_PATH": config.name,
+        "MCP_POOL_SIZE": str(args.pool_size),
+    })
+    queries = read_queries(args.queries or os.path.join(BENCH_DIR, "queries", "books.txt"))
+    rng = random.Random(args.seed)
+
+    def make(index, turns):
+        return lambda: books_session(f"http://{host}", turns, queries, rng, args.stream, args.timeout)
+
+    try:
+        return measure(args, process, host, "books", make)
+    finally:
+        os.unlink(config.name)
+
+
+def read_queries(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def scrape(host):
+    return httpx.get(f"http://{host}/metrics", timeout=10).text
+
+
+def measure(args, process, host, app, make):
+    if args.warmup:
+        asyncio.run(run_load(session_factories(args.warmup, args.turns_per_session, make), args.concurrency))
+
+    before = scrape(host)
+    sampler = MemorySampler(process.pid)
+    sampler.start()
+    records, elapsed = asyncio.run(
+        run_load(session_factories(args.requests, args.turns_per_session, make), args.concurrency)
+    )
+    memory = sampler.stop()
+    after = scrape(host)
+
+    ok = [r for r in records if r["ok"]]
+    stages = defaultdict(list)
+    for record in ok:
+        for key, value in record.items():
+            if key == "tool_calls":
+                stages["tool_call"].extend(value)
+            elif isinstance(value, float):
+                stages[key].append(value)
+
+    server = {}
+    for metric, label in SERVER_HISTOGRAMS[app]:
+        summary = histogram_summary(parse_histograms(before, metric, label), parse_histograms(after, metric, label))
+        for key, value in summary.items():
+            server[metric if key == "all" else f"{metric}{{{key}}}"] = value
+
+    errors = defaultdict(int)
+    for record in records:
+        if not record["ok"]:
+            errors[record.get("error", "unknown")] += 1
+
+    return {
+        "app": app,
+        "settings": {k: v for k, v in vars(args).items() if k not in ("func", "compare", "save_baseline", "output")},
+        "requests": len(records),
+        "errors": dict(errors),
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(len(ok) / elapsed, 2) if elapsed else 0,
+        "memory": memory,
+        "client_stages": {stage: summarize(values) for stage, values in stages.items()},
+        "server_stages": server,
+    }
+
+
+# --- reporting ---
+
+def print_report(result):
+    print(f"\n{result['app']}: {result['requests']} requests in {result['elapsed_s']}s, "
+          f"{result['rps']} req/s, errors {result['errors'] or 0}")
+    print(f"server memory: peak {result['memory']['peak_mb']} MB, end {result['memory']['end_mb']} MB")
+    for title, stages in (("client stages", result["client_stages"]), ("server stages", result["server_stages"])):
+        print(f"\n{title:<48}{'count':>8}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}")
+        for stage, s in stages.items():
+            if s:
+                print(f"{stage:<48}{s['count']:>8}{s.get('p50_ms', '-'):>11}{s.get('p95_ms', '-'):>11}{s.get('p99_ms', '-'):>11}")
+
+
+def flatten(result):
+    """Comparable numbers of a result, with whether higher is better"""
+    values = {"rps": (result["rps"], True), "memory.peak_mb": (result["memory"]["peak_mb"], False)}
+    for group in ("client_stages", "server_stages"):
+        for stage, s in result[group].items():
+            for pct in ("p50_ms", "p95_ms", "p99_ms"):
+                if s and s.get(pct) is not None:
+                    values[f"{group}.{stage}.{pct}"] = (s[pct], False)
+    return values
+
+
+def compare(result, baseline, tolerance):
+    """Print deltas against a baseline and return the regressions beyond tolerance (p95, rps and memory)"""
+    current, previous = flatten(result), flatten(baseline)
+    regressions = []
+    print(f"\n{'metric':<70}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, (value, higher_is_better) in current.items():
+        if key not in previous or not previous[key][0]:
+            continue
+        before = previous[key][0]
+        change = (value - before) / before
+        worse = -change if higher_is_better else change
+        gated = key == "rps" or key.startswith("memory") or key.endswith("p95_ms")
+        flag = ""
+        if gated and worse > tolerance:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:<70}{before:>12}{value:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="app", required=True)
+    for name, func in (("chat", run_chat), ("books", run_books)):
+        p = sub.add_parser(name)
+        p.set_defaults(func=func)
+        p.add_argument("--concurrency", type=int, default=4, help="sessions running at the same time")
+        p.add_argument("--requests", type=int, default=100, help="measured turns in total")
+        p.add_argument("--warmup", type=int, default=10, help="turns before measuring")
+        p.add_argument("--turns-per-session", type=int, default=5, help="turns sent on one session before a new one")
+        p.add_argument("--queries", help="file with one query per line")
+        p.add_argument("--seed", type=int, default=42)
+        p.add_argument("--timeout", type=float, default=120, help="seconds per turn before it counts as failed")
+        p.add_argument("--token-latency", type=float, default=0.01, help="seconds per generated token")
+        p.add_argument("--response-tokens", type=int, default=60)
+        p.add_argument("--tool-latency", type=float, default=0.1, help="seconds the fake LLM takes to pick a tool")
+        p.add_argument("--python", default=sys.executable, help="interpreter with the app's requirements")
+        p.add_argument("--startup-timeout", type=float, default=120)
+        p.add_argument("--env", action="append", metavar="KEY=VALUE", help="extra environment for the app")
+        p.add_argument("--output", help="write the JSON result here")
+        p.add_argument("--save-baseline", metavar="NAME", help=f"save the result to {BASELINE_DIR}/NAME.json")
+        p.add_argument("--compare", metavar="NAME", help="compare with a saved baseline, exit 1 on regressions")
+        p.add_argument("--tolerance", type=float, default=0.10, help="allowed p95/rps/memory regression")
+        p.add_argument("--verbose", action="store_true", help="show the output of the app and stand-ins")
+        if name == "chat":
+            p.add_argument("--mix", default="semantic=1", help="context_type weights, e.g. semantic=0.6,hybrid=0.4")
+            p.add_argument("--no-streaming", dest="streaming", action="store_false")
+        else:
+            p.add_argument("--stream", action="store_true", help="use /api/books-chat/stream")
+            p.add_argument("--pool-size", type=int, default=2)
+            p.add_argument("--mcp-latency", type=float, default=0.05, help="seconds per stub MCP tool call")
+            p.add_argument("--books-python", help="interpreter with the books-chat requirements, defaults to --python")
+    args = parser.parse_args()
+
+    processes = Processes(args.verbose)
+    try:
+        result = args.func(args, processes)
+    finally:
+        processes.stop()
+
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nbaseline saved to {path}")
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
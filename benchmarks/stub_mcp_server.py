@@ -0,0 +1,82 @@
+"""
+Stub of the Elasticsearch MCP server used by books-chat, served over stdio.
+
+It exposes the same tools as the workshop server and answers from track-notebooks/mcp-introduction/data/data.csv,
+with a configurable latency per call (STUB_MCP_LATENCY, seconds). run.py points MCP_CONFIG_PATH at it.
+"""
+import asyncio
+import csv
+import json
+import os
+import re
+from collections import defaultdict
+
+from mcp.server.fastmcp import FastMCP
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOOKS_CSV = os.getenv("STUB_MCP_BOOKS_CSV", os.path.join(ROOT, "track-notebooks", "mcp-introduction", "data", "data.csv"))
+LATENCY = float(os.getenv("STUB_MCP_LATENCY", "0.05"))
+WORD = re.compile(r"[a-z0-9]+")
+
+mcp = FastMCP("elasticsearch-mcp-server-stub")
+
+books = []
+postings = defaultdict(list)
+with open(BOOKS_CSV, newline="", encoding="utf-8") as f:
+    for row in csv.DictReader(f):
+        book_id = len(books)
+        books.append(row)
+        for token in set(WORD.findall(f"{row['title']} {row['authors']} {row['description']}".lower())):
+            postings[token].append(book_id)
+
+
+def _query_words(query_body):
+    return WORD.findall(json.dumps(query_body).lower())
+
+
+@mcp.tool()
+async def search(index: str, queryBody: dict) -> str:
+    """Perform an Elasticsearch search with the provided query DSL."""
+    await asyncio.sleep(LATENCY)
+    scores = defaultdict(int)
+    for token in set(_query_words(queryBody)):
+        for book_id in postings.get(token, ()):
+            scores[book_id] += 1
+    size = min(int(queryBody.get("size", 5)), 10)
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:size]
+    lines = [f"Total results: {len(scores)}, showing {len(ranked)} from position 0"]
+    for book_id, score in ranked:
+        lines.append(json.dumps({"_id": books[book_id]["isbn13"], "_score": score, **books[book_id]}))
+    return "\n".join(lines)
+
+
+@mcp.tool()
+async def list_indices(indexPattern: str = "*") -> str:
+    """List all available Elasticsearch indices."""
+    await asyncio.sleep(LATENCY)
+    return json.dumps([{"index": "books", "health": "green", "status": "open", "docsCount": str(len(books))}])
+
+
+@mcp.tool()
+async def get_mappings(index: str) -> str:
+    """Get field mappings for a specific Elasticsearch index."""
+    await asyncio.sleep(LATENCY)
+    return json.dumps({index: {"mappings": {"properties": {field: {"type": "text"} for field in books[0]}}}})
+
+
+@mcp.tool()
+async def get_shards(index: str = "") -> str:
+    """Get shard information for all or specific indices."""
+    await asyncio.sleep(LATENCY)
+    return json.dumps([{"index": "books", "shard": "0", "prirep": "p", "state": "STARTED", "docs": str(len(books))}])
+
+
+@mcp.tool()
+async def search_google_books(title: str, author: str = "") -> str:
+    """Look up purchase information for a book."""
+    await asyncio.sleep(LATENCY)
+    return json.dumps({"title": title, "author": author, "saleability": "FOR_SALE", "price": "9.99 USD"})
+
+
+if __name__ == "__main__":
+    mcp.run()
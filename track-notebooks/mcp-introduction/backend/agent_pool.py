@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from langchain_core.language_models import BaseChatModel
+from mcp_use import MCPAgent, MCPClient
+
+from backend.metrics import (
+    AGENT_QUEUE_WAIT_SECONDS, AGENT_REJECTIONS, MCP_SESSION_STARTUP_SECONDS, instrument_connector, timed
+)
+from backend.tool_cache import ToolResultCache
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(Exception):
+    """Raised when a request is not given an agent: the wait queue is full or the wait would exceed the lease timeout."""
+
+    def __init__(self, message: str, reason: str, retry_after: int):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PooledAgent:
+    """One warm MCP client (and its stdio subprocess) with the agent bound to it."""
+
+    def __init__(self, slot_id: int):
+        self.slot_id = slot_id
+        self.client: Optional[MCPClient] = None
+        self.agent: Optional[MCPAgent] = None
+        self.healthy = False
+
+
+class AgentPool:
+    """
+    A fixed number of warm MCPAgent/MCPClient pairs created at startup and leased per request.
+
+    The pool size is the max number of concurrent agent runs. Slots are pinged in the background
+    and before every lease; a slot whose MCP subprocess died is restarted.
+
+    At most max_queue requests wait for a free agent. A request is turned away at once when the queue is full
+    or when its expected wait (average run time times its place in line, over the pool size) is longer than
+    the lease timeout, so under overload the admitted requests keep their latency and the rest fail fast.
+    """
+
+    def __init__(
+        self,
+        config_path: str,
+        llm: BaseChatModel,
+        system_prompt: str,
+        size: int = 2,
+        max_steps: int = 30,
+        health_check_interval: float = 30.0,
+        ping_timeout: float = 5.0,
+        lease_timeout: float = 30.0,
+        max_queue: int = 16,
+        tool_cache: Optional[ToolResultCache] = None,
+    ):
+        self.config_path = config_path
+        self.llm = llm
+        self.system_prompt = system_prompt
+        self.size = size
+        self.max_steps = max_steps
+        self.health_check_interval = health_check_interval
+        self.ping_timeout = ping_timeout
+        self.lease_timeout = lease_timeout
+        self.max_queue = max_queue
+        self.tool_cache = tool_cache
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._slots: list[PooledAgent] = []
+        self._health_task: Optional[asyncio.Task] = None
+        self.restarts = 0
+        self.waiting = 0
+        self.rejected = 0
+        # moving average of how long a lease is held
+        self.run_seconds = 0.0
+
+    async def start(self) -> None:
+        """Start every slot concurrently, then the background health check."""
+        self._slots = [PooledAgent(i) for i in range(self.size)]
+        await asyncio.gather(*(self._start_slot(slot) for slot in self._slots))
+        for slot in self._slots:
+            self._idle.put_nowait(slot)
+        self._health_task = asyncio.create_task(self._health_loop())
+        logger.info(f"MCP agent pool started with {self.size} warm sessions.")
+
+    async def close(self) -> None:
+        if self._health_task:
+            self._health_task.cancel()
+        await asyncio.gather(*(self._stop_slot(slot) for slot in self._slots), return_exceptions=True)
+        logger.info("MCP agent pool closed.")
+
+    async def _start_slot(self, slot: PooledAgent) -> None:
+        with timed(MCP_SESSION_STARTUP_SECONDS, "mcp session startup"):
+            client = MCPClient.from_config_file(self.config_path)
+            # Conversation memory is per request, not per warm agent, so it is turned off here
+            agent = MCPAgent(
+                llm=self.llm,
+                client=client,
+                max_steps=self.max_steps,
+                system_prompt=self.system_prompt,
+                memory_enabled=False,
+            )
+            await agent.initialize()
+        for session in client.get_all_active_sessions().values():
+            # Timing goes innermost so only calls that reach the MCP server are measured
+            instrument_connector(session.connector)
+            if self.tool_cache is not None:
+                self.tool_cache.wrap(session.connector)
+        slot.client, slot.agent, slot.healthy = client, agent, True
+        logger.info(f"MCP pool slot {slot.slot_id} is ready.")
+
+    async def _stop_slot(self, slot: PooledAgent) -> None:
+        slot.healthy = False
+        if slot.client:
+            await slot.client.close_all_sessions()
+        slot.client, slot.agent = None, None
+
+    async def _restart_slot(self, slot: PooledAgent) -> None:
+        logger.warning(f"Restarting MCP pool slot {slot.slot_id}.")
+        self.restarts += 1
+        try:
+            await self._stop_slot(slot)
+        except Exception as e:
+            logger.warning(f"Error stopping MCP pool slot {slot.slot_id}: {e}")
+        await self._start_slot(slot)
+
+    async def _ping(self, slot: PooledAgent) -> bool:
+        if not slot.healthy or slot.client is None:
+            return False
+        try:
+            for session in slot.client.get_all_active_sessions().values():
+                if not session.is_connected:
+                    return False
+                await asyncio.wait_for(session.connector.client.send_ping(), self.ping_timeout)
+            return True
+        except Exception as e:
+            logger.warning(f"MCP pool slot {slot.slot_id} failed its health check: {e}")
+            return False
+
+    async def _ensure_healthy(self, slot: PooledAgent) -> None:
+        if not await self._ping(slot):
+            await self._restart_slot(slot)
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            # Only idle slots are checked, leased ones are checked when they come back
+            for _ in range(self._idle.qsize()):
+                slot = self._idle.get_nowait()
+                try:
+                    await self._ensure_healthy(slot)
+                except Exception as e:
+                    logger.error(f"Could not restart MCP pool slot {slot.slot_id}: {e}")
+                finally:
+                    self._idle.put_nowait(slot)
+
+    def expected_wait(self) -> float:
+        return self.run_seconds * (self.waiting + 1) / self.size
+
+    def _reject(self, reason: str, message: str) -> PoolExhaustedError:
+        self.rejected += 1
+        AGENT_REJECTIONS.labels(reason).inc()
+        return PoolExhaustedError(message, reason, max(1, math.ceil(self.expected_wait())))
+
+    def check_admission(self) -> None:
+        """Raise PoolExhaustedError if a request arriving now would be turned away, without leasing."""
+        if not self._idle.empty():
+            return
+        if self.waiting >= self.max_queue:
+            raise self._reject("queue_full", f"{self.waiting} requests are already waiting for an MCP agent")
+        if self.expected_wait() > self.lease_timeout:
+            raise self._reject(
+                "expected_wait", f"Expected wait of {self.expected_wait():.1f}s exceeds the {self.lease_timeout}s lease timeout"
+            )
+
+    @asynccontextmanager
+    async def lease(self):
+        """Borrow a warm agent for one request."""
+        self.check_admission()
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            slot = await asyncio.wait_for(self._idle.get(), self.lease_timeout)
+        except asyncio.TimeoutError:
+            raise self._reject("lease_timeout", f"No MCP agent became free within {self.lease_timeout}s")
+        finally:
+            self.waiting -= 1
+        AGENT_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+        leased = time.perf_counter()
+        try:
+            await self._ensure_healthy(slot)
+            yield slot.agent
+        except Exception:
+            # The failure may have come from a dead subprocess, check before the next lease
+            slot.healthy = await self._ping(slot)
+            raise
+        finally:
+            held = time.perf_counter() - leased
+            self.run_seconds = held if not self.run_seconds else 0.8 * self.run_seconds + 0.2 * held
+            self._idle.put_nowait(slot)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "healthy": sum(1 for slot in self._slots if slot.healthy),
+            "restarts": self.restarts,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from langchain_core.language_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a reader and a librarian in a few sentences. "
+    "Keep the book titles, authors and preferences the reader mentioned.\n\n"
+    "{previous_summary}{transcript}"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, about four characters per token for English text."""
+    return len(text) // 4 + 1
+
+
+def render_messages(messages: list[dict]) -> str:
+    return "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+
+
+class Conversation:
+    """
+    The messages of one chat session plus a rolling summary of the turns that left the window.
+
+    Only the newest messages that fit the token budget are sent to the agent, so the prompt
+    stops growing once the session is long enough.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.messages: list[dict] = []
+        self.summary = ""
+        self.last_access = time.monotonic()
+        self._summary_task: Optional[asyncio.Task] = None
+
+    def add(self, role: str, content: str) -> None:
+        self.messages.append({"role": role, "content": content})
+
+    def window_start(self, token_budget: int) -> int:
+        """Index of the oldest message that still fits the budget, counting back from the newest."""
+        used = 0
+        start = len(self.messages)
+        while start > 0:
+            used += estimate_tokens(self.messages[start - 1]["content"])
+            if used > token_budget:
+                break
+            start -= 1
+        return start
+
+    def build_prompt(self, query: str, token_budget: int) -> str:
+        start = self.window_start(token_budget)
+        parts = []
+        # Dropped messages are only represented by the summary; until it catches up they are lost
+        if self.summary:
+            parts.append(f"Summary of the earlier conversation: {self.summary}")
+        if start < len(self.messages):
+            parts.append(render_messages(self.messages[start:]))
+        parts.append(query)
+        return "\n".join(parts)
+
+    def cancel(self) -> None:
+        if self._summary_task and not self._summary_task.done():
+            self._summary_task.cancel()
+
+
+class HistoryManager:
+    """
+    Server-side store of books-chat conversations keyed by session id.
+
+    Sessions are kept in memory with LRU and idle-time eviction. When an llm is given, messages that
+    slide out of the token window are folded into a rolling summary in the background.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 1500,
+        max_sessions: int = 1000,
+        session_ttl: float = 3600.0,
+        llm: Optional[BaseChatModel] = None,
+    ):
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.llm = llm
+        self._sessions: OrderedDict[str, Conversation] = OrderedDict()
+        self.evictions = 0
+        self.summaries = 0
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._sessions:
+            session_id, conversation = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - conversation.last_access < self.session_ttl:
+                break
+            conversation.cancel()
+            del self._sessions[session_id]
+            self.evictions += 1
+
+    def get(self, session_id: Optional[str] = None, seed: Optional[list[dict]] = None) -> Conversation:
+        """Return the session's conversation, creating it (optionally from client-sent messages) if unknown."""
+        conversation = self._sessions.get(session_id) if session_id else None
+        if conversation is None:
+            conversation = Conversation(session_id or uuid.uuid4().hex)
+            for message in seed or []:
+                conversation.add(message["role"], message["content"])
+            self._sessions[conversation.session_id] = conversation
+        conversation.last_access = time.monotonic()
+        self._sessions.move_to_end(conversation.session_id)
+        self._evict()
+        return conversation
+
+    def record_turn(self, conversation: Conversation, query: str, response: str) -> None:
+        conversation.add("user", query)
+        conversation.add("assistant", response)
+        if self.llm is not None:
+            self._schedule_summary(conversation)
+        else:
+            # Without summarization nothing outside the window is ever used again
+            start = conversation.window_start(self.token_budget)
+            del conversation.messages[:start]
+
+    def _schedule_summary(self, conversation: Conversation) -> None:
+        if conversation._summary_task and not conversation._summary_task.done():
+            # The running task picks up the new overflow when it reschedules
+            return
+        start = conversation.window_start(self.token_budget)
+        if start == 0:
+            return
+        conversation._summary_task = asyncio.create_task(self._summarize(conversation, start))
+
+    async def _summarize(self, conversation: Conversation, end: int) -> None:
+        previous = f"Earlier summary: {conversation.summary}\n\n" if conversation.summary else ""
+        transcript = render_messages(conversation.messages[:end])
+        try:
+            result = await self.llm.ainvoke(SUMMARY_PROMPT.format(previous_summary=previous, transcript=transcript))
+        except Exception as e:
+            logger.warning(f"Could not summarize session {conversation.session_id}: {e}")
+            return
+        conversation.summary = result.content
+        # The summary now covers these messages, newer ones may have arrived meanwhile
+        del conversation.messages[:end]
+        self.summaries += 1
+        logger.info(f"Folded {end} messages of session {conversation.session_id} into its summary.")
+        conversation._summary_task = None
+        self._schedule_summary(conversation)
+
+    def close(self) -> None:
+        for conversation in self._sessions.values():
+            conversation.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "evictions": self.evictions,
+            "summaries": self.summaries,
+            "token_budget": self.token_budget,
+        }
@@ -0,0 +1,131 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# none or otlp; otlp uses the standard OTEL_EXPORTER_OTLP_* settings
+TRACING_BACKEND = os.getenv("TRACING_BACKEND", "none").lower()
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+MCP_SESSION_STARTUP_SECONDS = Histogram(
+    "mcp_session_startup_seconds",
+    "Time to start an MCP client, its server subprocess and the agent",
+    buckets=LATENCY_BUCKETS,
+)
+MCP_TOOL_CALL_SECONDS = Histogram(
+    "mcp_tool_call_seconds",
+    "Duration of tool calls that reached the MCP server (cache hits are not included)",
+    ["tool"],
+    buckets=LATENCY_BUCKETS,
+)
+MCP_TOOL_CALL_ERRORS = Counter("mcp_tool_call_errors_total", "Tool calls that raised or returned an error", ["tool"])
+AGENT_RUN_SECONDS = Histogram(
+    "books_chat_agent_run_seconds",
+    "Duration of a books-chat agent run, including the wait for a pooled agent",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+AGENT_QUEUE_WAIT_SECONDS = Histogram(
+    "books_chat_agent_queue_wait_seconds",
+    "Time requests waited for a free pooled agent",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+AGENT_REJECTIONS = Counter("books_chat_agent_rejections_total", "Requests turned away by the agent pool", ["reason"])
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "books_chat_time_to_first_token_seconds",
+    "Time from request to the first answer token on the streaming endpoint",
+    buckets=LATENCY_BUCKETS,
+)
+
+_tracer = None
+
+
+class PoolCollector:
+    """Exposes the agent pool, tool cache and history counters, read at scrape time."""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    def collect(self):
+        state = self.app.state
+        if getattr(state, "agent_pool", None) is not None:
+            for name, value in state.agent_pool.stats().items():
+                yield GaugeMetricFamily(f"mcp_agent_pool_{name}", f"Agent pool {name}", value=value)
+        if getattr(state, "tool_cache", None) is not None:
+            stats = state.tool_cache.stats()
+            lookups = GaugeMetricFamily("mcp_tool_cache_lookups", "Tool cache lookups", labels=["tool", "result"])
+            for tool, counts in stats["per_tool"].items():
+                lookups.add_metric([tool, "hit"], counts["hits"])
+                lookups.add_metric([tool, "miss"], counts["misses"])
+            yield lookups
+            yield GaugeMetricFamily("mcp_tool_cache_hit_rate", "Tool cache hit rate", value=stats["hit_rate"])
+            yield GaugeMetricFamily("mcp_tool_cache_entries", "Tool cache entries", value=stats["entries"])
+        if getattr(state, "history", None) is not None:
+            yield GaugeMetricFamily("books_chat_sessions", "Conversations held in memory", value=state.history.stats()["sessions"])
+
+
+def init_metrics(app: Any) -> None:
+    """Register the scrape-time collector and the optional OTLP exporter. Called once at import of the server."""
+    global _tracer
+    REGISTRY.register(PoolCollector(app))
+    if TRACING_BACKEND != "otlp":
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logger.error("TRACING_BACKEND=otlp needs opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http")
+        return
+    provider = TracerProvider()
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("books-chat")
+    logger.info("Tracing to OTLP")
+
+
+@contextmanager
+def timed(histogram: Histogram, span_name: str, **labels: str):
+    """Observe the block's duration in histogram, and export a span when tracing is on."""
+    start = time.perf_counter()
+    try:
+        if _tracer is not None:
+            with _tracer.start_as_current_span(span_name, attributes=labels):
+                yield
+        else:
+            yield
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - start)
+
+
+def instrument_connector(connector: Any) -> None:
+    """Time every tool call a connector sends to its MCP server."""
+    if getattr(connector, "_metrics_wrapped", False):
+        return
+    call_tool = connector.call_tool
+
+    async def timed_call_tool(name: str, arguments: dict):
+        with timed(MCP_TOOL_CALL_SECONDS, f"tool {name}", tool=name):
+            try:
+                result = await call_tool(name, arguments)
+            except Exception:
+                MCP_TOOL_CALL_ERRORS.labels(name).inc()
+                raise
+        if getattr(result, "isError", False):
+            MCP_TOOL_CALL_ERRORS.labels(name).inc()
+        return result
+
+    connector.call_tool = timed_call_tool
+    connector._metrics_wrapped = True
+
+
+def metrics_payload() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
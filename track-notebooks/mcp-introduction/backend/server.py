@@ -4,15 +4,23 @@ import logging
 import sys
 import os
 import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from mcp_use import MCPAgent, MCPClient
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from langchain_core.callbacks import BaseCallbackHandler
 from typing import AsyncIterable, Optional, List, Any, Dict
 
+from backend.agent_pool import AgentPool, PoolExhaustedError
+from backend.history import Conversation, HistoryManager
+from backend.metrics import AGENT_RUN_SECONDS, TIME_TO_FIRST_TOKEN_SECONDS, init_metrics, metrics_payload, timed
+from backend.tool_cache import ToolResultCache, parse_tool_ttls
+
 # --- Logging Configuration ---
 logging.basicConfig(
     level=logging.INFO,
@@ -26,22 +34,84 @@ logger = logging.getLogger(__name__)
 
 
 class ToolCallbackHandler(BaseCallbackHandler):
-    """A custom callback handler to record which tools are used."""
+    """A custom callback handler to record which tools are used and how long each call takes."""
     def __init__(self):
         super().__init__()
         self.used_tools = []
+        self.tool_timings = []
+        self._started: Dict[Any, tuple] = {}
 
-    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: Any = None, **kwargs: Any) -> None:
         """Called when the agent is about to start using a tool."""
         tool_name = serialized.get("name")
         logger.info(f"Agent is using tool: {tool_name}")
         self.used_tools.append(tool_name)
+        self._started[run_id] = (tool_name, time.perf_counter())
+
+    def on_tool_end(self, output: Any, *, run_id: Any = None, **kwargs: Any) -> Optional[float]:
+        """Called when a tool returns. Returns the call duration in milliseconds."""
+        tool_name, started = self._started.pop(run_id, (None, None))
+        if started is None:
+            return None
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(f"Tool {tool_name} finished in {duration_ms} ms")
+        self.tool_timings.append({"tool": tool_name, "duration_ms": duration_ms})
+        return duration_ms
 
 
 load_dotenv()
 logger.info("Dotenv loaded successfully.")
 
-app = FastAPI()
+MCP_CONFIG_PATH = os.getenv("MCP_CONFIG_PATH", "backend/elasticsearch_mcp.json")
+# Number of warm MCP sessions, which is also the max number of concurrent agent runs
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "2"))
+MCP_HEALTH_CHECK_INTERVAL = float(os.getenv("MCP_HEALTH_CHECK_INTERVAL", "30"))
+# How long a request waits for a free agent before getting a 429, and how many may wait at once
+MCP_LEASE_TIMEOUT = float(os.getenv("MCP_LEASE_TIMEOUT", "30"))
+MCP_POOL_MAX_QUEUE = int(os.getenv("MCP_POOL_MAX_QUEUE", "16"))
+# Per-tool result TTLs as "tool=seconds,...", and the max number of cached results
+MCP_TOOL_CACHE_TTLS = os.getenv("MCP_TOOL_CACHE_TTLS")
+MCP_TOOL_CACHE_MAX_ENTRIES = int(os.getenv("MCP_TOOL_CACHE_MAX_ENTRIES", "1000"))
+# Tokens of past messages sent with each query; older turns are summarized when HISTORY_SUMMARIZE is on
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARIZE = os.getenv("HISTORY_SUMMARIZE", "true").lower() == "true"
+# Idle sessions are dropped after SESSION_TTL seconds, or sooner once MAX_SESSIONS is reached
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.llm = build_llm()
+    app.state.history = HistoryManager(
+        token_budget=HISTORY_TOKEN_BUDGET,
+        max_sessions=MAX_SESSIONS,
+        session_ttl=SESSION_TTL,
+        llm=app.state.llm if HISTORY_SUMMARIZE else None,
+    )
+    app.state.tool_cache = ToolResultCache(
+        ttls=parse_tool_ttls(MCP_TOOL_CACHE_TTLS),
+        max_entries=MCP_TOOL_CACHE_MAX_ENTRIES,
+    )
+    app.state.agent_pool = AgentPool(
+        config_path=MCP_CONFIG_PATH,
+        llm=app.state.llm,
+        system_prompt=SYSTEM_PROMPT,
+        size=MCP_POOL_SIZE,
+        max_steps=30,
+        health_check_interval=MCP_HEALTH_CHECK_INTERVAL,
+        lease_timeout=MCP_LEASE_TIMEOUT,
+        max_queue=MCP_POOL_MAX_QUEUE,
+        tool_cache=app.state.tool_cache,
+    )
+    await app.state.agent_pool.start()
+    yield
+    await app.state.agent_pool.close()
+    app.state.history.close()
+
+
+app = FastAPI(lifespan=lifespan)
+init_metrics(app)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -51,13 +121,51 @@ app.add_middleware(
 )
 logger.info("CORS middleware configured.")
 
+class HistoryMessage(BaseModel):
+    role: str
+    content: str
+
+
 class ChatRequest(BaseModel):
     query: str
-    history: list[str] = []
+    # Returned by the first response, the server keeps the conversation from then on
+    session_id: Optional[str] = None
+    # Only used to seed a session the server does not know, e.g. after a restart
+    history: list[HistoryMessage] = Field(default_factory=list)
+
 
-async def run_agent_with_query(query: str, history: list[str] = []) -> str:
+def get_conversation(req: ChatRequest) -> Conversation:
+    return app.state.history.get(req.session_id, [message.model_dump() for message in req.history])
 
-    mcp_client = MCPClient.from_config_file("backend/elasticsearch_mcp.json")
+
+SYSTEM_PROMPT = (
+    "You are a helpful and knowledgeable librarian, equipped with tools to assist users with their book inquiries. " +
+    "You have access to the Elastic MCP server with the 'books' index, and the Google Books API for purchase information. " +
+    "Your available tools are:\n" +
+    "- **search**: Use this tool to find general information about books within the 'books' Elasticsearch index. When using this tool, you MUST provide both `index` (which should be 'books') and a valid Elasticsearch `queryBody` (e.g., using a `match` query, `bool` query, etc.). Remove any case formatting in the query body. Never return more than 5 results at any one time and always present the results in a human readable way. You can bold the title. \n" +
+    "- **search_google_books**: Use this tool when a user explicitly asks about purchasing a book, where to buy it, its price, or general sales availability. Provide the `title` of the book, and optionally the `author` if known.\n" +
+    "- **list_indices**, **get_mappings**, **get_shards**: (Not usually needed—only if the user explicitly requests low-level Elasticsearch details.)\n\n" +
+    "**Important formatting rule:**"
+    "1. Render each book as its own numbered card or entry."
+    "2. **Any text that isn’t part of a specific book entry**—for example, a final wrap-up, recommendation, or “next steps” paragraph—**must begin with the header**:"
+    "Additional Notes:"
+    "and then that text.  Do not include that under any numbered item or card."
+    "After using a tool, begin your answer with “Using the [tool_name] tool, …” etc."
+    "After retrieving information using any tool, explain the results clearly and engagingly, like a human librarian would:\n" +
+    "- Compare or contrast books clearly, if multiple are found.\n" +
+    "- Highlight themes, readability, or significance of the books.\n" +
+    "- Format your responses so they're easy to read and inviting.\n" +
+    "- Avoid just listing raw fields; interpret the data for the user.\n" +
+    "- It's okay to express a gentle opinion or help guide the user to their next read.\n" +
+    "- Speak naturally, like you're helping a curious reader at the reference desk.\n\n" +
+    "If multiple books are found by any tool, summarize each one clearly in plain English.\n\n" +
+    "After using a tool, you MUST begin your final answer with **'Using the [tool_name] tool, '** where [tool_name] is exactly the tool you invoked (for example, 'Using the search tool, I found…'). " +
+    "If you did not use a tool, just answer directly."
+)
+
+
+def build_llm() -> ChatOpenAI:
+    """Build the chat model once from the proxy settings in the environment."""
     raw_proxy_url = os.getenv("PROXY_URL") or os.getenv("LLM_PROXY_URL")
     llm_api_key = os.getenv("PROXY_API_KEY") or os.getenv("LLM_APIKEY")
     unneeded_path = "/v1/chat/completions"
@@ -66,69 +174,154 @@ async def run_agent_with_query(query: str, history: list[str] = []) -> str:
         llm_base_url = llm_base_url.removesuffix(unneeded_path)
         logger.info(f"PROXY_URL was trimmed to: {llm_base_url}")
 
-    if not llm_base_url.startswith("https://"):
+    if "://" not in llm_base_url:
         llm_base_url = "https://" + llm_base_url
         logger.info(f"Prepended 'https://' to PROXY_URL: {llm_base_url}")
 
     logger.info(f"llm_base_url: {llm_base_url}")
 
-
-    llm = ChatOpenAI(
+    return ChatOpenAI(
         model="gpt-4o",
         base_url=llm_base_url,
         openai_api_key=llm_api_key
     )
 
 
-    system_prompt = (
-        "You are a helpful and knowledgeable librarian, equipped with tools to assist users with their book inquiries. " +
-        "You have access to the Elastic MCP server with the 'books' index, and the Google Books API for purchase information. " +
-        "Your available tools are:\n" +
-        "- **search**: Use this tool to find general information about books within the 'books' Elasticsearch index. When using this tool, you MUST provide both `index` (which should be 'books') and a valid Elasticsearch `queryBody` (e.g., using a `match` query, `bool` query, etc.). Remove any case formatting in the query body. Never return more than 5 results at any one time and always present the results in a human readable way. You can bold the title. \n" +
-        "- **search_google_books**: Use this tool when a user explicitly asks about purchasing a book, where to buy it, its price, or general sales availability. Provide the `title` of the book, and optionally the `author` if known.\n" +
-        "- **list_indices**, **get_mappings**, **get_shards**: (Not usually needed—only if the user explicitly requests low-level Elasticsearch details.)\n\n" +
-        "**Important formatting rule:**"
-        "1. Render each book as its own numbered card or entry."
-        "2. **Any text that isn’t part of a specific book entry**—for example, a final wrap-up, recommendation, or “next steps” paragraph—**must begin with the header**:"
-        "Additional Notes:"
-        "and then that text.  Do not include that under any numbered item or card."
-        "After using a tool, begin your answer with “Using the [tool_name] tool, …” etc."
-        "After retrieving information using any tool, explain the results clearly and engagingly, like a human librarian would:\n" +
-        "- Compare or contrast books clearly, if multiple are found.\n" +
-        "- Highlight themes, readability, or significance of the books.\n" +
-        "- Format your responses so they're easy to read and inviting.\n" +
-        "- Avoid just listing raw fields; interpret the data for the user.\n" +
-        "- It's okay to express a gentle opinion or help guide the user to their next read.\n" +
-        "- Speak naturally, like you're helping a curious reader at the reference desk.\n\n" +
-        "If multiple books are found by any tool, summarize each one clearly in plain English.\n\n" +
-        "After using a tool, you MUST begin your final answer with **'Using the [tool_name] tool, '** where [tool_name] is exactly the tool you invoked (for example, 'Using the search tool, I found…'). " +
-        "If you did not use a tool, just answer directly."
-        )
-
-    agent = MCPAgent(llm=llm, client=mcp_client, max_steps=30, system_prompt=system_prompt)
-
-    full_prompt = "\n".join(history + [query])
-
-    try:
-        return await agent.run(full_prompt)
-    finally:
-        await mcp_client.close_all_sessions()
+async def run_agent_with_query(query: str, conversation: Conversation) -> str:
+    full_prompt = conversation.build_prompt(query, app.state.history.token_budget)
 
+    with timed(AGENT_RUN_SECONDS, "agent run", endpoint="books-chat"):
+        async with app.state.agent_pool.lease() as agent:
+            response = await agent.run(full_prompt, manage_connector=False)
+    app.state.history.record_turn(conversation, query, response)
+    return response
 
 
 @app.post("/api/books-chat")
 async def books_chat_endpoint(req: ChatRequest, http_request: Request):
     # logger.info(f"INCOMING HEADERS: {dict(http_request.headers)}")
     try:
-        response = await run_agent_with_query(req.query, req.history)
-        return {"response": response}
+        conversation = get_conversation(req)
+        response = await run_agent_with_query(req.query, conversation)
+        return {"response": response, "session_id": conversation.session_id}
+    except PoolExhaustedError as e:
+        logger.warning(str(e))
+        raise busy_response(e)
     except Exception as e:
         logger.exception(e)
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
 
+def busy_response(error: PoolExhaustedError) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="All agents are busy, please retry shortly.",
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+def sse_event(event_type: str, data: Dict[str, Any]) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_agent_events(query: str, conversation: Conversation) -> AsyncIterable[str]:
+    """
+    Run the agent and yield server-sent events as it works: tool starts and ends with durations,
+    intermediate thoughts, answer tokens and the final response.
+    """
+    full_prompt = conversation.build_prompt(query, app.state.history.token_budget)
+    handler = ToolCallbackHandler()
+    # text streamed by the current LLM call, it is a thought if the call ends in tool calls
+    step_text: list[str] = []
+    started = time.perf_counter()
+    first_token = True
+
+    try:
+        async with app.state.agent_pool.lease() as agent:
+            yield sse_event("start", {"session_id": conversation.session_id})
+            # MCPAgent.astream does not take callbacks, so the handler is fed from the event stream
+            async for event in agent.astream(full_prompt, manage_connector=False):
+                kind = event.get("event")
+                data = event.get("data", {})
+
+                if kind == "on_chat_model_stream":
+                    token = data["chunk"].content
+                    if token:
+                        if first_token:
+                            TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                            first_token = False
+                        step_text.append(token)
+                        yield sse_event("token", {"text": token})
+
+                elif kind == "on_chat_model_end":
+                    output = data.get("output")
+                    if getattr(output, "tool_calls", None) and step_text:
+                        yield sse_event("thought", {"text": "".join(step_text)})
+                    step_text = []
+
+                elif kind == "on_tool_start":
+                    handler.on_tool_start({"name": event["name"]}, str(data.get("input")), run_id=event["run_id"])
+                    yield sse_event("tool_start", {"tool": event["name"], "input": data.get("input")})
+
+                elif kind == "on_tool_end":
+                    duration_ms = handler.on_tool_end(data.get("output"), run_id=event["run_id"])
+                    yield sse_event("tool_end", {"tool": event["name"], "duration_ms": duration_ms})
+
+                elif kind == "on_chain_end" and event.get("name") == "AgentExecutor":
+                    output = data.get("output") or {}
+                    response = output.get("output", "")
+                    app.state.history.record_turn(conversation, query, response)
+                    yield sse_event("final", {
+                        "response": response,
+                        "tools": handler.used_tools,
+                        "tool_timings": handler.tool_timings,
+                    })
+    except PoolExhaustedError as e:
+        logger.warning(str(e))
+        yield sse_event("error", {"detail": "All agents are busy, please retry shortly.", "retry_after": e.retry_after})
+    except Exception as e:
+        logger.exception(e)
+        yield sse_event("error", {"detail": "An internal server error occurred."})
+    finally:
+        AGENT_RUN_SECONDS.labels(endpoint="stream").observe(time.perf_counter() - started)
+
+
+@app.post("/api/books-chat/stream")
+async def books_chat_stream_endpoint(req: ChatRequest):
+    # Shed before the 200 is sent, so overloaded clients get a 429 rather than an error event
+    try:
+        app.state.agent_pool.check_admission()
+    except PoolExhaustedError as e:
+        logger.warning(str(e))
+        raise busy_response(e)
+    return StreamingResponse(
+        stream_agent_events(req.query, get_conversation(req)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/")
 async def root():
     logger.info("Root endpoint '/' accessed.")
     return {"message": "ES Book server is running."}
 
 
+@app.get("/api/agent-pool")
+async def agent_pool_stats():
+    return app.state.agent_pool.stats()
+
+
+@app.get("/api/tool-cache")
+async def tool_cache_stats():
+    return app.state.tool_cache.stats()
+
+
+@app.get("/api/history")
+async def history_stats():
+    return app.state.history.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
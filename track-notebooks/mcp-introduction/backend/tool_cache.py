@@ -0,0 +1,125 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds a result stays fresh per tool. Tools without a TTL are never cached.
+DEFAULT_TOOL_TTLS = {
+    "search": 300,
+    "search_google_books": 3600,
+    "list_indices": 600,
+    "get_mappings": 600,
+}
+
+
+def parse_tool_ttls(value: Optional[str]) -> Dict[str, float]:
+    """Parse "tool=seconds,tool=seconds" into a TTL map, falling back to the defaults."""
+    if not value:
+        return dict(DEFAULT_TOOL_TTLS)
+    ttls = {}
+    for item in value.split(","):
+        name, _, seconds = item.partition("=")
+        if name.strip() and seconds.strip():
+            ttls[name.strip()] = float(seconds)
+    return ttls
+
+
+def _canonicalize(value: Any) -> Any:
+    """Collapse whitespace in strings so trivially different arguments share a key."""
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {k: _canonicalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_canonicalize(v) for v in value]
+    return value
+
+
+def cache_key(tool_name: str, arguments: Optional[Dict[str, Any]]) -> str:
+    return tool_name + ":" + json.dumps(_canonicalize(arguments or {}), sort_keys=True, separators=(",", ":"))
+
+
+class ToolResultCache:
+    """
+    Size-bounded LRU cache of MCP tool results with a TTL per tool.
+
+    It is shared by every pooled agent. Each connector's call_tool is wrapped,
+    so a hit never reaches the MCP subprocess.
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 1000):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.per_tool: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, tool_name: str, outcome: str) -> None:
+        counts = self.per_tool.setdefault(tool_name, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: Any, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def wrap(self, connector: Any) -> None:
+        """Route a connector's call_tool through the cache."""
+        if getattr(connector, "_tool_cache_wrapped", False):
+            return
+        call_tool = connector.call_tool
+
+        async def cached_call_tool(name: str, arguments: Dict[str, Any]):
+            ttl = self.ttls.get(name)
+            if not ttl:
+                return await call_tool(name, arguments)
+
+            key = cache_key(name, arguments)
+            result = self.get(key)
+            if result is not None:
+                self.hits += 1
+                self._count(name, "hits")
+                logger.info(f"Tool cache hit for {name}")
+                return result
+
+            self.misses += 1
+            self._count(name, "misses")
+            result = await call_tool(name, arguments)
+            # Errors are not cached so a transient failure is retried next time
+            if not getattr(result, "isError", False):
+                self.put(key, result, ttl)
+            return result
+
+        connector.call_tool = cached_call_tool
+        connector._tool_cache_wrapped = True
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "ttls": self.ttls,
+            "per_tool": self.per_tool,
+        }
@@ -17,6 +17,9 @@ export default function App() {
           },
         ];
   });
+  const [sessionId, setSessionId] = useState(
+    () => localStorage.getItem("bookchat-session") || null
+  );
   const [input, setInput] = useState("");
   const [loading, setLoading] = useState(false);
   const bottomRef = useRef(null);
@@ -27,6 +30,14 @@ export default function App() {
     bottomRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [messages]);
 
+  useEffect(() => {
+    if (sessionId) {
+      localStorage.setItem("bookchat-session", sessionId);
+    } else {
+      localStorage.removeItem("bookchat-session");
+    }
+  }, [sessionId]);
+
   const handleClear = () => {
     setMessages([
       {
@@ -37,6 +48,7 @@ export default function App() {
     ]);
     setInput("");
     setLoading(false);
+    setSessionId(null);
   };
 
   const parseToolFromResponse = (responseText) => {
@@ -85,9 +97,15 @@ export default function App() {
         method: "POST",
         credentials: "include",
         headers: { "Content-Type": "application/json" },
+        // The server keeps the conversation, history only seeds a new session
         body: JSON.stringify({
           query: input,
-          history: messages.map((m) => m.text).filter(Boolean),
+          session_id: sessionId,
+          history: sessionId
+            ? []
+            : messages
+                .filter((m) => m.text)
+                .map((m) => ({ role: m.role, content: m.text })),
         }),
       });
       if (!res.ok) {
@@ -95,6 +113,7 @@ export default function App() {
       }
 
       const data = await res.json();
+      setSessionId(data.session_id || null);
       const { toolUsed, cleanText } = parseToolFromResponse(
         data.response || ""
       );
@@ -0,0 +1,104 @@
+"""
+Answer a JSONL file of questions with the chat pipeline, for evaluations and bulk jobs.
+
+Each input line is {"id": "...", "question": "...", "context_type": "semantic"}, only question is required and
+ids default to the line number. Run from chat-app-code with the same ES_URL / ES_USER / ES_PASSWORD as the app:
+
+    python -m backend.batch questions.jsonl --output answers.jsonl --concurrency 8
+
+Questions are retrieved with one msearch per batch and the completions run concurrently. Every answer is
+appended to the output as soon as it finishes, so rerunning the same command after a failure or Ctrl-C only
+answers the questions that have no result yet, or whose result is an error.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from backend.logging_config import setup_logging
+
+setup_logging()
+
+from backend.services import batch_service, es_client
+
+logger = logging.getLogger(__name__)
+
+
+def answered_ids(path):
+    """Ids with a successful result in an earlier run's output"""
+    ids = set()
+    if not os.path.exists(path):
+        return ids
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be cut short
+                continue
+            if "error" not in result:
+                ids.add(result.get("id"))
+    return ids
+
+
+async def run(args):
+    skip_ids = set() if args.restart else answered_ids(args.output)
+    with open(args.questions) as f:
+        questions, invalid = batch_service.parse_questions(f, skip_ids)
+    if skip_ids:
+        logger.info("Resuming %s, %s questions already answered", args.output, len(skip_ids))
+    for result in invalid:
+        logger.warning("Skipping line %s: %s", result["id"], result["error"])
+
+    es_client.init_es_client()
+    started = time.perf_counter()
+    answered = failed = 0
+    try:
+        with open(args.output, "w" if args.restart else "a") as output:
+            async for result in batch_service.answer_questions(
+                    questions, args.context_type, args.concurrency, args.inference_id):
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                if "error" in result:
+                    failed += 1
+                else:
+                    answered += 1
+                done = answered + failed
+                if done % args.progress_every == 0:
+                    elapsed = time.perf_counter() - started
+                    logger.info("%s/%s questions done, %s failed, %.1f questions/s",
+                                done, len(questions), failed, done / elapsed if elapsed else 0)
+    finally:
+        await es_client.close_es_client()
+    logger.info("Finished %s: %s answered, %s failed in %.1fs",
+                args.questions, answered, failed, time.perf_counter() - started)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="JSONL file of questions")
+    parser.add_argument("--output", help="JSONL file the results are appended to, defaults to <questions>.answers.jsonl")
+    parser.add_argument("--context-type", help="retrieval strategy for lines without one, see search_service.STRATEGIES")
+    parser.add_argument("--concurrency", type=int, default=batch_service.BATCH_CONCURRENCY,
+                        help="completions running at the same time")
+    parser.add_argument("--inference-id", help="completion endpoint, defaults to COMPLETION_INFERENCE_ID")
+    parser.add_argument("--restart", action="store_true", help="overwrite the output and answer every question again")
+    parser.add_argument("--progress-every", type=int, default=100, help="log progress every this many questions")
+    args = parser.parse_args()
+    args.output = args.output or f"{os.path.splitext(args.questions)[0]}.answers.jsonl"
+
+    try:
+        failed = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        logger.error("Interrupted, rerun the same command to resume")
+        raise SystemExit(1)
+    if failed:
+        logger.warning("%s questions failed, rerun the same command to retry them", failed)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
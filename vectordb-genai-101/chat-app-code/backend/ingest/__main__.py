@@ -0,0 +1,230 @@
+"""
+Index kaggle_datasets_restaurant-reviews.csv (or a larger dump in the same format) into restaurant_reviews.
+
+Run from chat-app-code with the same ES_URL / ES_USER / ES_PASSWORD as the app:
+
+    python -m backend.ingest ../kaggle_datasets_restaurant-reviews.csv --threads 8 --chunk-size 250
+
+The CSV is streamed a window of rows at a time, each window is indexed with parallel_bulk and the checkpoint
+file records the rows done, so rerunning the same command after a failure resumes where it stopped.
+
+Runs are incremental: the manifest file keeps the content hash of every indexed review, rows whose hash did not
+change are skipped (no bulk request, no inference), changed and new rows are upserted and reviews no longer in
+the CSV are deleted. --full sends every row again.
+
+The knn retrieval strategy is opt-in. It needs a dense (text_embedding) endpoint such as my-e5-endpoint, and
+every review is then embedded by it as well as by ELSER. To enable it, add a dense field to the index's entry in
+backend/config/indices.json (or the file INDEX_REGISTRY_PATH points to):
+
+    "dense_field": "dense_body",
+    "dense_inference_id": "my-e5-endpoint"
+
+then rerun with --recreate. The new field changes every review's content hash, so all reviews are sent again.
+Indices without a dense field are searched with the default strategy when a client asks for knn.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from itertools import islice
+
+from backend.logging_config import setup_logging
+
+setup_logging()
+
+from elasticsearch import ApiError, Elasticsearch, TransportError
+from backend.ingest.bulk_indexer import BulkIndexer, Checkpoint, IngestError
+from backend.ingest.manifest import Manifest
+from backend.ingest.reviews import InvalidReview, content_hash, read_rows, review_id, review_mapping, to_review
+from backend.services.es_client import ES_MAX_RETRIES
+from backend.services.index_registry import get_index_config
+from backend.services.search_service import SEMANTIC_INFERENCE_ID
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CSV = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))),
+    'kaggle_datasets_restaurant-reviews.csv'
+)
+
+
+def create_client(request_timeout):
+    """Synchronous client for parallel_bulk, configured from the same environment as the app's client"""
+    return Elasticsearch(
+        hosts=os.getenv('ES_URL', 'http://kubernetes-vm:9200'),
+        basic_auth=(os.getenv('ES_USER', 'elastic'), os.getenv('ES_PASSWORD', 'changeme')),
+        request_timeout=request_timeout,
+        max_retries=ES_MAX_RETRIES,
+        retry_on_timeout=True,
+        # 429s are resent by BulkIndexer with backoff, an immediate transport retry would only add load
+        retry_on_status=()
+    )
+
+
+def ensure_index(client, config, inference_id, recreate):
+    if recreate and client.indices.exists(index=config.name):
+        logger.info("Deleting index %s", config.name)
+        client.indices.delete(index=config.name)
+    if client.indices.exists(index=config.name):
+        properties = client.indices.get_mapping(index=config.name)[config.name]["mappings"].get("properties", {})
+        if properties.get(config.semantic_field, {}).get("type") != "semantic_text":
+            raise IngestError(
+                f"{config.name}.{config.semantic_field} is not a semantic_text field, rerun with --recreate"
+            )
+        if config.dense_field and properties.get(config.dense_field, {}).get("type") != "semantic_text":
+            raise IngestError(
+                f"{config.name}.{config.dense_field} is not a semantic_text field, rerun with --recreate"
+            )
+        return
+    client.indices.create(index=config.name, mappings=review_mapping(config, inference_id))
+    logger.info("Created index %s with %s backed by inference endpoint %s",
+                config.name, config.semantic_field, inference_id)
+    if config.dense_field:
+        logger.info("%s is backed by inference endpoint %s", config.dense_field, config.dense_inference_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv", nargs="?", default=DEFAULT_CSV)
+    parser.add_argument("--index", default="restaurant_reviews", help="index from the index registry")
+    parser.add_argument("--inference-id", default=SEMANTIC_INFERENCE_ID,
+                        help="inference endpoint of the semantic_text field, used when the index is created")
+    parser.add_argument("--chunk-size", type=int, default=200, help="documents per bulk request")
+    parser.add_argument("--threads", type=int, default=4, help="bulk requests in flight")
+    parser.add_argument("--window", type=int, default=0,
+                        help="rows read and checkpointed at a time, defaults to chunk-size * threads * 4")
+    parser.add_argument("--max-retries", type=int, default=8, help="resends of documents rejected with 429")
+    parser.add_argument("--request-timeout", type=float, default=120,
+                        help="seconds per bulk request, semantic_text runs inference while indexing")
+    parser.add_argument("--checkpoint", help="defaults to <index>.ingest-checkpoint.json next to the CSV")
+    parser.add_argument("--manifest", help="defaults to <index>.ingest-manifest.json next to the CSV")
+    parser.add_argument("--manifest-every", type=int, default=10,
+                        help="windows between manifest saves, it is also saved when the run ends or stops")
+    parser.add_argument("--full", action="store_true", help="send every row, even when its content hash is unchanged")
+    parser.add_argument("--keep-missing", action="store_true",
+                        help="do not delete indexed reviews that are not in the CSV, e.g. when loading a partial dump")
+    parser.add_argument("--rejects", help="JSONL file for invalid rows and documents Elasticsearch refused")
+    parser.add_argument("--recreate", action="store_true", help="delete the index and start from the first row")
+    args = parser.parse_args()
+
+    config = get_index_config(args.index)
+    window = args.window or args.chunk_size * args.threads * 4
+    checkpoint = Checkpoint(
+        args.checkpoint or os.path.join(os.path.dirname(os.path.abspath(args.csv)), f"{args.index}.ingest-checkpoint.json"),
+        args.csv,
+        args.index
+    )
+    if args.recreate:
+        checkpoint.clear()
+    checkpoint.load()
+
+    rejects = open(args.rejects, "a") if args.rejects else None
+
+    def reject(entry):
+        if rejects:
+            rejects.write(json.dumps(entry, default=str) + "\n")
+
+    def on_error(info):
+        logger.warning("Document %s rejected: %s", info.get("_id"), info.get("error"))
+        reject({"_id": info.get("_id"), "status": info.get("status"), "error": info.get("error")})
+
+    client = create_client(args.request_timeout)
+    ensure_index(client, config, args.inference_id, args.recreate)
+    settings = client.indices.get_settings(index=config.name, name="index.refresh_interval,index.uuid") \
+        .get(config.name, {}).get("settings", {}).get("index", {})
+    manifest = Manifest(
+        args.manifest or os.path.join(os.path.dirname(os.path.abspath(args.csv)), f"{args.index}.ingest-manifest.json"),
+        config.name
+    ).load(client, settings.get("uuid"))
+    # Refreshing while bulk indexing costs throughput, it is switched off for the run and restored afterwards
+    client.indices.put_settings(index=config.name, settings={"index": {"refresh_interval": "-1"}})
+
+    indexer = BulkIndexer(client, args.chunk_size, args.threads, max_retries=args.max_retries, on_error=on_error)
+    # Rows before the checkpoint are read again, without sending them, to know which reviews the CSV still has
+    rows = read_rows(args.csv)
+    seen = set()
+    started = time.perf_counter()
+    run_indexed = 0
+    windows = 0
+    try:
+        while True:
+            batch = list(islice(rows, window))
+            if not batch:
+                break
+            actions = []
+            hashes = {}
+            for row_number, row in batch:
+                resumed = row_number < checkpoint.rows_done
+                try:
+                    doc = to_review(row, config)
+                except InvalidReview as e:
+                    if not resumed:
+                        checkpoint.rejected += 1
+                        reject({"row": row_number, "error": str(e)})
+                    continue
+                doc_id = review_id(doc, config)
+                seen.add(doc_id)
+                if resumed:
+                    continue
+                doc["content_hash"] = content_hash(doc)
+                if not args.full and manifest.get(doc_id) == doc["content_hash"]:
+                    checkpoint.unchanged += 1
+                    continue
+                hashes[doc_id] = doc["content_hash"]
+                actions.append({"_index": config.name, "_id": doc_id, "_source": doc})
+            if batch[-1][0] < checkpoint.rows_done:
+                continue
+
+            done, failed = indexer.index(actions) if actions else ([], 0)
+            # The manifest only learns about documents that made it in, failed ones are sent again next run.
+            # Saving rewrites every hash, so it happens every --manifest-every windows when something changed and
+            # when the run ends. A crash in between only means those documents are sent again once
+            manifest.update({doc_id: hashes[doc_id] for doc_id in done})
+            windows += 1
+            if manifest.changed and windows % args.manifest_every == 0:
+                manifest.save()
+            checkpoint.rows_done = batch[-1][0] + 1
+            checkpoint.indexed += len(done)
+            checkpoint.failed += failed
+            checkpoint.save()
+            run_indexed += len(done)
+            elapsed = time.perf_counter() - started
+            logger.info("%s rows done, %s indexed, %s unchanged, %s rejected, %s failed, %.0f docs/s",
+                        checkpoint.rows_done, checkpoint.indexed, checkpoint.unchanged, checkpoint.rejected,
+                        checkpoint.failed, run_indexed / elapsed if elapsed else 0)
+
+        missing = [] if args.keep_missing else [doc_id for doc_id in manifest.ids() if doc_id not in seen]
+        if missing:
+            logger.info("Deleting %s reviews that are no longer in %s", len(missing), args.csv)
+            done, failed = indexer.index([
+                {"_op_type": "delete", "_index": config.name, "_id": doc_id} for doc_id in missing
+            ])
+            manifest.remove(done)
+            checkpoint.deleted += len(done)
+            checkpoint.failed += failed
+            checkpoint.save()
+    except (IngestError, ApiError, TransportError, KeyboardInterrupt) as e:
+        logger.error("Stopped after row %s (%s), rerun the same command to resume", checkpoint.rows_done, str(e) or "interrupted")
+        raise SystemExit(1)
+    finally:
+        if manifest.changed:
+            manifest.save()
+        try:
+            client.indices.put_settings(index=config.name,
+                                        settings={"index": {"refresh_interval": settings.get("refresh_interval")}})
+        except (ApiError, TransportError):
+            logger.exception("Could not restore the refresh interval of %s", config.name)
+        if rejects:
+            rejects.close()
+
+    client.indices.refresh(index=config.name)
+    logger.info("Finished %s: %s indexed, %s unchanged, %s deleted, %s invalid rows, %s failed documents, "
+                "%s retried after 429 in %.1fs",
+                args.csv, checkpoint.indexed, checkpoint.unchanged, checkpoint.deleted, checkpoint.rejected,
+                checkpoint.failed, indexer.retried, time.perf_counter() - started)
+    checkpoint.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import random
+import time
+from elasticsearch.helpers import parallel_bulk
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+class IngestError(RuntimeError):
+    pass
+
+
+class Checkpoint:
+    """
+    Progress of one CSV into one index, saved after every fully indexed window so a failed run resumes
+    after the last window that made it in. Written to a temporary file and renamed, a crash never leaves it half written
+    """
+
+    def __init__(self, path, source, index):
+        self.path = path
+        self.source = source
+        self.index = index
+        self.rows_done = 0
+        self.indexed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    @property
+    def source_size(self):
+        return os.path.getsize(self.source)
+
+    def load(self):
+        """Resume from the saved checkpoint when it belongs to the same, unchanged source file and index"""
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path) as f:
+            saved = json.load(f)
+        if (saved.get("source"), saved.get("index"), saved.get("source_size")) != (
+                os.path.abspath(self.source), self.index, self.source_size):
+            logger.warning("Checkpoint %s is for another source or index, starting from the first row", self.path)
+            return self
+        for field in ("rows_done", "indexed", "rejected", "failed", "unchanged", "deleted"):
+            setattr(self, field, saved.get(field, 0))
+        logger.info("Resuming %s after row %s from checkpoint %s", self.source, self.rows_done, self.path)
+        return self
+
+    def save(self):
+        state = {
+            "source": os.path.abspath(self.source),
+            "source_size": self.source_size,
+            "index": self.index,
+            "rows_done": self.rows_done,
+            "indexed": self.indexed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "unchanged": self.unchanged,
+            "deleted": self.deleted,
+            "updated_at": time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BulkIndexer:
+    """
+    Sends index and delete actions with parallel_bulk, a window at a time.
+
+    parallel_bulk sends chunk_size documents per request from thread_count threads. It does not retry rejected
+    documents, so the ones refused with 429 (or a 5xx from an overloaded node or inference service) are collected
+    and resent with exponential backoff and jitter until they succeed or max_retries is reached. Other per-document
+    errors are reported to on_error and not retried. Deleting a document that is already gone counts as done.
+    """
+
+    def __init__(self, client, chunk_size=200, thread_count=4, max_chunk_bytes=10 * 1024 * 1024,
+                 max_retries=8, initial_backoff=2.0, max_backoff=60.0, on_error=None):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.thread_count = thread_count
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.on_error = on_error
+        self.retried = 0
+
+    def _send(self, actions):
+        """One parallel_bulk pass, returns (ids done, failed, retryable actions)"""
+        by_id = {action["_id"]: action for action in actions}
+        done = []
+        failed = 0
+        retry = []
+        for ok, item in parallel_bulk(
+            self.client,
+            actions,
+            thread_count=self.thread_count,
+            chunk_size=self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            raise_on_error=False,
+            raise_on_exception=False
+        ):
+            op_type, info = next(iter(item.items()))
+            if ok or (op_type == "delete" and info.get("status") == 404):
+                done.append(info.get("_id"))
+                continue
+            if info.get("status") in RETRYABLE_STATUSES and info.get("_id") in by_id:
+                retry.append(by_id[info["_id"]])
+            else:
+                failed += 1
+                if self.on_error:
+                    self.on_error(info)
+        return done, failed, retry
+
+    def index(self, actions):
+        """Send one window of actions, returns (ids done, failed). Raises IngestError when retries run out"""
+        done, failed, retry = self._send(actions)
+        attempt = 0
+        while retry:
+            attempt += 1
+            if attempt > self.max_retries:
+                raise IngestError(f"{len(retry)} documents still rejected after {self.max_retries} retries")
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+            backoff *= random.uniform(0.5, 1.0)
+            logger.warning("%s documents rejected by Elasticsearch, retry %s in %.1fs", len(retry), attempt, backoff)
+            self.retried += len(retry)
+            time.sleep(backoff)
+            retry_done, retry_failed, retry = self._send(retry)
+            done += retry_done
+            failed += retry_failed
+        return done, failed
@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import time
+from elasticsearch.helpers import scan
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest:
+    """
+    Local record of what an index holds: document id -> content hash, plus the uuid of the index it describes.
+
+    Comparing CSV rows against it tells which reviews are new, changed or gone without reading the index, so
+    unchanged reviews are not sent again and their semantic_text chunks are not re-embedded. When the index was
+    recreated (its uuid changed) or the file is missing, it is rebuilt from the content_hash stored in every
+    document, which reads only that field and runs no inference.
+    """
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.index_uuid = None
+        self.entries = {}
+        # entries changed since the last save
+        self.changed = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, doc_id):
+        return self.entries.get(doc_id)
+
+    def ids(self):
+        return list(self.entries)
+
+    def update(self, hashes):
+        if hashes:
+            self.entries.update(hashes)
+            self.changed = True
+
+    def remove(self, doc_ids):
+        for doc_id in doc_ids:
+            if self.entries.pop(doc_id, None) is not None:
+                self.changed = True
+
+    def load(self, client, index_uuid):
+        saved = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+        if saved and saved.get("index") == self.index and saved.get("index_uuid") == index_uuid:
+            self.index_uuid = index_uuid
+            self.entries = saved["entries"]
+            logger.info("Loaded manifest %s with %s documents", self.path, len(self.entries))
+            return self
+        if saved:
+            logger.warning("Manifest %s describes another copy of %s, rebuilding it from the index", self.path, self.index)
+        return self.rebuild(client, index_uuid)
+
+    def rebuild(self, client, index_uuid):
+        started = time.perf_counter()
+        self.index_uuid = index_uuid
+        self.entries = {}
+        for hit in scan(client, index=self.index, _source=["content_hash"], size=1000):
+            content_hash = hit.get("_source", {}).get("content_hash")
+            # documents indexed before content hashes were stored are sent again once
+            if content_hash:
+                self.entries[hit["_id"]] = content_hash
+        logger.info("Rebuilt manifest of %s from the index: %s documents in %.1fs",
+                    self.index, len(self.entries), time.perf_counter() - started)
+        self.save()
+        return self
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"index": self.index, "index_uuid": self.index_uuid, "entries": self.entries},
+                      f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.changed = False
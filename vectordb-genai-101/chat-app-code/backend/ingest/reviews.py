@@ -0,0 +1,110 @@
+import csv
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+CSV_TIME_FORMAT = '%m/%d/%Y %H:%M'
+
+
+class InvalidReview(ValueError):
+    pass
+
+
+def review_mapping(config, inference_id):
+    """
+    Mapping of the reviews index. The semantic field, and the dense field when the registry has one, are the
+    semantic_text fields the search strategies query through their inference chunks, they are filled with the
+    review text at index time
+    """
+    mapping = {
+        "properties": {
+            "Restaurant": {"type": "keyword"},
+            "Reviewer": {"type": "keyword"},
+            config.text_field: {"type": "text"},
+            "Rating": {"type": "float"},
+            "Metadata": {"type": "keyword", "index": False},
+            "Time": {"type": "date"},
+            "Pictures": {"type": "integer"},
+            config.semantic_field: {"type": "semantic_text", "inference_id": inference_id},
+            # hash of the fields above, compared by incremental runs to skip unchanged reviews
+            "content_hash": {"type": "keyword", "index": False}
+        }
+    }
+    if config.dense_field:
+        mapping["properties"][config.dense_field] = {"type": "semantic_text", "inference_id": config.dense_inference_id}
+    return mapping
+
+
+def read_rows(path):
+    """
+    Stream (row number, row) pairs from the CSV without loading the file.
+    Rows are counted as CSV records, reviews span several lines
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        yield from enumerate(csv.DictReader(f))
+
+
+def to_review(row, config):
+    """Validate a CSV row and convert it to the indexed document"""
+    restaurant = (row.get("Restaurant") or "").strip()
+    review = (row.get("Review") or "").strip()
+    if not restaurant:
+        raise InvalidReview("missing Restaurant")
+    if not review:
+        raise InvalidReview("missing Review")
+
+    # The dataset has a few "Like" ratings, they are kept without a Rating
+    rating = None
+    if row.get("Rating"):
+        try:
+            rating = float(row["Rating"])
+        except ValueError:
+            pass
+        else:
+            if not 0 <= rating <= 5:
+                raise InvalidReview(f"Rating {rating} is out of range")
+
+    time = None
+    if row.get("Time"):
+        try:
+            time = datetime.strptime(row["Time"].strip(), CSV_TIME_FORMAT).isoformat()
+        except ValueError:
+            raise InvalidReview(f"unparseable Time {row['Time']!r}")
+
+    try:
+        pictures = int(row.get("Pictures") or 0)
+    except ValueError:
+        raise InvalidReview(f"Pictures {row['Pictures']!r} is not a number")
+
+    doc = {
+        "Restaurant": restaurant,
+        "Reviewer": (row.get("Reviewer") or "").strip() or None,
+        config.text_field: review,
+        "Rating": rating,
+        "Metadata": row.get("Metadata") or None,
+        "Time": time,
+        "Pictures": pictures,
+        config.semantic_field: review
+    }
+    if config.dense_field:
+        doc[config.dense_field] = review
+    return doc
+
+
+def review_id(doc, config):
+    """
+    Stable document id, the same review keeps its id across runs so re-indexing overwrites instead of duplicating
+    """
+    key = [doc["Restaurant"], doc["Reviewer"] or "", doc["Time"] or ""]
+    if not doc["Reviewer"] and not doc["Time"]:
+        key.append(doc[config.text_field])
+    return hashlib.sha1("\x1f".join(key).encode()).hexdigest()
+
+
+def content_hash(doc):
+    """Hash of everything indexed for a review, any edit to the row changes it"""
+    fields = {k: v for k, v in doc.items() if k != "content_hash"}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import random
+import sys
+
+# Root level, and per-logger overrides as "backend.services.llm_service=DEBUG,elasticsearch=WARNING"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+# text or json
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Payloads (prompts, responses, hits) are cut to this many characters when they are logged
+LOG_MAX_PAYLOAD = int(os.getenv('LOG_MAX_PAYLOAD', '500'))
+# Fraction of requests whose payloads are logged at DEBUG level
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '1.0'))
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            "@timestamp": self.formatTime(record, DATE_FORMAT),
+            "log.level": record.levelname,
+            "log.logger": record.name,
+            "message": record.getMessage(),
+            "line": record.lineno
+        }
+        if record.exc_info:
+            entry["error.stack_trace"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class Truncated:
+    """
+    Log argument that is only converted to a string, and cut to LOG_MAX_PAYLOAD characters,
+    when the record is actually emitted
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit or LOG_MAX_PAYLOAD
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... [{len(text) - self.limit} more chars]"
+
+
+def truncate(value, limit=None):
+    return Truncated(value, limit)
+
+
+def log_payloads(logger):
+    """
+    True when this request's payloads should be logged: the logger is at DEBUG and the request is sampled.
+    Check it before building anything expensive for a log line
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    return LOG_PAYLOAD_SAMPLE_RATE >= 1.0 or random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def setup_logging():
+    """Configure the root handler and per-logger levels once, from main.py"""
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    for item in LOG_LEVELS.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
@@ -1,26 +1,32 @@
 import logging
+from backend.logging_config import setup_logging
+
+# Configured before the other backend modules are imported, some of them log at import time
+setup_logging()
+
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from backend.routers import search_router
-import os
-from elasticapm.contrib.starlette import make_apm_client, ElasticAPM
+from backend.services import es_client, health_service, metrics_service
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+logger = logging.getLogger(__name__)
 
 
-# apm = make_apm_client({
-#     'SERVICE_NAME': os.getenv('APM_SERVICE_NAME'),
-#     'API_KEY': os.getenv('APM_API_KEY'),
-#     'SERVER_URL': os.getenv('APM_SERVER_URL')
-# })
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connecting to Elasticsearch and setting up the cache and session storage happen in the background,
+    # the worker accepts connections right away and /readyz reports when it can serve traffic
+    health_service.start_warm_up()
+    yield
+    health_service.stop_warm_up()
+    await es_client.close_es_client()
 
 
-app = FastAPI()
-# app.add_middleware(ElasticAPM, client=apm)
+app = FastAPI(lifespan=lifespan)
+# Elastic APM or OTLP spans when TRACING_BACKEND is set, Prometheus metrics are always on at /metrics
+metrics_service.init_tracing(app)
 
 
 # CORS settings
@@ -31,7 +37,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-# app.add_middleware(ElasticAPM, client=apm)
 
 # Include the router
 app.include_router(search_router.router)
@@ -40,3 +45,14 @@ app.include_router(search_router.router)
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
+
+
+@app.get("/healthz")
+def liveness():
+    return health_service.liveness()
+
+
+@app.get("/readyz")
+async def readiness():
+    ready, report = await health_service.readiness()
+    return JSONResponse(report, status_code=200 if ready else 503)
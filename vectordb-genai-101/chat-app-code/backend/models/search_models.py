@@ -1,6 +1,41 @@
+from typing import NamedTuple, Optional
 from pydantic import BaseModel
 
 
 class SearchQuery(BaseModel):
     query: str
     context_type: str  # This matches the payload from the frontend correctly now
+
+
+class ReviewChunk(NamedTuple):
+    """One semantic_text chunk returned as an inner hit"""
+    text: str
+    score: float
+
+
+class SearchHit(NamedTuple):
+    """
+    The parts of an Elasticsearch hit used to build prompts.
+    Built straight from filtered responses so raw hit dicts are never kept around
+    """
+    index: str
+    id: str
+    score: float
+    # e.g. Restaurant and Rating
+    metadata: dict
+    # raw text for lexical matches, None when the text comes from chunks
+    text: Optional[str]
+    chunks: tuple = ()
+
+    def __str__(self):
+        chunks = " | ".join(chunk.text for chunk in self.chunks)
+        return f"{self.index}/{self.id} score={self.score:.4f} {self.metadata} {self.text or chunks}"
+
+
+class BatchQuestion(BaseModel):
+    """One line of a batch JSONL file"""
+    # echoed in the result, defaults to the line number
+    id: Optional[str] = None
+    question: str
+    # retrieval strategy, defaults to the one given for the whole batch
+    context_type: Optional[str] = None
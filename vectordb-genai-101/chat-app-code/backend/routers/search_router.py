@@ -1,128 +1,338 @@
+import asyncio
+import json
 import logging
-from fastapi import APIRouter, HTTPException
+import os
+import time
+import uuid
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from backend.services import search_service, inference_service, llm_service
+from backend.models.search_models import SearchQuery
+from backend.services import (
+    search_service, inference_service, llm_service, cache_service, session_service, admission_service, prefetch_service,
+    batch_service, rerank_service, frame_service
+)
+from backend.services.metrics_service import (
+    PROMPT_TOKENS, RESPONSE_TOKENS, TURNS, TURN_ERRORS, metrics_response, observe_stage, stage, turn_transaction
+)
+from backend.services.prompt_service import estimate_tokens
 from fastapi import WebSocket, APIRouter
-from elasticsearch import NotFoundError
+from backend.logging_config import log_payloads, truncate
 
 router = APIRouter()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+logger = logging.getLogger(__name__)
 
 # Set this to True to stream LLM responses back to the client
-# Streaming not implemented in this version
-streaming_llm = False
-
-class SearchQuery(BaseModel):
-    query: str
-    context_type: str
+streaming_llm = os.getenv('STREAMING_LLM', 'true').lower() == 'true'
 
 
 @router.post("/search")
 async def perform_search(search_query: SearchQuery):
-    logging.info(f"Received query: {search_query.query}")
+    logger.info("Received query: %s", search_query.query)
     try:
-        prompt_context = search_service.semantic_search(search_query.query, search_query.context_type)
-        llm_response = bedrock_service.query_aws_bedrock(prompt_context)
-        return {"prompt": prompt_context, "llm_response": llm_response}
+        with stage('retrieval'):
+            hits = await search_service.perform_es_search(
+                search_query.query,
+                search_service.SEARCH_INDICES,
+                search_query.context_type
+            )
+        with stage('rerank'):
+            chunks = await rerank_service.rerank(search_query.query, llm_service.prompt_chunks(hits))
+        with stage('prompt_build'):
+            prompt_result = llm_service.assemble_llm_prompt(search_query.query, hits, [], chunks)
+        with stage('completion'):
+            llm_response = await inference_service.es_chat_completion(
+                prompt_result.text,
+                inference_service.COMPLETION_INFERENCE_ID
+            )
+        return {"prompt": prompt_result.text, "llm_response": llm_response, "citations": prompt_result.citations}
+    except admission_service.Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
-        logging.error(f"Error in processing search: {str(e)}")
+        logger.error("Error in processing search: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/batch")
+async def batch_answer(request: Request, context_type: Optional[str] = None,
+                       concurrency: int = batch_service.BATCH_CONCURRENCY):
+    """
+    Answer a JSONL body of {"id": ..., "question": ..., "context_type": ...} lines without touching any session.
+    Results stream back as JSONL in the order they finish, each with its id and per-stage timings.
+    To resume an interrupted batch, send only the ids that have no result (or an error) yet
+    """
+    body = await request.body()
+    questions, invalid = batch_service.parse_questions(body.decode().splitlines())
+    concurrency = max(1, min(concurrency, batch_service.BATCH_CONCURRENCY))
+    logger.info("Received batch of %s questions", len(questions))
+
+    async def results():
+        for result in invalid:
+            yield json.dumps(result) + "\n"
+        async for result in batch_service.answer_questions(questions, context_type, concurrency):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+async def send_frame(websocket, frame):
+    with stage('ws_send'):
+        await websocket.send_json(frame)
+
+
 class ChatMessage(BaseModel):
-    message: str
+    # only settings messages come without one
+    message: Optional[str] = None
+    # retrieval strategy, see search_service.STRATEGIES
+    context_type: Optional[str] = None
+    # "prefetch" for the partial text of a message the user is still typing, "settings" to change the verbose
+    # frames, otherwise a full message
+    type: Optional[str] = None
+    # compact, full or off with type "settings", see frame_service
+    verbose: Optional[str] = None
 
 
-@router.websocket_route("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+async def stream_llm_response(websocket, prompt, inference_id):
+    """
+    Forward a streamed completion to the websocket as partial_response frames.
+    Deltas that pile up while a send is in flight are coalesced into the next frame.
+    :return: the assembled response text
+    """
+    buffer = asyncio.Queue(maxsize=inference_service.STREAM_BUFFER_SIZE)
+    done = object()
 
-    # Initialize the conversation history
-    convo_history = llm_service.init_conversation_history()
+    async def produce():
+        try:
+            async for delta in inference_service.es_stream_completion(prompt, inference_id):
+                await buffer.put(delta)
+        finally:
+            await buffer.put(done)
 
+    started = time.perf_counter()
+    producer = asyncio.create_task(produce())
+    parts = []
     try:
-        while True:
-            # Receive the message from the client (user's question)
-            data = await websocket.receive_text()
-            logging.debug(f"Raw data received: {data}")
+        finished = False
+        while not finished:
+            chunk = [await buffer.get()]
+            while not buffer.empty():
+                chunk.append(buffer.get_nowait())
+            if chunk[-1] is done:
+                chunk.pop()
+                finished = True
+            if chunk:
+                if not parts:
+                    observe_stage('time_to_first_token', time.perf_counter() - started)
+                text = "".join(chunk)
+                parts.append(text)
+                await send_frame(websocket, {
+                    "type": "partial_response",
+                    "text": text
+                })
+        # re-raise any error from the stream
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+
+    return "".join(parts)
+
+
+@router.get("/cache/stats")
+async def cache_stats():
+    if cache_service.response_cache is None:
+        return {"backend": "none"}
+    return cache_service.response_cache.stats()
+
+
+@router.get("/metrics")
+async def metrics():
+    body, content_type = metrics_response()
+    return Response(content=body, media_type=content_type)
+
+
+@router.get("/admission/stats")
+async def admission_stats():
+    return admission_service.stats()
+
+
+@router.get("/sessions/stats")
+async def session_stats():
+    return session_service.session_store.stats()
 
-            # Parse the user's question
-            chat_message = ChatMessage.parse_raw(data)
-            logging.info(f"Received message: {chat_message.message}")
 
-            # create Prompt to generate retriever
-            context_unparsed = search_service.perform_es_search(
+async def handle_turn(websocket, chat_message, session_id, convo_history, summarizer, prefetcher, frames):
+    """
+    Answer one user message on the websocket
+    :return: the updated conversation history
+    """
+    # Decided once per turn so a sampled turn logs all of its payloads
+    payloads = log_payloads(logger)
+    if payloads:
+        logger.debug("Message received: %s", truncate(chat_message))
+    logger.info("Received message: %s", chat_message.message)
+
+    if convo_history is None:
+        convo_history = await llm_service.init_conversation_history(session_id)
+
+    # Shed the turn before retrieval when the completion endpoint could not take it anyway
+    admission_service.get_limiter(inference_service.COMPLETION_INFERENCE_ID).check()
+
+    # create Prompt to generate retriever
+    with stage('retrieval'):
+        # hits retrieved while the user was typing, when they match the message
+        context_unparsed = await prefetcher.take(chat_message.message, chat_message.context_type)
+        if context_unparsed is None:
+            context_unparsed = await search_service.perform_es_search(
                 chat_message.message,
-                "elastic-labs"
+                search_service.SEARCH_INDICES,
+                chat_message.context_type
             )
-            logging.info(f"Context received from perform_es_search")
+        else:
+            logger.info("Using prefetched context")
+    logger.info("Context received from perform_es_search")
 
-            # Create a prompt for the LLM
-            prompt = llm_service.create_llm_prompt(
-                chat_message.message,
-                context_unparsed,
-                convo_history
-             )
-            logging.info(f"Created Prompt for LLM: {prompt}")
-            logging.info(f"Prompt length: {len(prompt)}")
-
-
-#TODO this is a mess
-            # Send the contextual data back to the UI before making LLM calls
-            logging.debug(f"Sending context back to UI: {context_unparsed}")
-            logging.info("building tmp_context")
-            # logging.info(context_unparsed)
-            # tmp_context = ('\n---------------------------------------------------------\n\n'
-            #                '---------------------------------------------------------\n\n\n').join(context_unparsed)
-            tmp_context = ""
-            for hit in context_unparsed:
-                tmp_context += f"str{hit}\n\n"
-
-            await websocket.send_json({
-                "type": "verbose_info",
-                "text": f"Context gathered from Elasticsearch\n\n{tmp_context}"
-                        # f"Elasticsearch\n\n---------------------------------------------------------\n\n"
-                        # f"---------------------------------------------------------\n\n{tmp_context}"
-            })
-
-
-            # Call the LLM to generate a response
-            if not streaming_llm:
-                logging.info(f"sending prompt {prompt}")
-                # use Elastic to call chat completion - response is full response
-                response = inference_service.es_chat_completion(prompt,
-                                                                "openai_chat_completions"
-                                                                )
-
-                logging.info(f"Response from LLM: {response}")
-
-
-                logging.info(f"Sending response to client")
-                await websocket.send_json({
-                    "type": "full_response",
-                    "text": response
-                })
+    # Send the contextual data back to the UI as soon as it is retrieved, before the prompt is built
+    context_frame = frames.context_frame(context_unparsed)
+    if context_frame is not None:
+        await send_frame(websocket, context_frame)
+
+    # Pick up a history summary that finished since the last turn
+    convo_history = llm_service.apply_conversation_summary(convo_history, summarizer)
+
+    # Keep the chunks most relevant to the message when a reranker is configured
+    with stage('rerank'):
+        chunks = await rerank_service.rerank(chat_message.message, llm_service.prompt_chunks(context_unparsed))
+
+    # Create a prompt for the LLM
+    with stage('prompt_build'):
+        prompt_result = llm_service.assemble_llm_prompt(
+            chat_message.message,
+            context_unparsed,
+            convo_history,
+            chunks
+         )
+    prompt = prompt_result.text
+    PROMPT_TOKENS.observe(prompt_result.report["total"])
+    logger.info("Prompt length: %s", len(prompt))
+    if payloads:
+        logger.debug("Created Prompt for LLM: %s", truncate(prompt))
+
+    # Serve near-duplicate questions from the response cache.
+    # Follow-up turns depend on the conversation history so they always go to the LLM
+    cache_lookup = None
+    if cache_service.response_cache is not None and not convo_history:
+        cache_lookup = await cache_service.response_cache.lookup(chat_message.message, context_unparsed)
+
+    if cache_lookup is not None and cache_lookup.response is not None:
+        logger.info("Response served from cache (%s match)", cache_lookup.match)
+        response = cache_lookup.response
+        TURNS.labels('cache').inc()
+        await send_frame(websocket, frames.response_frame(response, cached=True))
+
+    # Call the LLM to generate a response
+    elif not streaming_llm:
+        # use Elastic to call chat completion - response is full response
+        with stage('completion'):
+            response = await inference_service.es_chat_completion(prompt,
+                                                            inference_service.COMPLETION_INFERENCE_ID
+                                                            )
+        TURNS.labels('completion').inc()
+        RESPONSE_TOKENS.observe(estimate_tokens(response))
+
+        if payloads:
+            logger.debug("Response from LLM: %s", truncate(response))
+
+        logger.info("Sending response to client")
+        await send_frame(websocket, frames.response_frame(response, citations=prompt_result.citations))
+    else:
+        logger.info("Streaming response to client")
+        with stage('completion'):
+            response = await stream_llm_response(websocket,
+                                                 prompt,
+                                                 inference_service.COMPLETION_INFERENCE_ID
+                                                 )
+        TURNS.labels('stream').inc()
+        RESPONSE_TOKENS.observe(estimate_tokens(response))
+
+        # Final frame closes the partial bubble, in full mode it also carries the assembled text
+        await send_frame(websocket, frames.response_frame(response, streamed=True, citations=prompt_result.citations))
+
+    if cache_lookup is not None and cache_lookup.response is None:
+        await cache_service.response_cache.store(cache_lookup, response)
 
 
-            # Add the user's question and the LLM response to the conversation history
-            logging.info("Building conversation history")
-            convo_history = llm_service.build_conversation_history(history=convo_history,
-                                                                       user_message=chat_message.message,
-                                                                       ai_response=response
-                                                                       )
-            logging.debug(f"Conversation history: {convo_history}")
-            tmp_convo_hist = '\n---------------------------------------------------------\n\n'.join(
-                [str(h) for h in convo_history])
-            await websocket.send_json({
-                "type": "verbose_info",
-                "text": f"Conversation history updated:\n\n{tmp_convo_hist}"
-            })
+    # Add the user's question and the LLM response to the conversation history
+    logger.info("Building conversation history")
+    convo_history = await llm_service.build_conversation_history(history=convo_history,
+                                                               user_message=chat_message.message,
+                                                               ai_response=response,
+                                                               summarizer=summarizer,
+                                                               session_id=session_id
+                                                               )
+    if payloads:
+        logger.debug("Conversation history: %s", truncate(convo_history))
+    history_frame = frames.history_frame(convo_history)
+    if history_frame is not None:
+        await send_frame(websocket, history_frame)
+
+    return convo_history
+
+
+@router.websocket_route("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+
+    # Clients reconnect with ?session_id=... to resume a conversation, new clients are given an id
+    session_id = websocket.query_params.get("session_id") or uuid.uuid4().hex
+    await send_frame(websocket, {
+        "type": "session",
+        "session_id": session_id
+    })
+
+    # The conversation history is loaded from the session store with the first message
+    convo_history = None
+    # Summarizes older turns in the background for this session
+    summarizer = llm_service.HistorySummarizer()
+    # Searches the partial text the client sends while the user types
+    prefetcher = prefetch_service.Prefetcher()
+    # Clients pick compact, full or off with ?verbose=... and can change it with a settings message
+    frames = frame_service.FrameBuilder(websocket.query_params.get("verbose"))
+
+    try:
+        while True:
+            # Receive the message from the client (user's question)
+            data = await websocket.receive_text()
+            chat_message = ChatMessage.parse_raw(data)
+            if chat_message.type == 'settings':
+                frames.set_mode(chat_message.verbose)
+                continue
+            if not chat_message.message:
+                continue
+            if chat_message.type == 'prefetch':
+                prefetcher.schedule(chat_message.message, chat_message.context_type)
+                continue
+            with turn_transaction(), stage('turn'):
+                try:
+                    convo_history = await handle_turn(
+                        websocket, chat_message, session_id, convo_history, summarizer, prefetcher, frames
+                    )
+                except admission_service.Overloaded as e:
+                    # the connection stays open, the client may send the message again later
+                    await send_frame(websocket, {
+                        "type": "busy",
+                        "text": f"The assistant is handling too many conversations right now, please try again in {e.retry_after}s.",
+                        "retry_after": e.retry_after
+                    })
+                except Exception:
+                    TURN_ERRORS.inc()
+                    raise
 
     except Exception as e:
-        logging.error("WebSocket encountered an error:", exc_info=True)
+        logger.error("WebSocket encountered an error:", exc_info=True)
         await websocket.close(code=1001)
+    finally:
+        summarizer.cancel()
+        prefetcher.cancel()
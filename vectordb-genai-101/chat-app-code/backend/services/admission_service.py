@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from .metrics_service import LLM_QUEUE_WAIT_SECONDS, LLM_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+# Completions running at the same time per inference endpoint, with per-endpoint overrides as "id=limit,..."
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_CONCURRENCY_LIMITS = os.getenv('LLM_CONCURRENCY_LIMITS', '')
+# Completions allowed to wait for a slot per endpoint, more are rejected straight away
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '32'))
+# Longest a completion waits for a slot. A request whose expected wait is already longer is rejected on arrival
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '10'))
+
+
+class Overloaded(Exception):
+    """A completion was not admitted, the client should retry after retry_after seconds"""
+
+    def __init__(self, inference_id, reason, retry_after):
+        super().__init__(f"{inference_id} is overloaded ({reason})")
+        self.inference_id = inference_id
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    Concurrency limit with a bounded FIFO wait queue for one inference endpoint.
+
+    A request gets a slot when one is free. Otherwise it queues, unless the queue is full or the expected wait
+    (average completion time times its place in line, spread over the slots) is longer than the queue timeout,
+    in which case it is rejected at once instead of timing out later. Under overload the admitted requests keep
+    their normal latency and the rest fail fast with a retry hint
+    """
+
+    def __init__(self, inference_id, limit, max_queue, queue_timeout):
+        self.inference_id = inference_id
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = deque()
+        # moving average of how long a slot is held
+        self.service_seconds = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def expected_wait(self, position=None):
+        position = self.waiting if position is None else position
+        return self.service_seconds * (position + 1) / self.limit
+
+    def _reject(self, reason):
+        self.rejected += 1
+        LLM_REJECTIONS.labels(self.inference_id, reason).inc()
+        retry_after = max(1, math.ceil(self.expected_wait()))
+        logger.warning("Rejected a completion on %s: %s, %s running, %s waiting",
+                       self.inference_id, reason, self.active, self.waiting)
+        raise Overloaded(self.inference_id, reason, retry_after)
+
+    def check(self):
+        """Reject now if a request arriving at this moment would be rejected, without taking a slot"""
+        if self.active < self.limit:
+            return
+        if self.waiting >= self.max_queue:
+            self._reject('queue_full')
+        if self.expected_wait() > self.queue_timeout:
+            self._reject('expected_wait')
+
+    def _release(self):
+        # hand the slot straight to the next waiter so nobody can jump the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    async def _acquire(self):
+        started = time.perf_counter()
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+        else:
+            self.check()
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was handed over just as the wait ended
+                    self._release()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._reject('queue_timeout')
+                raise
+        self.admitted += 1
+        LLM_QUEUE_WAIT_SECONDS.labels(self.inference_id).observe(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            held = time.perf_counter() - started
+            self.service_seconds = held if not self.service_seconds else 0.8 * self.service_seconds + 0.2 * held
+            self._release()
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_completion_seconds": round(self.service_seconds, 3)
+        }
+
+
+def _parse_limits(value):
+    limits = {}
+    for item in value.split(','):
+        if '=' in item:
+            inference_id, limit = item.split('=', 1)
+            limits[inference_id.strip()] = int(limit)
+    return limits
+
+
+_limits = _parse_limits(LLM_CONCURRENCY_LIMITS)
+limiters = {}
+
+
+def get_limiter(inference_id):
+    limiter = limiters.get(inference_id)
+    if limiter is None:
+        limiter = limiters[inference_id] = AdmissionLimiter(
+            inference_id, _limits.get(inference_id, LLM_MAX_CONCURRENCY), LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT
+        )
+    return limiter
+
+
+def stats():
+    return {inference_id: limiter.stats() for inference_id, limiter in limiters.items()}
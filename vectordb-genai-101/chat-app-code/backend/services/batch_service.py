@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from backend.models.search_models import BatchQuestion
+from . import inference_service, llm_service, rerank_service, search_service
+from .admission_service import Overloaded
+from .metrics_service import BATCH_ITEMS
+
+logger = logging.getLogger(__name__)
+
+# Questions retrieved per msearch request
+BATCH_SEARCH_SIZE = int(os.getenv('BATCH_SEARCH_SIZE', '32'))
+# Completions one batch runs at the same time, also the most a /batch request may ask for.
+# Keep it below LLM_MAX_CONCURRENCY so chat sessions still get slots while a batch runs
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+# Times a completion shed by admission control is tried again, after the wait it was told to
+BATCH_MAX_RETRIES = int(os.getenv('BATCH_MAX_RETRIES', '5'))
+
+
+def parse_questions(lines, skip_ids=()):
+    """
+    Parse JSONL lines into BatchQuestions, ids default to the line number.
+    Questions whose id is in skip_ids are left out, which is how a run resumes
+    :return: (questions, error results for the lines that could not be parsed)
+    """
+    questions = []
+    invalid = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        question_id = str(line_number)
+        try:
+            item = json.loads(line)
+            question_id = item["id"] = str(item.get("id") or line_number)
+            question = BatchQuestion.parse_obj(item)
+        except (ValueError, TypeError, AttributeError) as e:
+            invalid.append({"id": question_id, "error": f"invalid line: {e}"})
+            continue
+        if question.id not in skip_ids:
+            questions.append(question)
+    return questions, invalid
+
+
+def _batches(questions, size):
+    for start in range(0, len(questions), size):
+        yield questions[start:start + size]
+
+
+async def _retrieve(batch, context_type):
+    """One msearch per strategy used in the batch, returns hits or an exception per question"""
+    by_strategy = {}
+    for position, question in enumerate(batch):
+        strategy = question.context_type or context_type or search_service.DEFAULT_STRATEGY
+        by_strategy.setdefault(strategy, []).append(position)
+    outcomes = [None] * len(batch)
+    for strategy, positions in by_strategy.items():
+        try:
+            hits = await search_service.perform_es_msearch(
+                [batch[position].question for position in positions],
+                search_service.SEARCH_INDICES,
+                strategy
+            )
+        except Exception as e:
+            logger.error("Batch msearch failed: %s", e)
+            hits = [e] * len(positions)
+        for position, result in zip(positions, hits):
+            outcomes[position] = result
+    return outcomes
+
+
+async def _complete(prompt, inference_id):
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        try:
+            return await inference_service.es_chat_completion(prompt, inference_id)
+        except Overloaded as e:
+            if attempt == BATCH_MAX_RETRIES:
+                raise
+            logger.info("Batch completion shed by admission control, retrying in %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+
+def _result(question, hits=None, answer=None, citations=None, error=None, timings=None):
+    result = {"id": question.id, "question": question.question}
+    if error is not None:
+        result["error"] = error
+    else:
+        result["answer"] = answer
+        result["sources"] = [{"index": hit.index, "id": hit.id, "score": round(hit.score, 4)} for hit in hits]
+        # what each [n] in the answer refers to
+        result["citations"] = citations
+    result["timings"] = {name: round(seconds, 4) for name, seconds in (timings or {}).items()}
+    BATCH_ITEMS.labels('error' if error is not None else 'ok').inc()
+    return result
+
+
+async def answer_questions(questions, context_type=None, concurrency=BATCH_CONCURRENCY,
+                           inference_id=None):
+    """
+    Answer BatchQuestions with the /ws pipeline (retrieval, rerank, prompt building, es_chat_completion), without
+    conversation history, sessions or the response cache.
+
+    Questions are retrieved BATCH_SEARCH_SIZE at a time with one msearch. As soon as a batch comes back its chunks
+    are reranked concurrently and its prompts are built, then the completions run at most concurrency at a time.
+    The next batch is only retrieved once slots free up, so memory stays flat however long the input is.
+    A failing question becomes an error result, it does not stop the batch.
+    :return: async generator of result dicts in the order they finish, with per-stage timings in seconds
+    """
+    inference_id = inference_id or inference_service.COMPLETION_INFERENCE_ID
+    # a slot is held from the completion until its result has been read, so a slow reader holds up the
+    # completions and with them the next msearch
+    slots = asyncio.Semaphore(concurrency)
+    # (result, holds a slot)
+    results = asyncio.Queue()
+    done = object()
+
+    async def answer(question, hits, prompt_result, timings, started):
+        completion_started = time.perf_counter()
+        try:
+            answer = await _complete(prompt_result.text, inference_id)
+        except asyncio.CancelledError:
+            slots.release()
+            raise
+        except Exception as e:
+            logger.error("Batch completion failed for %s: %s", question.id, e)
+            timings["total"] = time.perf_counter() - started
+            results.put_nowait((_result(question, error=f"completion failed: {e}", timings=timings), True))
+            return
+        timings["completion"] = time.perf_counter() - completion_started
+        timings["total"] = time.perf_counter() - started
+        results.put_nowait((_result(question, hits, answer, prompt_result.citations, timings=timings), True))
+
+    async def produce():
+        tasks = set()
+        try:
+            for batch in _batches(questions, BATCH_SEARCH_SIZE):
+                started = time.perf_counter()
+                outcomes = await _retrieve(batch, context_type)
+                retrieval = time.perf_counter() - started
+                reranked = await asyncio.gather(*(
+                    rerank_service.rerank(question.question, llm_service.prompt_chunks(hits))
+                    for question, hits in zip(batch, outcomes) if not isinstance(hits, Exception)
+                ))
+                rerank = time.perf_counter() - started - retrieval
+                reranked = iter(reranked)
+                for question, hits in zip(batch, outcomes):
+                    timings = {"retrieval": retrieval}
+                    if isinstance(hits, Exception):
+                        timings["total"] = time.perf_counter() - started
+                        results.put_nowait((_result(question, error=f"retrieval failed: {hits}", timings=timings), False))
+                        continue
+                    timings["rerank"] = rerank
+                    prompt_started = time.perf_counter()
+                    prompt_result = llm_service.assemble_llm_prompt(question.question, hits, [], next(reranked))
+                    timings["prompt_build"] = time.perf_counter() - prompt_started
+                    await slots.acquire()
+                    timings["queued"] = time.perf_counter() - prompt_started - timings["prompt_build"]
+                    task = asyncio.create_task(answer(question, hits, prompt_result, timings, started))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            results.put_nowait((done, False))
+
+    logger.info("Starting batch of %s questions, %s completions at a time", len(questions), concurrency)
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            result, holds_slot = await results.get()
+            if result is done:
+                break
+            yield result
+            if holds_slot:
+                slots.release()
+        # re-raise anything that stopped the producer
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
@@ -0,0 +1,311 @@
+import hashlib
+import logging
+import math
+import os
+import re
+from datetime import datetime, timezone
+from .es_client import get_es_client, inference_client
+from .ttl_store import TTLMap, delete_expired
+
+logger = logging.getLogger(__name__)
+
+# memory, elasticsearch or none
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory').lower()
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+RESPONSE_CACHE_INDEX = os.getenv('RESPONSE_CACHE_INDEX', 'llm_response_cache')
+# text_embedding inference endpoint used for similarity lookups, e.g. my-e5-endpoint.
+# When unset only exact matches are served from the cache
+RESPONSE_CACHE_EMBEDDING_INFERENCE_ID = os.getenv('RESPONSE_CACHE_EMBEDDING_INFERENCE_ID')
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = float(os.getenv('RESPONSE_CACHE_SIMILARITY_THRESHOLD', '0.95'))
+
+
+def normalize_question(question):
+    """Lowercase, strip punctuation and collapse whitespace so trivial variations share a key"""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+
+def hits_fingerprint(hits):
+    """Stable fingerprint of the retrieved documents, independent of their order"""
+    ids = sorted(f"{hit.index}/{hit.id}" for hit in hits)
+    return hashlib.sha1("\n".join(ids).encode()).hexdigest()
+
+
+def _unit_vector(vector):
+    norm = math.sqrt(sum(v * v for v in vector))
+    if norm == 0:
+        return vector
+    return [v / norm for v in vector]
+
+
+def _dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class CacheLookup:
+    """Result of a cache lookup, reused to store the response on a miss"""
+
+    __slots__ = ("key", "question", "fingerprint", "embedding", "response", "match")
+
+    def __init__(self, key, question, fingerprint, embedding=None, response=None, match=None):
+        self.key = key
+        self.question = question
+        self.fingerprint = fingerprint
+        self.embedding = embedding
+        self.response = response
+        # "exact", "semantic" or None on a miss
+        self.match = match
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache with TTL expiry. Each worker holds its own copy"""
+
+    def __init__(self, max_entries, ttl):
+        self.entries = TTLMap(max_entries, ttl)
+
+    @property
+    def evictions(self):
+        return self.entries.evictions
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        return None if entry is None else entry["response"]
+
+    async def find_similar(self, fingerprint, embedding, threshold):
+        best_key, best_score = None, threshold
+        for key, entry in self.entries.items():
+            if entry["fingerprint"] != fingerprint or entry["embedding"] is None:
+                continue
+            score = _dot(embedding, entry["embedding"])
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        return self.entries.get(best_key)["response"]
+
+    async def put(self, lookup, response):
+        self.entries.put(lookup.key, {
+            "fingerprint": lookup.fingerprint,
+            "embedding": lookup.embedding,
+            "response": response
+        })
+
+    async def setup(self):
+        pass
+
+
+class ElasticsearchCacheBackend:
+    """
+    Cache stored in an Elasticsearch index so every worker shares it.
+    Entries expire by TTL and the least recently used entries are trimmed when the index grows past max_entries
+    """
+
+    # Trim the index every N writes rather than on every write
+    TRIM_EVERY = 50
+
+    def __init__(self, index, max_entries, ttl):
+        self.index = index
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self.writes = 0
+
+    async def setup(self):
+        es = get_es_client()
+        if await es.indices.exists(index=self.index):
+            return
+        await es.indices.create(
+            index=self.index,
+            mappings={
+                "dynamic": False,
+                "properties": {
+                    "fingerprint": {"type": "keyword"},
+                    "question": {"type": "keyword"},
+                    "response": {"type": "text", "index": False},
+                    # dims are set from the first document indexed
+                    "embedding": {"type": "dense_vector", "similarity": "cosine"},
+                    "expires_at": {"type": "date"},
+                    "last_access": {"type": "date"}
+                }
+            }
+        )
+        logger.info("Created response cache index %s", self.index)
+
+    def _now(self):
+        return datetime.now(timezone.utc)
+
+    async def _touch(self, doc_id):
+        await get_es_client().update(
+            index=self.index,
+            id=doc_id,
+            doc={"last_access": self._now().isoformat()},
+            retry_on_conflict=1
+        )
+
+    async def get(self, key):
+        response = await get_es_client().options(ignore_status=404).get(
+            index=self.index, id=key, source_includes=["response", "expires_at"]
+        )
+        if not response.get("found"):
+            return None
+        source = response["_source"]
+        if datetime.fromisoformat(source["expires_at"]) < self._now():
+            return None
+        await self._touch(key)
+        return source["response"]
+
+    async def find_similar(self, fingerprint, embedding, threshold):
+        response = await get_es_client().search(
+            index=self.index,
+            knn={
+                "field": "embedding",
+                "query_vector": embedding,
+                "k": 1,
+                "num_candidates": 10,
+                "filter": [
+                    {"term": {"fingerprint": fingerprint}},
+                    {"range": {"expires_at": {"gt": "now"}}}
+                ]
+            },
+            source_includes=["response"],
+            size=1
+        )
+        hits = response["hits"]["hits"]
+        if not hits:
+            return None
+        # cosine similarity is reported as (1 + cosine) / 2
+        if 2 * hits[0]["_score"] - 1 < threshold:
+            return None
+        await self._touch(hits[0]["_id"])
+        return hits[0]["_source"]["response"]
+
+    async def put(self, lookup, response):
+        now = self._now()
+        document = {
+            "fingerprint": lookup.fingerprint,
+            "question": lookup.question,
+            "response": response,
+            "expires_at": datetime.fromtimestamp(now.timestamp() + self.ttl, timezone.utc).isoformat(),
+            "last_access": now.isoformat()
+        }
+        if lookup.embedding is not None:
+            document["embedding"] = lookup.embedding
+        await get_es_client().index(index=self.index, id=lookup.key, document=document)
+
+        self.writes += 1
+        if self.writes % self.TRIM_EVERY == 0:
+            await self._trim()
+
+    async def _trim(self):
+        es = get_es_client()
+        self.evictions += await delete_expired(self.index)
+
+        count = (await es.count(index=self.index))["count"]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        oldest = await es.search(
+            index=self.index,
+            sort=[{"last_access": "asc"}],
+            size=overflow,
+            source=False
+        )
+        ids = [hit["_id"] for hit in oldest["hits"]["hits"]]
+        if ids:
+            deleted = await es.delete_by_query(
+                index=self.index,
+                query={"ids": {"values": ids}},
+                conflicts="proceed"
+            )
+            self.evictions += deleted.get("deleted", 0)
+
+
+class ResponseCache:
+    """
+    Cache of LLM responses keyed on the normalized question and the retrieved hits.
+    Lookups try an exact key match first, then embedding similarity among entries built from the same hits.
+    """
+
+    def __init__(self, backend, embedding_inference_id=None, similarity_threshold=0.95):
+        self.backend = backend
+        self.embedding_inference_id = embedding_inference_id
+        self.similarity_threshold = similarity_threshold
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def _embed(self, question):
+        response = await inference_client().inference.inference(
+            inference_id=self.embedding_inference_id,
+            task_type="text_embedding",
+            input=question
+        )
+        return _unit_vector(response["text_embedding"][0]["embedding"])
+
+    async def lookup(self, question, hits):
+        normalized = normalize_question(question)
+        fingerprint = hits_fingerprint(hits)
+        key = hashlib.sha256(f"{normalized}|{fingerprint}".encode()).hexdigest()
+        lookup = CacheLookup(key, normalized, fingerprint)
+
+        try:
+            response = await self.backend.get(key)
+            if response is not None:
+                self.hits_exact += 1
+                lookup.response, lookup.match = response, "exact"
+                return lookup
+
+            if self.embedding_inference_id:
+                lookup.embedding = await self._embed(normalized)
+                response = await self.backend.find_similar(fingerprint, lookup.embedding, self.similarity_threshold)
+                if response is not None:
+                    self.hits_semantic += 1
+                    lookup.response, lookup.match = response, "semantic"
+                    return lookup
+        except Exception as e:
+            # A broken cache must never fail the turn
+            self.errors += 1
+            logger.error("Error in response cache lookup: %s", e)
+
+        self.misses += 1
+        return lookup
+
+    async def store(self, lookup, response):
+        try:
+            await self.backend.put(lookup, response)
+        except Exception as e:
+            self.errors += 1
+            logger.error("Error storing response in cache: %s", e)
+
+    def stats(self):
+        lookups = self.hits_exact + self.hits_semantic + self.misses
+        return {
+            "backend": RESPONSE_CACHE_BACKEND,
+            "hits_exact": self.hits_exact,
+            "hits_semantic": self.hits_semantic,
+            "misses": self.misses,
+            "errors": self.errors,
+            "evictions": self.backend.evictions,
+            "hit_rate": (self.hits_exact + self.hits_semantic) / lookups if lookups else 0.0
+        }
+
+
+def _create_response_cache():
+    if RESPONSE_CACHE_BACKEND == 'none':
+        return None
+    if RESPONSE_CACHE_BACKEND == 'elasticsearch':
+        backend = ElasticsearchCacheBackend(RESPONSE_CACHE_INDEX, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    else:
+        backend = MemoryCacheBackend(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    return ResponseCache(backend, RESPONSE_CACHE_EMBEDDING_INFERENCE_ID, RESPONSE_CACHE_SIMILARITY_THRESHOLD)
+
+
+response_cache = _create_response_cache()
+
+
+async def init_response_cache():
+    """Create backing storage for the cache. Called from the FastAPI startup hook"""
+    if response_cache is not None:
+        await response_cache.backend.setup()
@@ -0,0 +1,107 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Connection pool settings, shared by search_service and inference_service.
+# The aiohttp pool keeps idle connections for aiohttp's default keep-alive, ES_KEEPALIVE_TIMEOUT applies to the
+# httpx stream client
+ES_CONNECTIONS_PER_NODE = int(os.getenv('ES_CONNECTIONS_PER_NODE', '25'))
+ES_KEEPALIVE_TIMEOUT = float(os.getenv('ES_KEEPALIVE_TIMEOUT', '60'))
+ES_MAX_RETRIES = int(os.getenv('ES_MAX_RETRIES', '2'))
+
+# Per-operation timeouts (seconds)
+ES_REQUEST_TIMEOUT = float(os.getenv('ES_REQUEST_TIMEOUT', '30'))
+ES_SEARCH_TIMEOUT = float(os.getenv('ES_SEARCH_TIMEOUT', '10'))
+ES_INFERENCE_TIMEOUT = float(os.getenv('ES_INFERENCE_TIMEOUT', '90'))
+
+_es_client = None
+# elasticsearch-py does not stream response bodies, so the inference _stream API
+# is read through an httpx client sharing the same settings
+_stream_client = None
+
+
+def import_client_modules():
+    """
+    Import the client libraries. elasticsearch, aiohttp and httpx take longer to import than the rest of the app,
+    so they are not imported with this module. The startup warm-up imports them in a worker thread while the
+    server already answers health checks
+    """
+    import httpx
+    from elasticsearch import AsyncElasticsearch
+    from elastic_transport import AiohttpHttpNode
+    return httpx, AsyncElasticsearch, AiohttpHttpNode
+
+
+def init_es_client():
+    """
+    Create the shared AsyncElasticsearch client. Creating it does not connect, connections are opened by the
+    first request. Called by the startup warm-up, or by the first get_es_client() when that comes sooner
+    """
+    global _es_client, _stream_client
+    if _es_client is not None:
+        return _es_client
+    httpx, AsyncElasticsearch, AiohttpHttpNode = import_client_modules()
+
+    es_url = os.getenv('ES_URL', 'http://kubernetes-vm:9200')
+    es_auth = (
+        os.getenv('ES_USER', 'elastic'),
+        os.getenv('ES_PASSWORD', 'changeme')
+    )
+
+    _es_client = AsyncElasticsearch(
+        hosts=es_url,
+        # api_key=os.getenv('ES_API_KEY'),
+        basic_auth=es_auth,
+        node_class=AiohttpHttpNode,
+        connections_per_node=ES_CONNECTIONS_PER_NODE,
+        request_timeout=ES_REQUEST_TIMEOUT,
+        max_retries=ES_MAX_RETRIES,
+        retry_on_timeout=True,
+    )
+    _stream_client = httpx.AsyncClient(
+        base_url=es_url,
+        auth=es_auth,
+        limits=httpx.Limits(
+            max_connections=ES_CONNECTIONS_PER_NODE,
+            keepalive_expiry=ES_KEEPALIVE_TIMEOUT
+        ),
+        timeout=httpx.Timeout(ES_INFERENCE_TIMEOUT, connect=ES_REQUEST_TIMEOUT)
+    )
+    logger.info("Elasticsearch client pool created with %s connections per node", ES_CONNECTIONS_PER_NODE)
+    return _es_client
+
+
+async def close_es_client():
+    """
+    Close the shared client and its connection pool. Called from the FastAPI shutdown hook
+    """
+    global _es_client, _stream_client
+    if _es_client is None:
+        return
+    await _es_client.close()
+    await _stream_client.aclose()
+    _es_client = None
+    _stream_client = None
+    logger.info("Elasticsearch client pool closed")
+
+
+def get_es_client():
+    return _es_client if _es_client is not None else init_es_client()
+
+
+def search_client():
+    """Shared client with the search timeout applied"""
+    return get_es_client().options(request_timeout=ES_SEARCH_TIMEOUT)
+
+
+def inference_client():
+    """Shared client with the inference timeout applied"""
+    return get_es_client().options(request_timeout=ES_INFERENCE_TIMEOUT)
+
+
+def stream_client():
+    """httpx client for streaming Elasticsearch APIs"""
+    if _stream_client is None:
+        init_es_client()
+    return _stream_client
@@ -0,0 +1,95 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Verbose frames a /ws client gets unless it asks for others with ?verbose=... or a settings message:
+#   compact  structured context hit summaries and conversation history deltas
+#   full     the text verbose_info frames: every hit and the whole history on every turn, and the streamed
+#            answer repeated in full_response, as before the compact frames existed
+#   off      no verbose frames
+WS_VERBOSE_DEFAULT = os.getenv('WS_VERBOSE_DEFAULT', 'compact').lower()
+VERBOSE_MODES = ('compact', 'full', 'off')
+# Characters of review text kept per hit in compact context frames
+WS_SNIPPET_CHARS = int(os.getenv('WS_SNIPPET_CHARS', '160'))
+
+
+def snippet(text, limit=WS_SNIPPET_CHARS):
+    text = " ".join((text or "").split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def hit_summary(hit):
+    """What a client shows for one hit: where it comes from, its score and the start of its best chunk"""
+    text = hit.chunks[0].text if hit.chunks else hit.text
+    return {
+        "index": hit.index,
+        "id": hit.id,
+        "score": round(hit.score, 3),
+        "metadata": hit.metadata,
+        "text": snippet(text),
+        "chunks": len(hit.chunks)
+    }
+
+
+class FrameBuilder:
+    """
+    Builds the verbose and final frames of one websocket connection in the mode its client asked for.
+
+    In compact mode the history frame only carries the messages added since the previous one. When the history
+    was rewritten instead (older turns folded into a summary, or the client just switched verbose frames on)
+    it carries the whole history with reset set, and the client replaces its copy
+    """
+
+    def __init__(self, mode=None):
+        self.mode = WS_VERBOSE_DEFAULT
+        # the history the client holds, None when it holds nothing we know of
+        self._sent_history = None
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        mode = (mode or self.mode).lower()
+        if mode not in VERBOSE_MODES:
+            logger.warning("Unknown verbose mode %s, keeping %s", mode, self.mode)
+            return
+        if mode != 'compact':
+            self._sent_history = None
+        self.mode = mode
+
+    def context_frame(self, hits):
+        if self.mode == 'off':
+            return None
+        if self.mode == 'full':
+            tmp_context = "\n\n".join(str(hit) for hit in hits)
+            return {
+                "type": "verbose_info",
+                "text": f"Context gathered from Elasticsearch\n\n{tmp_context}"
+            }
+        return {"type": "context", "hits": [hit_summary(hit) for hit in hits]}
+
+    def response_frame(self, response, streamed=False, **fields):
+        frame = {"type": "full_response", **fields}
+        if streamed:
+            frame["streamed"] = True
+        # a streamed answer has already reached the client as partial_response frames
+        if not streamed or self.mode == 'full':
+            frame["text"] = response
+        return frame
+
+    def history_frame(self, history):
+        if self.mode == 'off':
+            return None
+        if self.mode == 'full':
+            tmp_convo_hist = '\n---------------------------------------------------------\n\n'.join(
+                [str(h) for h in history])
+            return {
+                "type": "verbose_info",
+                "text": f"Conversation history updated:\n\n{tmp_convo_hist}"
+            }
+        sent = self._sent_history
+        self._sent_history = list(history)
+        if sent is not None and history[:len(sent)] == sent:
+            return {"type": "history", "append": history[len(sent):]}
+        return {"type": "history", "reset": True, "messages": history}
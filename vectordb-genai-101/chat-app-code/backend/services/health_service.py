@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from . import cache_service, es_client, session_service
+
+logger = logging.getLogger(__name__)
+
+# Backoff between warm-up attempts while Elasticsearch is unreachable
+STARTUP_RETRY_INITIAL = float(os.getenv('STARTUP_RETRY_INITIAL', '0.5'))
+STARTUP_RETRY_MAX = float(os.getenv('STARTUP_RETRY_MAX', '30'))
+# Once warmed up, /readyz pings Elasticsearch at most this often (seconds) and waits this long for it
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '5'))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', '2'))
+
+_started_at = time.monotonic()
+
+
+class Dependency:
+    """What the last check of one dependency found"""
+
+    def __init__(self, name):
+        self.name = name
+        self.ok = False
+        self.error = "not checked yet"
+        self.attempts = 0
+        self.checked_at = None
+        self.detail = {}
+
+    def succeeded(self, **detail):
+        self.ok = True
+        self.error = None
+        self.detail.update(detail)
+        self.checked_at = time.monotonic()
+
+    def failed(self, error):
+        self.ok = False
+        self.error = str(error) or type(error).__name__
+        self.checked_at = time.monotonic()
+
+    def report(self):
+        report = {"ok": self.ok, "attempts": self.attempts, **self.detail}
+        if self.error:
+            report["error"] = self.error
+        return report
+
+
+elasticsearch = Dependency('elasticsearch')
+response_cache = Dependency('response_cache')
+session_store = Dependency('session_store')
+DEPENDENCIES = (elasticsearch, response_cache, session_store)
+
+_warm_up_task = None
+
+
+async def _until_ok(dependency, check):
+    """Run check until it succeeds, with exponential backoff and jitter between attempts"""
+    backoff = STARTUP_RETRY_INITIAL
+    while True:
+        dependency.attempts += 1
+        try:
+            detail = await check()
+            dependency.succeeded(**(detail or {}))
+            return
+        except Exception as e:
+            dependency.failed(e)
+            logger.warning("%s is not ready (attempt %s): %s, retrying in %.1fs",
+                           dependency.name, dependency.attempts, dependency.error, backoff)
+        await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+        backoff = min(STARTUP_RETRY_MAX, backoff * 2)
+
+
+async def _ping_elasticsearch():
+    info = await es_client.get_es_client().options(request_timeout=HEALTH_CHECK_TIMEOUT).info()
+    return {"cluster": info["cluster_name"], "version": info["version"]["number"]}
+
+
+async def _connect_elasticsearch():
+    # the client libraries are imported off the event loop. Creating the client fails on a malformed ES_URL,
+    # which is retried like an unreachable cluster so /readyz reports it
+    await asyncio.to_thread(es_client.import_client_modules)
+    es_client.init_es_client()
+    return await _ping_elasticsearch()
+
+
+async def warm_up():
+    """
+    Connect to Elasticsearch and set up the storage of the response cache and session store.
+    Runs in the background after startup so the server answers /healthz right away and keeps retrying
+    while Elasticsearch is unreachable instead of failing the worker
+    """
+    started = time.perf_counter()
+    await _until_ok(elasticsearch, _connect_elasticsearch)
+    logger.info("Elasticsearch client Info: %s", elasticsearch.detail)
+
+    async def setup_cache():
+        await cache_service.init_response_cache()
+        cache = cache_service.response_cache
+        return {"backend": "none" if cache is None else type(cache.backend).__name__}
+
+    async def setup_sessions():
+        await session_service.init_session_store()
+        return {"backend": type(session_service.session_store.backend).__name__}
+
+    await asyncio.gather(_until_ok(response_cache, setup_cache), _until_ok(session_store, setup_sessions))
+    logger.info("Warm-up finished in %.2fs", time.perf_counter() - started)
+
+
+def _warm_up_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Warm-up failed, this worker will not become ready", exc_info=task.exception())
+
+
+def start_warm_up():
+    global _warm_up_task
+    _warm_up_task = asyncio.create_task(warm_up())
+    _warm_up_task.add_done_callback(_warm_up_done)
+    return _warm_up_task
+
+
+def stop_warm_up():
+    if _warm_up_task is not None and not _warm_up_task.done():
+        _warm_up_task.cancel()
+
+
+def liveness():
+    """The process is up and its event loop answers, dependencies do not matter here"""
+    return {"status": "ok", "uptime_seconds": round(time.monotonic() - _started_at, 1)}
+
+
+async def readiness():
+    """
+    Whether this worker should get traffic: warm-up finished and Elasticsearch answered a ping recently.
+    :return: (ready, report)
+    """
+    finished = _warm_up_task is not None and _warm_up_task.done() and not _warm_up_task.cancelled()
+    dependencies = {dependency.name: dependency.report() for dependency in DEPENDENCIES}
+    if finished and _warm_up_task.exception() is not None:
+        error = _warm_up_task.exception()
+        return False, {"status": "failed", "error": str(error) or type(error).__name__, "dependencies": dependencies}
+
+    stale = elasticsearch.checked_at is None or time.monotonic() - elasticsearch.checked_at > HEALTH_CHECK_INTERVAL
+    if finished and stale:
+        try:
+            elasticsearch.succeeded(**await _ping_elasticsearch())
+        except Exception as e:
+            elasticsearch.failed(e)
+        dependencies[elasticsearch.name] = elasticsearch.report()
+    ready = finished and all(dependency.ok for dependency in DEPENDENCIES)
+    return ready, {
+        "status": "ready" if ready else "starting" if not finished else "degraded",
+        "dependencies": dependencies
+    }
@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+INDEX_REGISTRY_PATH = os.getenv(
+    'INDEX_REGISTRY_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'indices.json')
+)
+
+
+class IndexConfig:
+    """How to query one index and which of its fields end up in the prompt"""
+
+    __slots__ = ("name", "text_field", "semantic_field", "dense_field", "dense_inference_id", "inner_hits_path",
+                 "metadata_fields")
+
+    def __init__(self, name, text_field, semantic_field, metadata_fields, inner_hits_path=None, dense_field=None,
+                 dense_inference_id=None):
+        self.name = name
+        # raw text used by lexical search and when a hit has no chunks
+        self.text_field = text_field
+        # sparse (ELSER) semantic_text field searched by the semantic strategy
+        self.semantic_field = semantic_field
+        # optional dense (text_embedding) semantic_text field searched by the knn strategy and the inference
+        # endpoint that embeds it. Indices without one are not searched with knn, see python -m backend.ingest --help
+        self.dense_field = dense_field
+        self.dense_inference_id = dense_inference_id
+        # inner_hits name the chunks are returned under
+        self.inner_hits_path = inner_hits_path or f"{name}.{semantic_field}"
+        # fields rendered above every chunk, e.g. Restaurant and Rating
+        self.metadata_fields = list(metadata_fields)
+
+    @property
+    def source_includes(self):
+        return self.metadata_fields + [self.text_field]
+
+
+def load_index_registry(path=INDEX_REGISTRY_PATH):
+    with open(path) as f:
+        config = json.load(f)
+    registry = {name: IndexConfig(name=name, **settings) for name, settings in config.items()}
+    logger.info("Loaded index registry from %s: %s", path, list(registry))
+    return registry
+
+
+index_registry = load_index_registry()
+
+
+def get_index_config(name):
+    config = index_registry.get(name)
+    if config is None:
+        raise ValueError(f"Index {name} is not in the index registry {INDEX_REGISTRY_PATH}")
+    return config
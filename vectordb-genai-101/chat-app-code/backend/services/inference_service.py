@@ -1,41 +1,90 @@
+import json
 import logging
-from elasticsearch import Elasticsearch
 import os
+from backend.logging_config import log_payloads, truncate
+from .es_client import inference_client, stream_client, ES_INFERENCE_TIMEOUT
+from .admission_service import get_limiter
+from .single_flight import SharedStreams, SingleFlight, prompt_key
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+logger = logging.getLogger(__name__)
 
+# Inference endpoint used for chat completions
+COMPLETION_INFERENCE_ID = os.getenv('COMPLETION_INFERENCE_ID', 'openai_chat_completions')
 
-# TODO move this to central location so this and search_service don't create separate connections
-# Initialize the Elasticsearch client
-es_client = Elasticsearch(
-    hosts=os.getenv('ES_URL', 'http://kubernetes-vm:9200'),
-    # api_key=os.getenv('ES_API_KEY'),
-    basic_auth=(
-        os.getenv('ES_USER', 'elastic'),
-        os.getenv('ES_PASSWORD', 'changeme')
-    ),
-    timeout=90
-)
-logging.info(f"Elasticsearch client Info: {es_client.info()}")
+# Max number of undelivered deltas buffered per streamed completion, both between the Elasticsearch stream and
+# its slowest subscriber and between a subscriber and its websocket. When a client is slow its websocket
+# producer waits, the shared stream stops reading from Elasticsearch once that client is this far behind
+STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_SIZE', '64'))
 
+# Identical prompts sent to the same endpoint at the same time share one completion, which then takes
+# one slot of the endpoint's admission limiter
+_completion_flight = SingleFlight('completion')
+_stream_flight = SharedStreams('stream_completion', STREAM_BUFFER_SIZE)
 
-def es_chat_completion(prompt, inference_id):
-    logging.info(f"Starting Elasticsearch chat completion with Inference ID: {inference_id}")
 
-    response = es_client.inference.inference(
-        inference_id = inference_id,
-        task_type = "completion",
-        input = prompt,
-        timeout="90s"
-    )
+async def es_chat_completion(prompt, inference_id):
+    return await _completion_flight.do(prompt_key(prompt, inference_id), lambda: _chat_completion(prompt, inference_id))
 
-    logging.info(f"Response from Elasticsearch chat completion: {response}")
+
+async def _chat_completion(prompt, inference_id):
+    logger.info("Starting Elasticsearch chat completion with Inference ID: %s", inference_id)
+
+    async with get_limiter(inference_id).slot():
+        response = await inference_client().inference.inference(
+            inference_id=inference_id,
+            task_type="completion",
+            input=prompt,
+            timeout=f"{int(ES_INFERENCE_TIMEOUT)}s"
+        )
+
+    if log_payloads(logger):
+        logger.debug("Response from Elasticsearch chat completion: %s", truncate(response))
 
     return response['completion'][0]['result']
 
 
+async def es_stream_completion(prompt, inference_id):
+    """
+    Stream a completion from the Elasticsearch inference _stream API.
+    Yields text deltas as they arrive from the server-sent events
+    :param prompt:
+    :param inference_id:
+    :return: async generator of text deltas
+    """
+    async for delta in _stream_flight.stream(prompt_key(prompt, inference_id),
+                                             lambda: _stream_completion(prompt, inference_id)):
+        yield delta
+
+
+async def _stream_completion(prompt, inference_id):
+    logger.info("Starting Elasticsearch streaming completion with Inference ID: %s", inference_id)
+
+    async with get_limiter(inference_id).slot():
+        async with stream_client().stream(
+            "POST",
+            f"/_inference/completion/{inference_id}/_stream",
+            json={"input": prompt},
+            headers={"Accept": "text/event-stream"}
+        ) as response:
+            if response.status_code >= 400:
+                body = await response.aread()
+                raise RuntimeError(f"Streaming completion failed with status {response.status_code}: {body.decode()}")
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if not data:
+                    continue
+                if data == "[DONE]":
+                    break
+
+                event = json.loads(data)
+                if "error" in event:
+                    raise RuntimeError(f"Streaming completion returned an error: {event['error']}")
+                for chunk in event.get("completion", []):
+                    delta = chunk.get("delta")
+                    if delta:
+                        yield delta
 
+    logger.info("Elasticsearch streaming completion finished")
@@ -1,70 +1,45 @@
+import asyncio
 import logging
-from .inference_service import es_chat_completion
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-
-# TODO - this should not be hardcoded
-index_source_fields = {
-    "restaurant_reviews": [
-        "semantic_body"
-    ]
-}
-
+import os
+from backend.logging_config import log_payloads, truncate
+from .inference_service import es_chat_completion, COMPLETION_INFERENCE_ID
+from .metrics_service import stage
+from .prompt_service import PromptBuilder, PromptChunk, estimate_tokens
+from .session_service import session_store
+
+logger = logging.getLogger(__name__)
+
+# Hard cap on the estimated prompt size, lowest-scoring context chunks are dropped first
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))
+# Summarize older turns once the history is estimated to be over this many tokens
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '1500'))
+# Most recent raw messages that are never summarized (2 user + 2 assistant)
+HISTORY_KEEP_MESSAGES = int(os.getenv('HISTORY_KEEP_MESSAGES', '4'))
+SUMMARY_INFERENCE_ID = os.getenv('SUMMARY_INFERENCE_ID', COMPLETION_INFERENCE_ID)
+
+SUMMARY_PROMPT_TEMPLATE = """
+You are a conversation summarizer specializing in restaurant recommendations, reviews, and related topics. Your task is to create a detailed and accurate summary of the conversation history. This summary will be used as context for future interactions, so ensure it retains all relevant details, especially the specific restaurants discussed, their ratings, and key points mentioned by the user.
 
-def init_conversation_history():
-    # convo = [
-    #     {
-    #         "role": "user",
-    #         "content": "Hi, I have questions about Notary regulations"
-    #     },
-    #     {
-    #         "role": "assistant",
-    #         "content": "Sure, I can help with that. What specific questions do you have?"
-    #     },
-    # ]
-    convo = []
+Rules:
+1. Summarize the entire conversation history provided, including any earlier summary in the "system" role.
+2. Prioritize the restaurants mentioned in the latest user queries and assistant responses. Maintain focus on these restaurants in subsequent interactions.
+3. Ensure that restaurant names, ratings, specific food items, and any notable characteristics (e.g., speed of service, atmosphere, cuisine type) are clearly retained and highlighted in the summary.
+4. Avoid introducing irrelevant details or shifting focus to restaurants not part of the immediate conversation.
+5. Use a structured format optimized for AI processing, keeping relevant information at the forefront. Length may exceed 150 words if necessary to maintain context.
+6. Highlight any unresolved questions or areas that may require further clarification in future interactions.
 
-    return convo
+Current conversation history:
+{history}
 
+Provide your summary in the following format:
+SUMMARY: [Detailed summary focusing on the specific restaurants discussed, their key characteristics, and any user preferences or questions.]
+KEY RESTAURANTS: [List of restaurant names mentioned in the conversation, along with their ratings and any specific details relevant to the user’s queries.]
+RELEVANT DETAILS: [List any specific food items, service attributes, or user preferences mentioned.]
+TOPICS: [List of key topics discussed, such as speed of service, food quality, or atmosphere.]
+UNRESOLVED: [Any open questions or issues that may need further attention.]
+"""
 
-def create_llm_prompt(question, results, conversation_history):
-    """
-    Create a prompt for the LLM based on the question, search results, and conversation history provided
-    :param question:
-    :param results:
-    :param conversation_history:
-    :return:
-    """
-    logging.info("Starting to create LLM prompt")
-    context = ""
-    logging.info(f"Results: {results}")
-    for hit in results:
-        inner_hit_path = f"{hit['_index']}.{index_source_fields.get(hit['_index'])[0]}"
-        logging.info(f"hit: {hit}")
-
-        ## For semantic_text matches, we need to extract the text from the inner_hits
-        if 'inner_hits' in hit and inner_hit_path in hit['inner_hits']:
-            logging.info('inner_hits found')
-            restaurant_name = hit['_source']['Restaurant']
-            restaurant_rating = hit['_source']['Rating']
-            for inner_hit in hit['inner_hits'][inner_hit_path]['hits']['hits']:
-                review = inner_hit['_source']['text']
-
-                context += f"""
-                Restaurant: {restaurant_name}
-                Rating: {restaurant_rating}
-                Review Chunk: {review}
-                """
-        else:
-            source_field = index_source_fields.get(hit["_index"])[0]
-            hit_context = hit["_source"][source_field]
-            context += f"{hit_context}\n"
-
-    prompt = f"""
+PROMPT_INSTRUCTIONS = """
   Instructions:
 
 - You are a helpful and knowledgeable assistant designed to assist users in finding and recommending restaurants based on provided reviews. Your primary goal is to provide accurate, personalized, and relevant restaurant recommendations using semantically matching restaurant reviews.
@@ -102,35 +77,172 @@ Encourage exploration by being enthusiastic and supportive of all user queries a
 - You must always cite the review or data where the recommendation is extracted using inline academic citation style [], using the position.
 - Use markdown format for examples and citations.
 - Be correct, factual, precise, and reliable.
+"""
 
-Conversation History:
-{conversation_history}
- 
-Context:
-{context}
+PROMPT_ANSWER_INSTRUCTIONS = """Answer this question using the context provided and the conversation history. If the user's question is related to a previous question or answer, use the relevant parts of the conversation history to provide a consistent and accurate response.
+If the answer is not in the context, please say "I'm unable to provide a recommendation because the information is not in the context or previously discussed." DO NOT make up an answer."""
 
-The user has a question:
-{question}
+prompt_builder = PromptBuilder(PROMPT_INSTRUCTIONS, PROMPT_ANSWER_INSTRUCTIONS, PROMPT_TOKEN_BUDGET)
 
-Answer this question using the context provided and the conversation history. If the user's question is related to a previous question or answer, use the relevant parts of the conversation history to provide a consistent and accurate response.
-If the answer is not in the context, please say "I'm unable to provide a recommendation because the information is not in the context or previously discussed." DO NOT make up an answer.
 
-   """
+async def init_conversation_history(session_id=None):
+    """
+    Load the conversation history of a session from the session store, or start an empty one
+    :param session_id: client session id, None for a conversation that is not persisted
+    """
+    if session_id:
+        return await session_store.load(session_id)
+    # convo = [
+    #     {
+    #         "role": "user",
+    #         "content": "Hi, I have questions about Notary regulations"
+    #     },
+    #     {
+    #         "role": "assistant",
+    #         "content": "Sure, I can help with that. What specific questions do you have?"
+    #     },
+    # ]
+    convo = []
 
-    logging.info(f"Done creating LLM prompt")
-    logging.info(f"Full Prompt: {prompt}")
-    return prompt
+    return convo
 
 
-def build_conversation_history(history, user_message, ai_response):
+def prompt_chunks(results):
+    """
+    Turn search hits into prompt chunks, one per semantic_text chunk or one per hit for lexical matches.
+    Each chunk is scored by its inner hit score when there is one, else the hit score
+    """
+    chunks = []
+    for hit in results:
+        header = "".join(f"{field}: {value}\n" for field, value in hit.metadata.items())
+        source = (hit.index, hit.id)
+
+        ## For semantic_text matches, the text comes from the inner_hits chunks
+        if hit.chunks:
+            for chunk in hit.chunks:
+                chunks.append(PromptChunk(f"{header}Review Chunk: {chunk.text}", chunk.score or hit.score, len(chunks),
+                                          source))
+        elif hit.text:
+            chunks.append(PromptChunk(f"{header}Review Chunk: {hit.text}", hit.score, len(chunks), source))
+    return chunks
+
+
+def assemble_llm_prompt(question, results, conversation_history, chunks=None):
+    """
+    Build the LLM prompt and a report of the tokens used per section
+    :param question:
+    :param results:
+    :param conversation_history:
+    :param chunks: context chunks to use instead of prompt_chunks(results), e.g. the output of rerank_service
+    :return: PromptResult
+    """
+    if chunks is None:
+        chunks = prompt_chunks(results)
+    result = prompt_builder.build(question, chunks, conversation_history)
+    logger.info("Done creating LLM prompt: %s", result.report)
+    return result
+
+
+def create_llm_prompt(question, results, conversation_history):
+    """
+    Create a prompt for the LLM based on the question, search results, and conversation history provided
+    :param question:
+    :param results:
+    :param conversation_history:
+    :return:
+    """
+    return assemble_llm_prompt(question, results, conversation_history).text
+
+
+class HistorySummarizer:
+    """
+    Summarizes the older part of one session's conversation history in the background.
+    At most one summary job runs per session, turns that arrive while it runs are folded by the next job
+    """
+
+    def __init__(self):
+        # latest finished summary and how many leading raw messages it covers
+        self.summary = None
+        self.folded_count = 0
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def schedule(self, previous_summary, messages):
+        if self.running:
+            logger.info("Summary job already running for this session, coalescing")
+            return
+        self._task = asyncio.create_task(self._summarize(previous_summary, messages))
+
+    async def _summarize(self, previous_summary, messages):
+        history = []
+        if previous_summary:
+            history.append(f"system: {previous_summary}")
+        history.extend(f"{m['role']}: {m['content']}" for m in messages)
+        summary_prompt = SUMMARY_PROMPT_TEMPLATE.format(history="\n".join(history))
+
+        try:
+            with stage('summarization'):
+                summary = await es_chat_completion(summary_prompt, SUMMARY_INFERENCE_ID)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # keep the raw history, the next turn will try again
+            logger.error("Error summarizing conversation history: %s", e)
+            return
+
+        logger.info("Summarized %s history messages", len(messages))
+        if log_payloads(logger):
+            logger.debug("LLM Summary of history: %s", truncate(summary))
+        self.summary = summary
+        self.folded_count = len(messages)
+
+    def apply(self, history):
+        """
+        Replace the messages covered by the latest finished summary with the summary itself
+        """
+        if self.summary is None:
+            return history
+
+        _, raw = _split_history(history)
+        new_history = [{"role": "system", "content": self.summary}] + raw[self.folded_count:]
+        self.summary = None
+        self.folded_count = 0
+        return new_history
+
+    def cancel(self):
+        if self.running:
+            self._task.cancel()
+
+
+def _split_history(history):
+    """Split history into the summary message (or None) and the raw turns after it"""
+    if history and history[0]["role"] == "system":
+        return history[0], history[1:]
+    return None, history
+
+
+def history_tokens(history):
+    return sum(estimate_tokens(m["content"]) for m in history)
+
+
+def apply_conversation_summary(history, summarizer):
+    """Fold in any summary that finished since the last turn"""
+    if summarizer is None:
+        return history
+    return summarizer.apply(history)
+
+
+async def build_conversation_history(history, user_message, ai_response, summarizer=None, session_id=None):
     """
     Function to build converstation history for the LLM
-    Keep 2 messages from the user and 2 messages from the AI
-    When the count of messages from the user and AI each is greater than 2,
-     keep the last 2 messages as is
-     make a call to the LLM to summarize the conversation and keep the summary
+    New turns are appended as is. When the history grows past HISTORY_TOKEN_BUDGET,
+    everything except the last HISTORY_KEEP_MESSAGES raw messages is summarized by a background job,
+    and the summary replaces those messages once the job finishes. The current turn never waits for it.
 
-    Summary is kept in the "system" role
+    Summary is kept in the "system" role. With a session_id the new history is written to the session store
 
     structure
     [
@@ -142,73 +254,32 @@ def build_conversation_history(history, user_message, ai_response):
     ]
     """
 
-    logging.info("Starting to build conversation history function")
-    if len(history) < 4:
-        logging.info("History is less than 4 messages. Adding new messages to history")
-        history.extend([
-            {
-                "role": "user",
-                "content": user_message
-            },
-            {
-                "role": "assistant",
-                "content": ai_response
-            }
-        ])
-        new_history = history
-    else:
-        logging.info("History is greater than 4 messages. Summarizing conversation")
-        summary_prompt = f"""
-You are a conversation summarizer specializing in restaurant recommendations, reviews, and related topics. Your task is to create a detailed and accurate summary of the conversation history, incorporating the new message provided. This summary will be used as context for future interactions, so ensure it retains all relevant details, especially the specific restaurants discussed, their ratings, and key points mentioned by the user.
-
-Rules:
-1. Summarize the entire conversation, including the provided history and the new message.
-2. Prioritize the restaurants mentioned in the latest user queries and assistant responses. Maintain focus on these restaurants in subsequent interactions.
-3. Ensure that restaurant names, ratings, specific food items, and any notable characteristics (e.g., speed of service, atmosphere, cuisine type) are clearly retained and highlighted in the summary.
-4. Avoid introducing irrelevant details or shifting focus to restaurants not part of the immediate conversation.
-5. Use a structured format optimized for AI processing, keeping relevant information at the forefront. Length may exceed 150 words if necessary to maintain context.
-6. Highlight any unresolved questions or areas that may require further clarification in future interactions.
-
-Current conversation history:
-{history}
+    new_history = apply_conversation_summary(history, summarizer)
+    new_history = new_history + [
+        {
+            "role": "user",
+            "content": user_message
+        },
+        {
+            "role": "assistant",
+            "content": ai_response
+        }
+    ]
 
-New User message:
-{user_message}
+    summary_message, raw = _split_history(new_history)
+    if (summarizer is not None
+            and history_tokens(new_history) > HISTORY_TOKEN_BUDGET
+            and len(raw) > HISTORY_KEEP_MESSAGES):
+        logger.info("History is over the token budget. Scheduling background summary")
+        summarizer.schedule(
+            summary_message["content"] if summary_message else None,
+            raw[:-HISTORY_KEEP_MESSAGES]
+        )
 
-New Assistant response:
-{ai_response}
+    if log_payloads(logger):
+        logger.debug("New conversation history: %s", truncate(new_history))
 
-Provide your summary in the following format:
-SUMMARY: [Detailed summary focusing on the specific restaurants discussed, their key characteristics, and any user preferences or questions.]
-KEY RESTAURANTS: [List of restaurant names mentioned in the conversation, along with their ratings and any specific details relevant to the user’s queries.]
-RELEVANT DETAILS: [List any specific food items, service attributes, or user preferences mentioned.]
-TOPICS: [List of key topics discussed, such as speed of service, food quality, or atmosphere.]
-UNRESOLVED: [Any open questions or issues that may need further attention.]
-        """
+    if session_id:
+        await session_store.save(session_id, new_history)
 
-        # call the LLM to summarize the conversation
-        # summary = query_aws_bedrock_nonstreaming(summary_prompt)
-        summary = es_chat_completion(summary_prompt)
-        logging.info(f"LLM Summary of history: {summary}")
-
-        # Build new history
-        new_history = [
-            {
-                "role": "system",
-                "content": summary
-            },
-            history[-2],
-            history[-1],
-            {
-                "role": "user",
-                "content": user_message
-            },
-            {
-                "role": "assistant",
-                "content": ai_response
-            }
-        ]
-
-    logging.info(f"New conversation history: {new_history}")
-
-    return new_history
\ No newline at end of file
+    return new_history
@@ -0,0 +1,157 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# none, apm or otlp. apm uses the APM_* settings, otlp the standard OTEL_EXPORTER_OTLP_* settings
+TRACING_BACKEND = os.getenv('TRACING_BACKEND', 'none').lower()
+
+STAGE_SECONDS = Histogram(
+    'chat_stage_seconds',
+    'Time spent in each stage of a /ws turn',
+    ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 6000, 8000, 16000)
+PROMPT_TOKENS = Histogram('chat_prompt_tokens', 'Estimated tokens per LLM prompt', buckets=TOKEN_BUCKETS)
+RESPONSE_TOKENS = Histogram('chat_response_tokens', 'Estimated tokens per LLM response', buckets=TOKEN_BUCKETS)
+TURNS = Counter('chat_turns_total', 'Completed /ws turns by how the response was produced', ['source'])
+TURN_ERRORS = Counter('chat_turn_errors_total', 'Turns that failed')
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    'chat_llm_queue_wait_seconds',
+    'Time completions waited for a concurrency slot',
+    ['inference_id'],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+LLM_REJECTIONS = Counter('chat_llm_rejections_total', 'Completions shed by admission control', ['inference_id', 'reason'])
+PREFETCHES = Counter(
+    'chat_prefetch_total',
+    'Speculative retrievals by outcome: completed, superseded, and for final messages hit, joined or miss',
+    ['result']
+)
+RERANKS = Counter('chat_rerank_total', 'Rerank calls by backend and result (ok or error)', ['backend', 'result'])
+BATCH_ITEMS = Counter('chat_batch_items_total', 'Batch questions answered, by result (ok or error)', ['result'])
+COALESCED = Counter(
+    'chat_coalesced_calls_total',
+    'Searches and completions that joined an identical in-flight call instead of running their own',
+    ['operation']
+)
+
+_apm_client = None
+_tracer = None
+
+
+class _StatsCollector:
+    """Exposes the cache and session store counters, read at scrape time"""
+
+    def describe(self):
+        # registering would otherwise call collect(), which imports services that may still be importing this module
+        return []
+
+    def collect(self):
+        # imported here, the services import this module
+        from . import admission_service, cache_service, session_service
+
+        active = GaugeMetricFamily('chat_llm_active', 'Completions holding a concurrency slot', labels=['inference_id'])
+        waiting = GaugeMetricFamily('chat_llm_queue_depth', 'Completions waiting for a slot', labels=['inference_id'])
+        for inference_id, limiter in admission_service.limiters.items():
+            active.add_metric([inference_id], limiter.active)
+            waiting.add_metric([inference_id], limiter.waiting)
+        yield active
+        yield waiting
+
+        if cache_service.response_cache is not None:
+            stats = cache_service.response_cache.stats()
+            lookups = GaugeMetricFamily('chat_response_cache_lookups', 'Response cache lookups', labels=['result'])
+            lookups.add_metric(['exact'], stats['hits_exact'])
+            lookups.add_metric(['semantic'], stats['hits_semantic'])
+            lookups.add_metric(['miss'], stats['misses'])
+            yield lookups
+            yield GaugeMetricFamily('chat_response_cache_hit_rate', 'Response cache hit rate', value=stats['hit_rate'])
+            yield GaugeMetricFamily('chat_response_cache_evictions', 'Response cache evictions', value=stats['evictions'])
+
+        stats = session_service.session_store.stats()
+        sessions = GaugeMetricFamily('chat_session_store_operations', 'Session store operations', labels=['operation'])
+        for operation in ('loads', 'misses', 'saves', 'errors'):
+            sessions.add_metric([operation], stats[operation])
+        yield sessions
+
+
+REGISTRY.register(_StatsCollector())
+
+
+def init_tracing(app=None):
+    """Set up the optional span exporter. Called once from main.py"""
+    global _apm_client, _tracer
+    if TRACING_BACKEND == 'apm':
+        from elasticapm.contrib.starlette import make_apm_client, ElasticAPM
+        _apm_client = make_apm_client({
+            'SERVICE_NAME': os.getenv('APM_SERVICE_NAME', 'chat-app'),
+            'API_KEY': os.getenv('APM_API_KEY'),
+            'SERVER_URL': os.getenv('APM_SERVER_URL')
+        })
+        if app is not None:
+            app.add_middleware(ElasticAPM, client=_apm_client)
+        logger.info("Tracing to Elastic APM at %s", os.getenv('APM_SERVER_URL'))
+    elif TRACING_BACKEND == 'otlp':
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.error("TRACING_BACKEND=otlp needs opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http")
+            return
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        _tracer = trace.get_tracer('chat-app')
+        logger.info("Tracing to OTLP")
+
+
+@contextmanager
+def turn_transaction():
+    """One APM transaction per /ws turn, websocket messages get none from the middleware"""
+    if _apm_client is None:
+        yield
+        return
+    _apm_client.begin_transaction('websocket')
+    result = 'success'
+    try:
+        yield
+    except Exception:
+        result = 'failure'
+        raise
+    finally:
+        _apm_client.end_transaction('/ws turn', result)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the turn into chat_stage_seconds, and a span when tracing is on"""
+    start = time.perf_counter()
+    try:
+        if _apm_client is not None:
+            import elasticapm
+            with elasticapm.capture_span(name, span_type='app'):
+                yield
+        elif _tracer is not None:
+            with _tracer.start_as_current_span(name):
+                yield
+        else:
+            yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def observe_stage(name, seconds):
+    """Record a stage timed elsewhere, e.g. time to first token"""
+    STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def metrics_response():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from .cache_service import normalize_question
+from .metrics_service import PREFETCHES
+from .search_service import perform_es_search, SEARCH_INDICES
+
+logger = logging.getLogger(__name__)
+
+# Retrieval started from the partial text clients send while the user types ({"type": "prefetch", ...})
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'true').lower() == 'true'
+# Quiet period after the last keystroke before the search is started
+PREFETCH_DEBOUNCE = float(os.getenv('PREFETCH_DEBOUNCE', '0.3'))
+# Partial text shorter than this is not searched
+PREFETCH_MIN_CHARS = int(os.getenv('PREFETCH_MIN_CHARS', '8'))
+# How long prefetched hits stay usable, and how many are kept per session
+PREFETCH_TTL = float(os.getenv('PREFETCH_TTL', '30'))
+PREFETCH_MAX_ENTRIES = int(os.getenv('PREFETCH_MAX_ENTRIES', '4'))
+# Similarity (0-1) between the normalized final message and the prefetched text for the hits to be reused,
+# 1.0 only reuses exact matches
+PREFETCH_SIMILARITY = float(os.getenv('PREFETCH_SIMILARITY', '0.85'))
+
+
+def similarity(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+class Prefetcher:
+    """
+    Speculative retrieval for one websocket session.
+
+    Every prefetch message replaces the previous one: a search still waiting out the debounce, or still running,
+    is cancelled. Finished searches are kept for a short time, and the final message reuses the hits of the most
+    similar one, or waits for the running search when that one matches
+    """
+
+    def __init__(self):
+        # (normalized text, context_type) -> (finished at, hits)
+        self._results = OrderedDict()
+        self._task = None
+        self._pending = None
+        # whether the pending prefetch is past its debounce and searching
+        self._searching = False
+
+    def schedule(self, text, context_type):
+        if not PREFETCH_ENABLED or len(text.strip()) < PREFETCH_MIN_CHARS:
+            return
+        key = (normalize_question(text), context_type)
+        if key == self._pending or key in self._results:
+            return
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            PREFETCHES.labels('superseded').inc()
+        self._pending = key
+        self._searching = False
+        self._task = asyncio.create_task(self._prefetch(text, key))
+
+    async def _prefetch(self, text, key):
+        await asyncio.sleep(PREFETCH_DEBOUNCE)
+        self._searching = True
+        try:
+            hits = await perform_es_search(text, SEARCH_INDICES, key[1])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the final message searches again
+            logger.warning("Prefetch search failed: %s", e)
+            return None
+        self._results[key] = (time.monotonic(), hits)
+        self._results.move_to_end(key)
+        while len(self._results) > PREFETCH_MAX_ENTRIES:
+            self._results.popitem(last=False)
+        PREFETCHES.labels('completed').inc()
+        return hits
+
+    def _best_match(self, normalized, context_type):
+        now = time.monotonic()
+        best, best_score = None, PREFETCH_SIMILARITY
+        for (text, prefetched_type), (finished_at, hits) in list(self._results.items()):
+            if now - finished_at > PREFETCH_TTL:
+                del self._results[(text, prefetched_type)]
+                continue
+            if prefetched_type != context_type:
+                continue
+            score = 1.0 if text == normalized else similarity(text, normalized)
+            if score >= best_score:
+                best, best_score = hits, score
+        return best
+
+    async def take(self, text, context_type):
+        """
+        Hits prefetched for text, or None when the final message has to be searched.
+        Whatever else is pending is cancelled, the message supersedes it
+        """
+        if not PREFETCH_ENABLED:
+            return None
+        normalized = normalize_question(text)
+        task, pending, searching = self._task, self._pending, self._searching
+        self._task = self._pending = None
+
+        if task is not None and not task.done():
+            # a prefetch still in its debounce has not saved anything yet, the message is searched right away
+            if searching and pending[1] == context_type and similarity(pending[0], normalized) >= PREFETCH_SIMILARITY:
+                try:
+                    # started before the message arrived, waiting for it keeps that head start
+                    hits = await task
+                except asyncio.CancelledError:
+                    if not task.cancelled():
+                        raise
+                    hits = None
+                if hits is not None:
+                    PREFETCHES.labels('joined').inc()
+                    return list(hits)
+            else:
+                task.cancel()
+                PREFETCHES.labels('superseded').inc()
+
+        hits = self._best_match(normalized, context_type)
+        PREFETCHES.labels('hit' if hits is not None else 'miss').inc()
+        return list(hits) if hits is not None else None
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._results.clear()
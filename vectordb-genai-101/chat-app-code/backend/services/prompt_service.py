@@ -13,3 +13,127 @@ def create_prompt(question, results, index_source_fields):
   Answer:
   """
     return prompt
+
+
+def estimate_tokens(text):
+    """Rough token count, about 4 characters per token for English text"""
+    return (len(text) + 3) // 4
+
+
+class PromptChunk:
+    """One piece of retrieved context competing for space in the prompt"""
+
+    __slots__ = ("text", "score", "rank", "source", "retrieval_score")
+
+    def __init__(self, text, score, rank, source=None, retrieval_score=None):
+        self.text = text
+        self.score = score
+        # position in retrieval (or rerank) order, kept chunks are rendered in this order
+        self.rank = rank
+        # (index, id) of the hit the chunk comes from
+        self.source = source
+        # the search score when score has been replaced by a rerank score
+        self.retrieval_score = retrieval_score
+
+    def citation(self, position):
+        citation = {"position": position, "score": round(self.score, 4)}
+        if self.source is not None:
+            citation["index"], citation["id"] = self.source
+        if self.retrieval_score is not None:
+            citation["retrieval_score"] = round(self.retrieval_score, 4)
+        return citation
+
+
+def dedup_chunks(chunks):
+    """
+    Drop repeats of the same chunk text (ignoring case and whitespace), keeping the best-scoring copy.
+    Used by the prompt builder and the reranker so both treat the same chunks as repeats
+    """
+    unique = {}
+    for chunk in chunks:
+        key = " ".join(chunk.text.split()).lower()
+        if key not in unique or chunk.score > unique[key].score:
+            unique[key] = chunk
+    return list(unique.values())
+
+
+class PromptResult:
+    __slots__ = ("text", "report", "citations")
+
+    def __init__(self, text, report, citations=()):
+        self.text = text
+        # tokens used per section and what happened to the context chunks
+        self.report = report
+        # the chunk behind each [position] in the prompt, with its scores
+        self.citations = citations
+
+
+class PromptBuilder:
+    """
+    Assembles prompts from a static instruction block, the conversation history, retrieved chunks and the question
+    under a hard token budget.
+
+    The instruction and answer blocks are fixed when the builder is created so their token cost is computed once.
+    Repeated chunks are dropped, then the lowest-scoring chunks are dropped until the prompt fits the budget.
+    Oldest history messages are trimmed only when the fixed sections alone do not fit.
+    """
+
+    def __init__(self, instructions, answer_instructions, token_budget):
+        self.head = f"{instructions}\n\nConversation History:\n"
+        self.context_header = "\n\nContext:\n"
+        self.question_header = "\n\nThe user has a question:\n"
+        self.tail = f"\n\n{answer_instructions}\n"
+        self.token_budget = token_budget
+        self.instruction_tokens = estimate_tokens(self.head + self.context_header + self.question_header + self.tail)
+
+    @staticmethod
+    def render_history(conversation_history):
+        return "\n".join(f"{m['role']}: {m['content']}" for m in conversation_history)
+
+    def build(self, question, chunks, conversation_history):
+        question_tokens = estimate_tokens(question)
+
+        # Trim the oldest raw turns if history alone would blow the budget, the summary is kept
+        history = list(conversation_history)
+        history_text = self.render_history(history)
+        history_tokens = estimate_tokens(history_text)
+        history_dropped = 0
+        while history and self.instruction_tokens + question_tokens + history_tokens > self.token_budget:
+            drop_at = 1 if history[0]["role"] == "system" and len(history) > 1 else 0
+            history.pop(drop_at)
+            history_dropped += 1
+            history_text = self.render_history(history)
+            history_tokens = estimate_tokens(history_text)
+
+        # Drop exact repeats of the same review chunk, keeping the best-scoring copy
+        unique = dedup_chunks(chunks)
+        deduplicated = len(chunks) - len(unique)
+
+        # Fill the remaining budget with the best-scoring chunks
+        remaining = self.token_budget - self.instruction_tokens - question_tokens - history_tokens
+        kept = []
+        context_tokens = 0
+        for chunk in sorted(unique, key=lambda c: c.score, reverse=True):
+            chunk_tokens = estimate_tokens(chunk.text) + 1
+            if context_tokens + chunk_tokens > remaining:
+                continue
+            kept.append(chunk)
+            context_tokens += chunk_tokens
+        kept.sort(key=lambda c: c.rank)
+
+        context = "\n".join(f"[{position}] {chunk.text}" for position, chunk in enumerate(kept, start=1))
+        text = "".join((self.head, history_text, self.context_header, context, self.question_header, question, self.tail))
+
+        report = {
+            "instructions": self.instruction_tokens,
+            "history": history_tokens,
+            "context": context_tokens,
+            "question": question_tokens,
+            "total": self.instruction_tokens + history_tokens + context_tokens + question_tokens,
+            "budget": self.token_budget,
+            "chunks_used": len(kept),
+            "chunks_dropped": len(unique) - len(kept),
+            "chunks_deduplicated": deduplicated,
+            "history_messages_dropped": history_dropped
+        }
+        return PromptResult(text, report, [chunk.citation(position) for position, chunk in enumerate(kept, start=1)])
@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from .es_client import inference_client
+from .metrics_service import RERANKS
+from .prompt_service import PromptChunk, dedup_chunks, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# none, elasticsearch (a rerank inference endpoint) or local (lexical scorer in the app)
+RERANK_BACKEND = os.getenv('RERANK_BACKEND', 'none').lower()
+# rerank inference endpoint used by the elasticsearch backend, e.g. an Elastic Rerank or Cohere endpoint
+RERANK_INFERENCE_ID = os.getenv('RERANK_INFERENCE_ID', 'my-rerank-endpoint')
+# Seconds to wait for the endpoint before the chunks are used in retrieval order
+RERANK_TIMEOUT = float(os.getenv('RERANK_TIMEOUT', '5'))
+# Chunks reranked per question, best retrieval scores first. Retrieval should return more than RERANK_TOP_N,
+# see SEARCH_SIZE and SEARCH_INNER_HITS_SIZE
+RERANK_WINDOW = int(os.getenv('RERANK_WINDOW', '40'))
+# Chunks kept after reranking and the most context tokens they may take
+RERANK_TOP_N = int(os.getenv('RERANK_TOP_N', '8'))
+RERANK_TOKEN_BUDGET = int(os.getenv('RERANK_TOKEN_BUDGET', '2000'))
+# local backend: weight of the lexical score, the rest is the normalized retrieval score
+RERANK_LOCAL_WEIGHT = float(os.getenv('RERANK_LOCAL_WEIGHT', '0.5'))
+
+
+def _tokens(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def _min_max(scores):
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [1.0 for _ in scores]
+    return [(score - low) / (high - low) for score in scores]
+
+
+class ElasticsearchReranker:
+    """Scores chunks with a rerank task inference endpoint, usually a cross-encoder"""
+
+    name = 'elasticsearch'
+
+    def __init__(self, inference_id, timeout):
+        self.inference_id = inference_id
+        self.timeout = timeout
+
+    async def scores(self, question, chunks):
+        response = await inference_client().options(request_timeout=self.timeout).inference.inference(
+            inference_id=self.inference_id,
+            task_type="rerank",
+            query=question,
+            input=[chunk.text for chunk in chunks]
+        )
+        scores = [0.0] * len(chunks)
+        for item in response["rerank"]:
+            scores[item["index"]] = item.get("relevance_score", item.get("score", 0.0))
+        return scores
+
+
+class LocalReranker:
+    """
+    BM25 of the question against the candidate chunks, blended with their normalized retrieval score.
+    No model and no network call, it promotes chunks that share rare words with the question (dish and
+    restaurant names) over ones that only matched semantically
+    """
+
+    name = 'local'
+
+    def __init__(self, lexical_weight, k1=1.2, b=0.75):
+        self.lexical_weight = lexical_weight
+        self.k1 = k1
+        self.b = b
+
+    async def scores(self, question, chunks):
+        documents = [Counter(_tokens(chunk.text)) for chunk in chunks]
+        lengths = [sum(document.values()) for document in documents]
+        average_length = sum(lengths) / len(lengths) or 1
+        terms = set(_tokens(question))
+        document_frequency = {term: sum(1 for document in documents if term in document) for term in terms}
+
+        lexical = []
+        for document, length in zip(documents, lengths):
+            score = 0.0
+            for term in terms:
+                frequency = document.get(term, 0)
+                if not frequency:
+                    continue
+                idf = math.log(1 + (len(documents) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                score += idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+            lexical.append(score)
+
+        retrieval = _min_max([chunk.score for chunk in chunks])
+        lexical = _min_max(lexical)
+        return [self.lexical_weight * lex + (1 - self.lexical_weight) * ret for lex, ret in zip(lexical, retrieval)]
+
+
+def _create_reranker():
+    if RERANK_BACKEND == 'elasticsearch':
+        return ElasticsearchReranker(RERANK_INFERENCE_ID, RERANK_TIMEOUT)
+    if RERANK_BACKEND == 'local':
+        return LocalReranker(RERANK_LOCAL_WEIGHT)
+    return None
+
+
+reranker = _create_reranker()
+
+
+async def rerank(question, chunks):
+    """
+    Rerank prompt chunks for question and keep the best RERANK_TOP_N that fit RERANK_TOKEN_BUDGET.
+    The kept chunks carry the rerank score and their retrieval score, and are ordered by rerank score.
+    Without a reranker, or when it fails, the chunks are returned unchanged
+    :param question:
+    :param chunks: PromptChunks, see llm_service.prompt_chunks
+    :return: PromptChunks
+    """
+    if reranker is None or not chunks:
+        return chunks
+
+    # repeats of the same review chunk would take several of the top N places
+    window = sorted(dedup_chunks(chunks), key=lambda c: c.score, reverse=True)[:RERANK_WINDOW]
+
+    started = time.perf_counter()
+    try:
+        scores = await reranker.scores(question, window)
+    except Exception as e:
+        RERANKS.labels(reranker.name, 'error').inc()
+        logger.warning("Rerank with %s failed, using retrieval order: %s", reranker.name, e)
+        return chunks
+
+    kept = []
+    context_tokens = 0
+    for score, chunk in sorted(zip(scores, window), key=lambda pair: pair[0], reverse=True):
+        if len(kept) == RERANK_TOP_N:
+            break
+        chunk_tokens = estimate_tokens(chunk.text) + 1
+        if context_tokens + chunk_tokens > RERANK_TOKEN_BUDGET:
+            continue
+        kept.append(PromptChunk(chunk.text, score, len(kept), chunk.source, chunk.score))
+        context_tokens += chunk_tokens
+
+    RERANKS.labels(reranker.name, 'ok').inc()
+    logger.info("Reranked %s of %s chunks with %s in %.1f ms, kept %s using %s tokens",
+                len(window), len(chunks), reranker.name, (time.perf_counter() - started) * 1000,
+                len(kept), context_tokens)
+    return kept
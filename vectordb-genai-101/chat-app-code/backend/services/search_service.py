@@ -1,46 +1,391 @@
-from elasticsearch import Elasticsearch
+import asyncio
 import logging
 import os
+from backend.models.search_models import SearchHit, ReviewChunk
+from .es_client import search_client
+from .index_registry import index_registry, get_index_config
+from .single_flight import SingleFlight
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-
-# Initialize the Elasticsearch client
-es_client = Elasticsearch(
-    hosts=os.getenv('ES_URL', 'http://kubernetes-vm:9200'),
-    # api_key=os.getenv('ES_API_KEY')
-    basic_auth=(
-        os.getenv('ES_USER', 'elastic'),
-        os.getenv('ES_PASSWORD', 'changeme')
+logger = logging.getLogger(__name__)
+
+# Comma separated indices searched per request, defaults to every index in the registry
+SEARCH_INDICES = [i for i in os.getenv('SEARCH_INDICES', ','.join(index_registry)).split(',') if i]
+# Strategy used when the client does not send a known context_type
+DEFAULT_STRATEGY = os.getenv('SEARCH_STRATEGY', 'semantic')
+
+# Inference endpoint backing semantic_body, see the workshop notebooks. The knn strategy uses the dense_inference_id
+# of each index in the registry
+SEMANTIC_INFERENCE_ID = os.getenv('SEMANTIC_INFERENCE_ID', 'my-elser-endpoint')
+
+
+# Only the parts of the response that become SearchHits are sent back by Elasticsearch
+HIT_FILTER_PATH = [
+    "hits.hits._index",
+    "hits.hits._id",
+    "hits.hits._score",
+    "hits.hits._source",
+    "hits.hits.inner_hits.*.hits.hits._score",
+    "hits.hits.inner_hits.*.hits.hits._source.text"
+]
+MSEARCH_FILTER_PATH = ["responses.error"] + [f"responses.{path}" for path in HIT_FILTER_PATH]
+
+
+def to_search_hit(hit, config):
+    """Convert a filtered raw hit into a SearchHit using the index's registry entry"""
+    source = hit.get("_source", {})
+    chunks = ()
+    inner_hits = hit.get("inner_hits", {}).get(config.inner_hits_path)
+    if inner_hits:
+        chunks = tuple(
+            ReviewChunk(inner_hit["_source"]["text"], inner_hit.get("_score") or 0.0)
+            for inner_hit in inner_hits["hits"].get("hits", [])
+        )
+    return SearchHit(
+        index=hit["_index"],
+        id=hit["_id"],
+        score=hit.get("_score") or 0.0,
+        metadata={field: source[field] for field in config.metadata_fields if field in source},
+        text=source.get(config.text_field),
+        chunks=chunks
     )
-)
 
 
-def perform_es_search(query, index):
-    """Performs the Elasticsearch query based on the context type."""
-    logging.info(f"Starting Elasticsearch search for query: {query}")
+def _response_hits(response, config):
+    # filter_path drops the hits key entirely when nothing matched
+    return [to_search_hit(hit, config) for hit in response.get("hits", {}).get("hits", [])]
+
+
+def _setting(strategy, name, default):
+    """SEARCH_<STRATEGY>_<NAME> overrides SEARCH_<NAME> which overrides the default"""
+    value = os.getenv(f"SEARCH_{strategy.upper()}_{name}", os.getenv(f"SEARCH_{name}", default))
+    return type(default)(value)
+
+
+class RetrievalStrategy:
+    """
+    A named way of querying an index, selected by SearchQuery.context_type.
+    Field names come from the index's registry entry.
+    Every strategy only asks for the fields the prompt reads, so full documents and embeddings never leave Elasticsearch
+    """
+
+    name = None
+
+    def __init__(self):
+        self.size = _setting(self.name, 'SIZE', 5)
+        self.num_candidates = _setting(self.name, 'NUM_CANDIDATES', 50)
+        self.inner_hits_size = _setting(self.name, 'INNER_HITS_SIZE', 2)
+
+    def supports(self, config):
+        """Whether the index has the fields this strategy queries"""
+        return True
+
+    def source_includes(self, config):
+        # chunk text comes from the inner hits
+        return config.metadata_fields
+
+    def inner_hits(self, config, field=None):
+        return {
+            "size": self.inner_hits_size,
+            "name": config.inner_hits_path,
+            "_source": [f"{field or config.semantic_field}.inference.chunks.text"]
+        }
+
+    def build(self, query, config):
+        raise NotImplementedError
+
+    def searches(self, query, config):
+        """Request bodies sent for query in an msearch, see perform_es_msearch"""
+        return [self.build(query, config)]
+
+    def hits(self, responses, config):
+        """SearchHits from the msearch responses to searches()"""
+        return _response_hits(responses[0], config)
+
+    async def search(self, query, config):
+        result = await search_client().search(
+            index=config.name,
+            body=self.build(query, config),
+            filter_path=HIT_FILTER_PATH
+        )
+        return _response_hits(result, config)
+
+
+class BM25Strategy(RetrievalStrategy):
+    """Lexical match on the raw review text"""
+
+    name = 'bm25'
+
+    def source_includes(self, config):
+        return config.source_includes
+
+    def build(self, query, config):
+        return {
+            "size": self.size,
+            "_source": {"includes": self.source_includes(config)},
+            "query": {
+                "match": {
+                    config.text_field: query
+                }
+            }
+        }
+
+
+class SemanticStrategy(RetrievalStrategy):
+    """Sparse (ELSER) match on the semantic_body chunks, best chunks returned as inner hits"""
+
+    name = 'semantic'
+
+    def build(self, query, config):
+        return {
+            "size": self.size,
+            "_source": {"includes": self.source_includes(config)},
+            "query": {
+                "nested": {
+                    "path": f"{config.semantic_field}.inference.chunks",
+                    "query": {
+                        "sparse_vector": {
+                            "inference_id": SEMANTIC_INFERENCE_ID,
+                            "field": f"{config.semantic_field}.inference.chunks.embeddings",
+                            "query": query
+                        }
+                    },
+                    "inner_hits": self.inner_hits(config)
+                }
+            }
+        }
+
+
+class KnnStrategy(RetrievalStrategy):
+    """Dense vector kNN on the chunk embeddings of the index's dense_field"""
 
-## TODO USERS ENTER QUERY CODE HERE
-    es_query = {
+    name = 'knn'
 
-    }
+    def supports(self, config):
+        return bool(config.dense_field and config.dense_inference_id)
 
+    def build(self, query, config):
+        return {
+            "size": self.size,
+            "_source": {"includes": self.source_includes(config)},
+            "knn": {
+                "field": f"{config.dense_field}.inference.chunks.embeddings",
+                "query_vector_builder": {
+                    "text_embedding": {
+                        "model_id": config.dense_inference_id,
+                        "model_text": query
+                    }
+                },
+                "k": self.size,
+                "num_candidates": self.num_candidates,
+                "inner_hits": self.inner_hits(config, config.dense_field)
+            }
+        }
 
-    try:
-        result = es_client.search(index="restaurant_reviews", body=es_query)
 
-    except Exception as e:
-        # If generated query fails fallback to backup query
-        logging.error(f"Error in Elasticsearch search: {str(e)}")
-        raise
+class HybridStrategy(RetrievalStrategy):
+    """
+    BM25 and semantic retrieval fused with reciprocal rank fusion.
+    Both legs go out in one msearch and are fused here, which keeps the semantic inner hits
+    and does not need the rrf retriever license
+    """
 
-    # logging.info(f"elasticsearch results: {result}")
-    hits = result["hits"]["hits"]
-    logging.info(f"number of hits: {len(hits)}")
+    name = 'hybrid'
+
+    def __init__(self, lexical, semantic):
+        super().__init__()
+        self.lexical = lexical
+        self.semantic = semantic
+        self.rank_constant = _setting(self.name, 'RANK_CONSTANT', 60)
+        # each leg fetches this many hits before fusion
+        self.rank_window_size = _setting(self.name, 'RANK_WINDOW_SIZE', 20)
+
+    def _leg(self, strategy, query, config):
+        body = strategy.build(query, config)
+        body["size"] = self.rank_window_size
+        return body
+
+    def searches(self, query, config):
+        return [self._leg(self.lexical, query, config), self._leg(self.semantic, query, config)]
+
+    async def search(self, query, config):
+        bodies = self.searches(query, config)
+        result = await search_client().msearch(
+            searches=[line for body in bodies for line in ({"index": config.name}, body)],
+            filter_path=MSEARCH_FILTER_PATH
+        )
+        return self.hits(result["responses"], config)
+
+    def hits(self, responses, config):
+        fused = {}
+        for response in responses:
+            if "error" in response:
+                raise RuntimeError(f"Hybrid search leg failed: {response['error']}")
+            for rank, hit in enumerate(_response_hits(response, config), start=1):
+                key = (hit.index, hit.id)
+                entry = fused.setdefault(key, {"hit": hit, "score": 0.0})
+                entry["score"] += 1.0 / (self.rank_constant + rank)
+                # prefer the copy carrying the semantic chunks
+                if hit.chunks:
+                    entry["hit"] = hit
+
+        ranked = sorted(fused.values(), key=lambda e: e["score"], reverse=True)[:self.size]
+        return [entry["hit"]._replace(score=entry["score"]) for entry in ranked]
+
+
+_bm25 = BM25Strategy()
+_semantic = SemanticStrategy()
+STRATEGIES = {
+    _bm25.name: _bm25,
+    _semantic.name: _semantic,
+    KnnStrategy.name: KnnStrategy(),
+    HybridStrategy.name: HybridStrategy(_bm25, _semantic)
+}
+
+
+def get_strategy(context_type):
+    """The strategy named by context_type, clients that send none get DEFAULT_STRATEGY"""
+    if not context_type:
+        return STRATEGIES[DEFAULT_STRATEGY]
+    strategy = STRATEGIES.get(context_type.lower())
+    if strategy is None:
+        logger.warning("Unknown context_type %s, using %s", context_type, DEFAULT_STRATEGY)
+        strategy = STRATEGIES[DEFAULT_STRATEGY]
+    return strategy
+
+
+def _supported(strategy, configs):
+    """
+    The indices strategy can search, knn only runs on indices with a dense_field.
+    When none of them can, the default strategy searches all of them
+    """
+    supported = [config for config in configs if strategy.supports(config)]
+    if len(supported) < len(configs):
+        logger.info("Skipping %s for %s search, see the index registry",
+                    [config.name for config in configs if config not in supported], strategy.name)
+    if supported:
+        return strategy, supported
+    logger.warning("No index supports %s search, using %s", strategy.name, DEFAULT_STRATEGY)
+    return STRATEGIES[DEFAULT_STRATEGY], configs
+
+
+def _normalize_scores(hits):
+    """Min-max normalize scores so hits from different indices are comparable"""
+    if not hits:
+        return hits
+    scores = [hit.score for hit in hits]
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [hit._replace(score=1.0) for hit in hits]
+    return [hit._replace(score=(hit.score - low) / (high - low)) for hit in hits]
+
+
+def _resolve_indices(index):
+    """Registry entries of index: one index name, comma separated names, a list of names or None for SEARCH_INDICES"""
+    if index is None:
+        indices = SEARCH_INDICES
+    elif isinstance(index, str):
+        indices = index.split(",")
+    else:
+        indices = list(index)
+    return [get_index_config(name) for name in indices]
+
+
+_search_flight = SingleFlight('search')
+
+
+async def perform_es_search(query, index=None, context_type=None):
+    """
+    Performs the Elasticsearch query based on the context type.
+    index may be one index name, a list of names or None for SEARCH_INDICES. Several indices are searched
+    concurrently and merged by normalized score.
+    Identical searches running at the same time (same query text, indices and strategy) share one request
+    """
+    strategy, configs = _supported(get_strategy(context_type), _resolve_indices(index))
+    key = (" ".join(query.split()), tuple(config.name for config in configs), strategy.name)
+    hits = await _search_flight.do(key, lambda: _search(query, configs, strategy))
+    # every caller gets its own list, the hits themselves are immutable
+    return list(hits)
+
+
+async def _search(query, configs, strategy):
+    logger.info("Starting Elasticsearch %s search on %s for query: %s",
+                strategy.name, [config.name for config in configs], query)
+
+    if len(configs) == 1:
+        try:
+            hits = await strategy.search(query, configs[0])
+        except Exception as e:
+            logger.error("Error in Elasticsearch search: %s", e)
+            raise
+        logger.info("number of hits: %s", len(hits))
+        return hits
+
+    results = await asyncio.gather(
+        *(strategy.search(query, config) for config in configs),
+        return_exceptions=True
+    )
+
+    hits = _merge_results(configs, results, strategy)
+    logger.info("number of hits: %s", len(hits))
     return hits
 
 
+def _merge_results(configs, results, strategy):
+    """Merge the hits (or exceptions) of each index by normalized score, raises when every index failed"""
+    if len(configs) == 1:
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0]
+    merged = []
+    errors = []
+    for config, result in zip(configs, results):
+        if isinstance(result, Exception):
+            # one corpus failing should not take the others down
+            logger.error("Error in Elasticsearch search on %s: %s", config.name, result)
+            errors.append(result)
+            continue
+        merged.extend(_normalize_scores(result))
+    if len(errors) == len(configs):
+        raise errors[0]
+    return sorted(merged, key=lambda hit: hit.score, reverse=True)[:strategy.size]
+
+
+async def perform_es_msearch(queries, index=None, context_type=None):
+    """
+    Search many queries in one msearch request, for batch jobs.
+    Returns one entry per query in order: its hits, merged across indices like perform_es_search, or the
+    exception when its search failed. A failing query does not fail the others
+    """
+    strategy, configs = _supported(get_strategy(context_type), _resolve_indices(index))
+
+    # one slice of the msearch body per (query, index), the hybrid strategy sends two searches per slice
+    searches = []
+    plan = []
+    for query in queries:
+        slices = []
+        for config in configs:
+            bodies = strategy.searches(query, config)
+            slices.append((config, len(bodies)))
+            for body in bodies:
+                searches.extend(({"index": config.name}, body))
+        plan.append(slices)
+    logger.info("Starting Elasticsearch %s msearch on %s for %s queries",
+                strategy.name, [config.name for config in configs], len(queries))
+    result = await search_client().msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH)
+    responses = iter(result["responses"])
+
+    outcomes = []
+    for slices in plan:
+        results = []
+        for config, count in slices:
+            part = [next(responses) for _ in range(count)]
+            errors = [response["error"] for response in part if "error" in response]
+            if errors:
+                results.append(RuntimeError(f"Search on {config.name} failed: {errors[0]}"))
+            else:
+                results.append(strategy.hits(part, config))
+        try:
+            outcomes.append(_merge_results(configs, results, strategy))
+        except Exception as e:
+            outcomes.append(e)
+    return outcomes
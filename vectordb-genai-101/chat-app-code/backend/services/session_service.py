@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from .es_client import get_es_client
+from .ttl_store import TTLMap, delete_expired
+
+logger = logging.getLogger(__name__)
+
+# memory, sqlite or elasticsearch. memory only survives reconnects to the same worker
+SESSION_STORE_BACKEND = os.getenv('SESSION_STORE_BACKEND', 'memory').lower()
+# Sessions idle for longer than this are dropped
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '1000'))
+SESSION_SQLITE_PATH = os.getenv('SESSION_SQLITE_PATH', 'chat_sessions.db')
+SESSION_INDEX = os.getenv('SESSION_INDEX', 'chat_sessions')
+
+# Roles are stored as one letter to keep serialized sessions small
+_ROLE_CODES = {"system": "s", "user": "u", "assistant": "a"}
+_ROLE_NAMES = {code: role for role, code in _ROLE_CODES.items()}
+
+
+def encode_history(history):
+    """Serialize a conversation history as compact JSON: [["u", "question"], ["a", "answer"], ...]"""
+    return json.dumps(
+        [[_ROLE_CODES.get(m["role"], m["role"]), m["content"]] for m in history],
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+
+
+def decode_history(data):
+    return [{"role": _ROLE_NAMES.get(role, role), "content": content} for role, content in json.loads(data)]
+
+
+class MemorySessionBackend:
+    """In-process LRU of serialized sessions with idle TTL. Each worker holds its own copy"""
+
+    def __init__(self, max_entries, ttl):
+        self.entries = TTLMap(max_entries, ttl)
+
+    @property
+    def evictions(self):
+        return self.entries.evictions
+
+    async def setup(self):
+        pass
+
+    async def get(self, session_id):
+        return self.entries.get(session_id)
+
+    async def put(self, session_id, data):
+        self.entries.put(session_id, data)
+
+    async def delete(self, session_id):
+        self.entries.pop(session_id)
+
+
+class SqliteSessionBackend:
+    """
+    Sessions in a SQLite file, shared by every worker on the host.
+    sqlite3 is blocking so each call runs in a worker thread
+    """
+
+    # Delete expired sessions every N writes rather than on every write
+    TRIM_EVERY = 50
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.evictions = 0
+        self.writes = 0
+
+    @contextmanager
+    def _connect(self):
+        """A connection for one call: commits (or rolls back) its transaction, then closes"""
+        with closing(sqlite3.connect(self.path, timeout=10)) as connection, connection:
+            yield connection
+
+    def _setup(self):
+        with self._connect() as connection:
+            # WAL lets readers in other workers proceed while one worker writes, it is stored in the database file
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _get(self, session_id):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT data FROM sessions WHERE id = ? AND expires_at > ?", (session_id, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def _put(self, session_id, data, trim):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, data, time.time() + self.ttl)
+            )
+            if trim:
+                return connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+        return 0
+
+    def _delete(self, session_id):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def setup(self):
+        await asyncio.to_thread(self._setup)
+        logger.info("Session store is using %s", self.path)
+
+    async def get(self, session_id):
+        return await asyncio.to_thread(self._get, session_id)
+
+    async def put(self, session_id, data):
+        self.writes += 1
+        self.evictions += await asyncio.to_thread(self._put, session_id, data, self.writes % self.TRIM_EVERY == 0)
+
+    async def delete(self, session_id):
+        await asyncio.to_thread(self._delete, session_id)
+
+
+class ElasticsearchSessionBackend:
+    """Sessions stored in an Elasticsearch index so workers on any host share them"""
+
+    TRIM_EVERY = 50
+
+    def __init__(self, index, ttl):
+        self.index = index
+        self.ttl = ttl
+        self.evictions = 0
+        self.writes = 0
+
+    async def setup(self):
+        es = get_es_client()
+        if await es.indices.exists(index=self.index):
+            return
+        await es.indices.create(
+            index=self.index,
+            mappings={
+                "dynamic": False,
+                "properties": {
+                    "data": {"type": "text", "index": False},
+                    "expires_at": {"type": "date"}
+                }
+            }
+        )
+        logger.info("Created session index %s", self.index)
+
+    async def get(self, session_id):
+        response = await get_es_client().options(ignore_status=404).get(index=self.index, id=session_id)
+        if not response.get("found"):
+            return None
+        source = response["_source"]
+        if datetime.fromisoformat(source["expires_at"]) < datetime.now(timezone.utc):
+            return None
+        return source["data"]
+
+    async def put(self, session_id, data):
+        expires_at = datetime.fromtimestamp(time.time() + self.ttl, timezone.utc)
+        await get_es_client().index(
+            index=self.index,
+            id=session_id,
+            document={"data": data, "expires_at": expires_at.isoformat()}
+        )
+        self.writes += 1
+        if self.writes % self.TRIM_EVERY == 0:
+            self.evictions += await delete_expired(self.index)
+
+    async def delete(self, session_id):
+        await get_es_client().options(ignore_status=404).delete(index=self.index, id=session_id)
+
+
+class SessionStore:
+    """
+    Conversation histories keyed by a client session id.
+    Histories are only loaded when a session sends its first message, and a store failure falls back
+    to an empty history rather than failing the turn
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.loads = 0
+        self.misses = 0
+        self.saves = 0
+        self.errors = 0
+
+    async def load(self, session_id):
+        try:
+            data = await self.backend.get(session_id)
+        except Exception as e:
+            self.errors += 1
+            logger.error("Error loading session %s: %s", session_id, e)
+            return []
+        if data is None:
+            self.misses += 1
+            return []
+        self.loads += 1
+        return decode_history(data)
+
+    async def save(self, session_id, history):
+        try:
+            await self.backend.put(session_id, encode_history(history))
+            self.saves += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error("Error saving session %s: %s", session_id, e)
+
+    async def delete(self, session_id):
+        await self.backend.delete(session_id)
+
+    def stats(self):
+        return {
+            "backend": SESSION_STORE_BACKEND,
+            "loads": self.loads,
+            "misses": self.misses,
+            "saves": self.saves,
+            "errors": self.errors,
+            "evictions": self.backend.evictions
+        }
+
+
+def _create_session_store():
+    if SESSION_STORE_BACKEND == 'elasticsearch':
+        backend = ElasticsearchSessionBackend(SESSION_INDEX, SESSION_TTL)
+    elif SESSION_STORE_BACKEND == 'sqlite':
+        backend = SqliteSessionBackend(SESSION_SQLITE_PATH, SESSION_TTL)
+    else:
+        backend = MemorySessionBackend(SESSION_MAX_ENTRIES, SESSION_TTL)
+    return SessionStore(backend)
+
+
+session_store = _create_session_store()
+
+
+async def init_session_store():
+    """Create backing storage for sessions. Called from the FastAPI startup hook"""
+    await session_store.backend.setup()
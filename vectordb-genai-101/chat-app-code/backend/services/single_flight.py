@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import logging
+import os
+from .metrics_service import COALESCED
+
+logger = logging.getLogger(__name__)
+
+# Share one in-flight search or completion between concurrent identical requests
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+
+
+def prompt_key(prompt, inference_id):
+    return inference_id, hashlib.sha256(prompt.encode()).hexdigest()
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time, concurrent callers with the same key await the same task.
+
+    The call runs in its own task so a caller going away (a closed websocket cancels its turn) does not fail
+    the others; it is cancelled only when every caller waiting for it is gone. Errors reach every caller.
+    Nothing is kept once the call finishes, later callers start a new one
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, call):
+        """Await call() unless an identical call is in flight, then await that one"""
+        if not SINGLE_FLIGHT_ENABLED:
+            return await call()
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.create_task(call())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is entry else None)
+        else:
+            COALESCED.labels(self.name).inc()
+            logger.debug("Joined in-flight %s call", self.name)
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                task.cancel()
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+class _SharedStream:
+    """
+    One upstream stream read into a buffer, every subscriber replays it from the start and then follows it.
+    The upstream is read at most max_lag deltas ahead of the slowest subscriber, so a slow client still holds back
+    reading from Elasticsearch
+    """
+
+    def __init__(self, source, max_lag):
+        self.deltas = []
+        self.finished = False
+        self.error = None
+        self.max_lag = max_lag
+        # subscriber -> deltas it has read
+        self._positions = {}
+        self._changed = asyncio.Event()
+        self._advanced = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(source))
+
+    @property
+    def subscribers(self):
+        return len(self._positions)
+
+    @staticmethod
+    def _notify(event):
+        # waiters hold the old event, the next wait gets a fresh one
+        event.set()
+        return asyncio.Event()
+
+    def _lagging(self):
+        return self._positions and len(self.deltas) - min(self._positions.values()) >= self.max_lag
+
+    async def _pump(self, source):
+        try:
+            async for delta in source:
+                self.deltas.append(delta)
+                self._changed = self._notify(self._changed)
+                while self._lagging():
+                    await self._advanced.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._changed = self._notify(self._changed)
+
+    def _move(self, subscriber, position):
+        self._positions[subscriber] = position
+        self._advanced = self._notify(self._advanced)
+
+    async def subscribe(self):
+        subscriber = object()
+        position = 0
+        self._positions[subscriber] = position
+        try:
+            while True:
+                while position < len(self.deltas):
+                    yield self.deltas[position]
+                    position += 1
+                    self._move(subscriber, position)
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            del self._positions[subscriber]
+            self._advanced = self._notify(self._advanced)
+
+
+class SharedStreams:
+    """
+    SingleFlight for async generators: concurrent identical streams share one upstream stream.
+
+    Subscribers that join late first get the deltas already received, so every one of them sees the whole
+    response. The upstream is read at most max_lag deltas ahead of the slowest subscriber, so backpressure from
+    a slow websocket reaches Elasticsearch as it does for an unshared stream
+    """
+
+    def __init__(self, name, max_lag):
+        self.name = name
+        self.max_lag = max_lag
+        self._streams = {}
+
+    async def stream(self, key, open_stream):
+        if not SINGLE_FLIGHT_ENABLED:
+            async for delta in open_stream():
+                yield delta
+            return
+        shared = self._streams.get(key)
+        if shared is None or shared.finished:
+            shared = self._streams[key] = _SharedStream(open_stream(), self.max_lag)
+            shared.task.add_done_callback(lambda _: self._streams.pop(key, None) if self._streams.get(key) is shared else None)
+        else:
+            COALESCED.labels(self.name).inc()
+            logger.debug("Joined in-flight %s stream", self.name)
+        try:
+            async for delta in shared.subscribe():
+                yield delta
+        finally:
+            if shared.subscribers == 0 and not shared.task.done():
+                shared.task.cancel()
+
+    def in_flight(self):
+        return len(self._streams)
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from .es_client import get_es_client
+
+
+class TTLMap:
+    """
+    In-process LRU map whose entries expire ttl seconds after they were written. Each worker holds its own copy.
+    Backs the memory backends of the response cache and the session store
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _live(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        """The value of key, marked as most recently used, or None when it is missing or expired"""
+        entry = self._live(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def items(self):
+        """(key, value) of the entries that have not expired, dropping the expired ones on the way"""
+        for key in list(self.entries):
+            entry = self._live(key)
+            if entry is not None:
+                yield key, entry[1]
+
+
+async def delete_expired(index, field="expires_at"):
+    """
+    Delete the documents of index whose expiry date has passed, for the Elasticsearch backends of the response
+    cache and the session store.
+    :return: number of documents deleted
+    """
+    expired = await get_es_client().delete_by_query(
+        index=index,
+        query={"range": {field: {"lte": "now"}}},
+        conflicts="proceed"
+    )
+    return expired.get("deleted", 0)
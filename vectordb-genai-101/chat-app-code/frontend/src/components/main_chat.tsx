@@ -11,13 +11,23 @@ export default function MainChat() {
     const [promptContext, setPromptContext] = useState([]);
     const websocket = useRef<WebSocket | null>(null);
     const [verboseMode, setVerboseMode] = useState(false);
+    // Read by reconnects, which run outside of the render that created them
+    const verboseModeRef = useRef(false);
+    // The conversation history as the server last described it, history frames only carry the changes
+    const conversationHistory = useRef<{ role: string, content: string }[]>([]);
     const [connectionStatus, setConnectionStatus] = useState('Connecting...');
 
     // Define the connectWebSocket function to handle WebSocket connections
     const connectWebSocket = () => {
         const protocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
-        const websocketURL = `/ws`;
-        websocket.current = new WebSocket(websocketURL);
+        // Reconnects resume the same server-side conversation
+        const sessionId = sessionStorage.getItem('chatSessionId');
+        const params = new URLSearchParams({ verbose: verboseModeRef.current ? 'compact' : 'off' });
+        if (sessionId) {
+            params.set('session_id', sessionId);
+        }
+        conversationHistory.current = [];
+        websocket.current = new WebSocket(`/ws?${params}`);
 
         websocket.current.onopen = () => {
             setConnectionStatus('Connected');
@@ -56,6 +66,9 @@ export default function MainChat() {
 
     const handleWebSocketData = (data: any) => {
         switch (data.type) {
+            case 'session':
+                sessionStorage.setItem('chatSessionId', data.session_id);
+                break;
             case 'content_block_delta':
                 if (data.delta.type === 'text_delta') {
                     setMessages(prevMessages => {
@@ -71,6 +84,10 @@ export default function MainChat() {
             case 'content_block_start':
                 setMessages(prevMessages => [...prevMessages, { text: '', from: 'AI' }]);
                 break;
+            case 'busy':
+                // The server shed this turn under load, nothing was added to the conversation
+                setMessages(prevMessages => [...prevMessages, { text: data.text, from: 'AI' }]);
+                break;
             case 'error_message':
                 setMessages(prevMessages => [...prevMessages, { text: data.text, from: 'AI' }]);
                 break;
@@ -80,6 +97,25 @@ export default function MainChat() {
             case 'verbose_info':
                 setMessages(prevMessages => [...prevMessages, { text: data.text, from: 'Verbose', verbose: true }]);
                 break;
+            case 'context': {
+                const hits = data.hits.map((hit: any) =>
+                    `${hit.index}/${hit.id} score=${hit.score} ${JSON.stringify(hit.metadata)} ${hit.text}`
+                ).join('\n\n');
+                const text = `Context gathered from Elasticsearch\n\n${hits}`;
+                setMessages(prevMessages => [...prevMessages, { text, from: 'Verbose', verbose: true }]);
+                break;
+            }
+            case 'history': {
+                conversationHistory.current = data.reset
+                    ? data.messages
+                    : [...conversationHistory.current, ...data.append];
+                const history = conversationHistory.current
+                    .map(message => `${message.role}: ${message.content}`)
+                    .join('\n---------------------------------------------------------\n\n');
+                const text = `Conversation history updated:\n\n${history}`;
+                setMessages(prevMessages => [...prevMessages, { text, from: 'Verbose', verbose: true }]);
+                break;
+            }
             case 'content_block_stop':
                 break;
             case 'message_stop':
@@ -94,8 +130,32 @@ export default function MainChat() {
                     verbose: true
                 }]);
                 break;
+            case 'partial_response':
+                setMessages(prevMessages => {
+                    const newMessages = [...prevMessages];
+                    const lastMessage = newMessages[newMessages.length - 1];
+                    if (lastMessage && lastMessage.streaming) {
+                        newMessages[newMessages.length - 1] = { ...lastMessage, text: lastMessage.text + data.text };
+                        return newMessages;
+                    }
+                    return [...newMessages, { text: data.text, from: 'AI', streaming: true }];
+                });
+                break;
             case 'full_response':
-                setMessages(prevMessages => [...prevMessages, { text: data.text, from: 'AI' }]);
+                setMessages(prevMessages => {
+                    if (data.streamed) {
+                        // Replace the streamed bubble with the final assembled text
+                        const index = prevMessages.findLastIndex(message => message.streaming);
+                        if (index !== -1) {
+                            // Only verbose=full repeats the text, otherwise the streamed text is the answer
+                            const newMessages = [...prevMessages];
+                            newMessages[index] = { text: data.text ?? prevMessages[index].text, from: 'AI' };
+                            return newMessages;
+                        }
+                    }
+                    // A streamed answer that sent no partial_response frames only has text in verbose=full
+                    return [...prevMessages, { text: data.text ?? '', from: 'AI' }];
+                });
                 break;
             case 'source_text':
                 console.log('Source text received:', data.text);
@@ -108,6 +168,23 @@ export default function MainChat() {
         }
     };
 
+    const handleInputChange = (text: string) => {
+        setInputText(text);
+        // Lets the server start retrieval while the user is still typing, it debounces these itself
+        if (text.trim().length >= 8 && websocket.current && websocket.current.readyState === WebSocket.OPEN) {
+            websocket.current.send(JSON.stringify({ type: 'prefetch', message: text }));
+        }
+    };
+
+    const handleVerboseChange = (verbose: boolean) => {
+        setVerboseMode(verbose);
+        verboseModeRef.current = verbose;
+        // Verbose frames are only sent while they are shown
+        if (websocket.current && websocket.current.readyState === WebSocket.OPEN) {
+            websocket.current.send(JSON.stringify({ type: 'settings', verbose: verbose ? 'compact' : 'off' }));
+        }
+    };
+
     const handleSendClick = () => {
         if (inputText.trim()) {
             // Check if the WebSocket is open before sending
@@ -151,7 +228,7 @@ export default function MainChat() {
                             className="textarea-chat"
                             rows={1}
                             value={inputText}
-                            onChange={(e) => setInputText(e.target.value)}
+                            onChange={(e) => handleInputChange(e.target.value)}
                         />
                         <button type="submit" onClick={handleSendClick}
                             className="send-button">
@@ -189,7 +266,7 @@ export default function MainChat() {
                     <input
                         type="checkbox"
                         checked={verboseMode}
-                        onChange={(e) => setVerboseMode(e.target.checked)}
+                        onChange={(e) => handleVerboseChange(e.target.checked)}
                     />
                     <span className="verbose-mode-label">Verbose Mode</span>
                 </label>